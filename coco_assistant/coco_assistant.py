@@ -1,17 +1,11 @@
 # -*- coding: utf-8 -*-
 import ast
-import json
 import logging
 import sys
 from pathlib import Path
 
-from pycocotools.coco import COCO
-from tqdm import tqdm
-
 from coco_assistant import utils
-
-from . import coco_stats as stats
-from . import coco_visualiser as cocovis
+from coco_assistant.utils import jsonio
 
 logging.basicConfig(level=logging.ERROR)
 logging.getLogger().setLevel(logging.WARNING)
@@ -38,17 +32,59 @@ Expected Directory Structure
 class COCO_Assistant:
     """COCO_Assistant object"""
 
-    def __init__(self, img_dir, ann_dir):
+    def __init__(
+        self,
+        img_dir,
+        ann_dir,
+        mem_budget=None,
+        workers=None,
+        cache=False,
+        stream=False,
+        compression=None,
+        result_cache=False,
+        result_cache_size=None,
+    ):
         """
+        Annotation files are only parsed the first time a dataset is accessed
+        through `anndict`. Datasets are held as column arrays (see `utils.AnnTable`)
+        and exposed as pycocotools compatible `COCO` objects.
 
         Args:
             img_dir (str): Path to images folder.
             ann_dir (str): Path to images folder.
+            mem_budget (int, optional): Approximate number of bytes the parsed datasets may
+                occupy at once. Least recently used datasets are dropped (and parsed again
+                when needed) once it is exceeded. Defaults to None (no limit).
+            workers (int, optional): If greater than 1, all annotation files are parsed up
+                front in parallel, using up to this many processes. Merges are run in parallel
+                as well. Defaults to None.
+            cache (bool or str, optional): Keep a binary sidecar cache of every parsed
+                annotation file, which later constructions memory-map instead of parsing the
+                json again. Caches are stored in `<ann_dir>/.coco_cache`, or in the given
+                directory, and are rebuilt automatically when the json changes. Defaults to False.
+            stream (bool, optional): Read annotation files incrementally instead of loading
+                them. `anndict` then holds `utils.AnnStream` readers and merge, remove_cat,
+                ann_stats and anchors run with bounded memory. Operations that need random
+                access (get_segmasks, visualise) still load the dataset. Defaults to False.
+            compression (str, optional): Compress the annotation files written by merge and
+                remove_cat with "gzip" (`.json.gz`) or "zstd" (`.json.zst`, requires the
+                zstandard package). Compressed annotation files in `ann_dir` are read
+                transparently either way. Defaults to None.
+            result_cache (bool or str, optional): Keep the results of ann_stats and anchors
+                on disk, keyed by the content of the annotation files and the parameters of
+                the call, so repeated analyses of unchanged datasets are not computed again,
+                even by later processes. Results are stored in `<res_dir>/.result_cache`, or
+                in the given directory. Defaults to False.
+            result_cache_size (int, optional): Number of bytes the result cache may occupy
+                before least recently used results are evicted. Defaults to 256M.
 
         """
         self.img_dir = Path(img_dir)
         self.ann_dir = Path(ann_dir)
         self.res_dir = self.ann_dir.parent / "results"
+        self.stream = stream
+        self.workers = workers
+        self.compression = compression
 
         self.dh = utils.DirectoryHandler(img_dir, ann_dir, self.res_dir)
 
@@ -56,90 +92,188 @@ class COCO_Assistant:
         logging.debug("Number of image folders = %s", len(self.dh.names))
         logging.debug("Number of annotation files = %s", len(self.dh.names))
 
-        self.annfiles = [COCO(self.ann_dir / (i + ".json")) for i in self.dh.names]
-        self.anndict = dict(zip(self.dh.names, self.annfiles))
+        if cache is True:
+            self.cache_dir = self.ann_dir / utils.DEFAULT_CACHE_DIR
+        else:
+            self.cache_dir = Path(cache) if cache else None
+
+        # Annotation tables parsed up front or memory-mapped from cache,
+        # waiting to be handed to anndict
+        paths = [self.dh.ann_path(i) for i in self.dh.names]
+        if stream:
+            tables = []
+        elif workers is not None and workers > 1:
+            tables = utils.load_tables(paths, workers, self.cache_dir)
+        elif self.cache_dir is not None:
+            tables = [utils.load_cached_table(p, self.cache_dir) for p in paths]
+        else:
+            tables = []
+        self._tables = {n: t for n, t in zip(self.dh.names, tables) if t is not None}
+
+        if result_cache:
+            root = (
+                self.res_dir / utils.DEFAULT_RESULT_CACHE_DIR
+                if result_cache is True
+                else Path(result_cache)
+            )
+            size = {"max_bytes": result_cache_size} if result_cache_size is not None else {}
+            self.results = utils.ResultCache(root, **size)
+        else:
+            self.results = None
 
-        self.ann_anchors = []
+        self.anndict = utils.LazyAnnDict(
+            self.dh.names, self._load_ann, mem_budget=mem_budget, sizeof=self._ann_size
+        )
 
-    def merge(self):
+        self.ann_anchors = []
+        self._anchor_params = None
+
+    @property
+    def annfiles(self):
+        """list[COCO]: Parsed annotation objects of every dataset (loads all of them)."""
+        return list(self.anndict.values())
+
+    def _load_ann(self, name):
+        if self.stream:
+            return utils.AnnStream(self.dh.ann_path(name))
+        return self._load_view(name)
+
+    def _load_view(self, name):
+        path = self.dh.ann_path(name)
+        table = self._tables.pop(name, None)
+        if table is None:
+            table = utils.load_table(path, self.cache_dir)
+        if table is not None:
+            return utils.TableCOCO(table)
+        # Not representable as a table (e.g. string ids)
+        return utils.load_coco(path)
+
+    def _source(self, name):
+        # Chunked record source of a dataset, see utils.merge_sources
+        if self.stream:
+            return self.anndict[name]
+        return utils.COCOSource(self.anndict, name)
+
+    def _random_access(self, name):
+        ann = self.anndict[name]
+        if isinstance(ann, utils.AnnStream):
+            logging.info("Loading %s for an operation that needs random access", name)
+            return self._load_view(name)
+        return ann
+
+    def _cached_all(self, op, params, compute, refresh=False):
+        # Result of an operation on every dataset, from the result cache if enabled.
+        # `compute` is called once with the names of all datasets missing from the cache.
+        results, keys = {}, {}
+        if self.results is not None:
+            for name in self.anndict:
+                keys[name] = self.results.key(op, [self.dh.ann_path(name)], params)
+                value = None if refresh else self.results.get(keys[name])
+                if value is not None:
+                    results[name] = value
+        missing = [name for name in self.anndict if name not in results]
+        if missing:
+            fresh = compute(missing)
+            for name in missing:
+                results[name] = fresh[name]
+                if self.results is not None:
+                    self.results.put(keys[name], fresh[name])
+        return {name: results[name] for name in self.anndict}
+
+    def _stats(self, stat, arearng):
+        from . import coco_stats as stats
+
+        results = {}
+        # Plain floats, so array valued ranges can be keyed
+        key_rng = [float(a) for a in arearng] if arearng is not None else None
+        for name in self.anndict:
+            res, keys = {}, {}
+            if self.results is not None:
+                path = self.dh.ann_path(name)
+                for s in stat:
+                    params = {"stat": s, "arearng": key_rng if s == "area" else None}
+                    keys[s] = self.results.key("stats", [path], params)
+                    value = self.results.get(keys[s])
+                    if value is not None:
+                        res[s] = value
+            # Statistics missing from the cache are computed together, in as few passes as possible
+            missing = [s for s in stat if s not in res]
+            if missing:
+                fresh = stats.dataset_stats({name: self.anndict[name]}, missing, arearng)[name]
+                for s in missing:
+                    res[s] = fresh[s]
+                    if self.results is not None:
+                        self.results.put(keys[s], fresh[s])
+            results[name] = {s: res[s] for s in stat}
+        return results
+
+    def _ann_size(self, name, ann):
+        # A parsed COCO object takes several times the size of its json.
+        # The file size is used as a cheap, monotonic estimate of it.
+        return self.dh.ann_path(name).stat().st_size
+
+    def merge(self, append=False, workers=None):
         """
         Merge multiple coco datasets
-        """
-
-        resann_dir = self.dh.create("merged/annotations")
-
-        cann = {"images": [], "annotations": [], "info": None, "licenses": None, "categories": None}
 
-        logging.debug("Merging Annotations...")
-
-        dst_ann = resann_dir / "merged.json"
-
-        print("Merging annotations")
-        for j in tqdm(self.dh.names):
-            cj = self.anndict[j].dataset
-
-            ind = self.dh.names.index(j)
-            # Check if this is the 1st annotation.
-            # If it is, continue else modify current annotation
-            if ind == 0:
-                cann["images"] = cann["images"] + cj["images"]
-                cann["annotations"] = cann["annotations"] + cj["annotations"]
-                if "info" in list(cj.keys()):
-                    cann["info"] = cj["info"]
-                if "licenses" in list(cj.keys()):
-                    cann["licenses"] = cj["licenses"]
-                cann["categories"] = sorted(cj["categories"], key=lambda i: i["id"])
-
-                last_imid = cann["images"][-1]["id"]
-                last_annid = cann["annotations"][-1]["id"]
-
-                # If last imid or last_annid is a str, convert it to int
-                if isinstance(last_imid, str) or isinstance(last_annid, str):
-                    logging.debug("String Ids detected. Converting to int")
-                    id_dict = {}
-                    # Change image id in images field
-                    for i, im in enumerate(cann["images"]):
-                        id_dict[im["id"]] = i
-                        im["id"] = i
-
-                    # Change annotation id & image id in annotations field
-                    for i, im in enumerate(cann["annotations"]):
-                        im["id"] = i
-                        if isinstance(last_imid, str):
-                            im["image_id"] = id_dict[im["image_id"]]
-
-                last_imid = max(im["id"] for im in cann["images"])
-                last_annid = max(ann["id"] for ann in cann["annotations"])
+        The merged annotation file is written incrementally, one chunk of
+        records at a time, so the combined dataset is never held in memory.
 
+        Args:
+            append (bool, optional): Only merge the datasets that are not part of the
+                existing merged annotation file yet and append them to it. The result is
+                the same as merging all datasets again. Falls back to a full merge if there
+                is no merged annotation file, if appending would change the order of the
+                datasets, i.e. a new dataset name sorts before a merged one or a merged
+                dataset is gone, or if the annotation file of a merged dataset changed
+                since. Defaults to False.
+            workers (int, optional): If greater than 1, the datasets are rewritten in
+                parallel worker processes once the merged category table has been built
+                (see `utils.merge_files`). Defaults to the `workers` the assistant was
+                created with.
+        """
+        dst_ann = jsonio.json_path(self.res_dir / "merged/annotations", "merged", self.compression)
+        manifest = utils.load_manifest(dst_ann) if append and dst_ann.exists() else None
+        if manifest is not None:
+            names = [j for j in self.dh.names if j not in manifest["names"]]
+            # A full merge takes the datasets in name order, appending after the merged ones
+            if manifest["names"] + names != self.dh.names:
+                logging.info("Appending would reorder the merged datasets, merging all datasets")
+                manifest = None
             else:
+                changed = utils.changed_sources(manifest)
+                if changed:
+                    logging.warning(
+                        "%s changed after being merged, merging all datasets", ", ".join(changed)
+                    )
+                    manifest = None
+        if manifest is not None:
+            if not names:
+                print("Nothing to append, all datasets are merged already")
+                return
+            print("Appending {} to merged annotations".format(", ".join(names)))
+        else:
+            if append:
+                logging.info("No merged annotations to append to, merging all datasets")
+            names = self.dh.names
+            self.dh.create("merged/annotations")
+            print("Merging annotations")
 
-                id_dict = {}
-                # Change image id in images field
-                for i, im in enumerate(cj["images"]):
-                    id_dict[im["id"]] = last_imid + i + 1
-                    im["id"] = last_imid + i + 1
-
-                # Change annotation and image ids in annotations field
-                for i, ann in enumerate(cj["annotations"]):
-                    ann["id"] = last_annid + i + 1
-                    ann["image_id"] = id_dict[ann["image_id"]]
-
-                # Remap categories
-                cmapper = utils.CatRemapper(cann["categories"], cj["categories"])
-                cann["categories"], cj["annotations"] = cmapper.remap(cj["annotations"])
-
-                cann["images"] = cann["images"] + cj["images"]
-                cann["annotations"] = cann["annotations"] + cj["annotations"]
-                if "info" in list(cj.keys()):
-                    cann["info"] = cj["info"]
-                if "licenses" in list(cj.keys()):
-                    cann["licenses"] = cj["licenses"]
-
-                last_imid = cann["images"][-1]["id"]
-                last_annid = cann["annotations"][-1]["id"]
+        logging.debug("Merging Annotations...")
 
-        with open(dst_ann, "w") as aw:
-            json.dump(cann, aw)
+        append = manifest is not None
+        workers = workers if workers is not None else self.workers
+        if workers is not None and workers > 1:
+            paths = [self.dh.ann_path(j) for j in names]
+            merge = utils.merge_files(
+                paths, dst_ann, workers, names, append, self.stream, self.cache_dir
+            )
+        else:
+            sources = [self._source(j) for j in names]
+            paths = [self.dh.ann_path(j) for j in names]
+            merge = utils.merge_sources(sources, dst_ann, names, append, paths)
+        if merge.datasets and merge.datasets[0].renumber:
+            logging.debug("String Ids detected. Converting to int")
 
     def remove_cat(self, interactive=True, jc=None, rcats=None):
 
@@ -175,11 +309,13 @@ class COCO_Assistant:
                 raise AssertionError("Index exceeds number of datasets")
             # ann = self.annfiles[json_choice]
             name = self.dh.names[json_choice]
-            json_name = name + ".json"
             ann = self.anndict[name]
 
             print("\nCategories present:")
-            cats = [i["name"] for i in ann.cats.values()]
+            if isinstance(ann, utils.AnnStream):
+                cats = [i["name"] for i in ann.categories]
+            else:
+                cats = [i["name"] for i in ann.loadCats(ann.getCatIds())]
             print(cats)
 
             self.rcats = []
@@ -200,49 +336,151 @@ class COCO_Assistant:
                 )
             # If passed, json_choice needs to be full path
             json_choice = Path(jc)  # Full path
-            name = json_choice.stem
-            json_name = json_choice.name  # abc
-            ann = self.anndict[name]
+            name = jsonio.json_name(json_choice)
             self.rcats = rcats
 
         print("Removing specified categories...")
+        dst = jsonio.json_path(resrm_dir, name, self.compression)
+        utils.remove_categories(self._source(name), self.rcats, dst)
+
+    def remove_cats(self, rcats, names=None, prune_images=False, compact=False):
+        """
+        Remove categories from several datasets in one go.
+
+        Every dataset is filtered straight from its loaded (or streamed)
+        annotations and written to `results/removal`.
 
-        # Gives you a list of category ids of the categories to be removed
-        catids_remove = ann.getCatIds(catNms=self.rcats)
-        # Gives you a list of ids of annotations that contain those categories
-        annids_remove = ann.getAnnIds(catIds=catids_remove)
+        Args:
+            rcats (list[str] or dict): Names of the categories to remove from every dataset,
+                or a mapping of dataset names to the categories to remove from them.
+            names (list[str], optional): Datasets to remove `rcats` from if it is a list.
+                Defaults to None (all datasets).
+            prune_images (bool, optional): Drop images whose annotations all belong to removed
+                categories. Defaults to False.
+            compact (bool, optional): Renumber the remaining categories 1..N. Defaults to False.
 
-        # Get keep category ids
-        catids_keep = list(set(ann.getCatIds()) - set(catids_remove))
-        # Get keep annotation ids
-        annids_keep = list(set(ann.getAnnIds()) - set(annids_remove))
+        Raises:
+            AssertionError: if a dataset does not exist
+            AssertionError: if compacting and an annotation belongs to an unlisted category
 
-        with open(self.ann_dir / json_name) as it:
-            x = json.load(it)
+        Returns:
+            dict: Number of remaining "categories", "annotations" and "images" of every dataset
+        """
+        if not isinstance(rcats, dict):
+            rcats = {name: rcats for name in (names if names is not None else self.dh.names)}
+        unknown = [name for name in rcats if name not in self.anndict]
+        if unknown:
+            raise AssertionError("Unknown datasets: {}".format(unknown))
 
-        del x["categories"]
-        x["categories"] = ann.loadCats(catids_keep)
-        del x["annotations"]
-        x["annotations"] = ann.loadAnns(annids_keep)
+        resrm_dir = self.dh.create("removal")
+        print("Removing specified categories...")
+        counts = {}
+        for name, cats in rcats.items():
+            dst = jsonio.json_path(resrm_dir, name, self.compression)
+            src = self._source(name)
+            counts[name] = utils.remove_categories(src, cats, dst, prune_images, compact)
+        return counts
+
+    def query(self, name, save=None, **filters):
+        """
+        Select the annotations of a dataset that match a set of filters.
 
-        with open(resrm_dir / json_name, "w") as oa:
-            json.dump(x, oa)
+        Filters are evaluated on column arrays of the dataset (see `utils.AnnQuery`),
+        e.g. `cas.query("train", cats=["person"], area=(32 ** 2, None), iscrowd=False)`.
+        To run many queries on one dataset, create a `utils.AnnQuery` once and reuse it.
 
-    def ann_stats(self, stat, arearng, show_count=False, save=False):
+        Args:
+            name (str): Name of the dataset
+            save (str, optional): Write the selected annotations and their images to
+                `results/query/<save>.json`. Defaults to None.
+            **filters: Filters accepted by `utils.AnnQuery.select`
+
+        Raises:
+            AssertionError: if the dataset or a category does not exist
+
+        Returns:
+            list: Ids of the selected annotations
+        """
+        if name not in self.anndict:
+            raise AssertionError("Unknown dataset: {}".format(name))
+        q = utils.AnnQuery(self._source(name))
+        sel = q.select(**filters)
+        if save is not None:
+            dst = jsonio.json_path(self.dh.create("query"), save, self.compression)
+            q.write(sel, dst)
+        return q.ann_ids[sel.anns].tolist()
+
+    def ann_stats(
+        self, stat, arearng=None, show_count=False, save=False, headless=False, report=None
+    ):
         """Display statistics.
 
+        In headless mode (or when a report is requested) the statistics are
+        computed without plotting and returned. Plots are then only drawn if
+        `save` is set, on an Agg canvas that leaves the matplotlib backend alone,
+        and written to disk.
+        With a result cache (see `result_cache`), statistics of unchanged
+        datasets are loaded instead of computed.
+
         Args:
-            stat (str): Type of statistic to be shown. Supports ["area", "cat"]
-            arearng (list[float]): Area range list
+            stat (str or list[str]): Type of statistic to be shown. Supports ["area", "cat",
+                "per_image", "geometry"], and "image" (per image statistics) in headless mode.
+                "per_image" shows annotations per image, empty images and image resolutions,
+                "geometry" bounding box aspect ratios, relative sizes and polygon vertex counts
+                (see `coco_stats.geometry_stats`).
+            arearng (list[float], optional): Side lengths bounding small, medium and large
+                objects. Defaults to the COCO sizes [0, 32, 96, 1e5].
             show_count (bool, optional): Shows category countplot if True. Defaults to False.
             save (bool, optional): Save stat plot to disk if True. Defaults to False.
+            headless (bool, optional): Return the statistics instead of showing plots.
+                Defaults to False.
+            report (str, optional): Also write the statistics to this `.json` or `.csv` file.
+                Defaults to None.
+
+        Returns:
+            dict: Statistics of every dataset (see `coco_stats.dataset_stats`), if headless
+                or a report is requested
         """
-        if stat == "area":
-            stats.pi_area_split(self.anndict, areaRng=arearng, save=save)
-        elif stat == "cat":
-            stats.cat_count(self.anndict, show_count=show_count, save=save)
-
-    def anchors(self, n, fmt="rect", recompute=False):
+        # Plotting libraries are slow to import, only load them when needed
+        from . import coco_stats as stats
+
+        stat = [stat] if isinstance(stat, str) else list(stat)
+        results = self._stats(stat, arearng)
+        if report is not None:
+            stats.write_report(results, report)
+
+        headless = headless or report is not None
+        if headless and not save:
+            return results
+        for s in stat:
+            data = {name: res[s] for name, res in results.items()}
+            if s == "area":
+                stats.pi_area_split(
+                    self.anndict, areaRng=arearng, save=save, headless=headless, splits=data
+                )
+            elif s == "cat":
+                stats.cat_count(
+                    self.anndict, show_count=show_count, save=save, headless=headless, counts=data
+                )
+            elif s in ("per_image", "geometry"):
+                stats.geometry_plot(self.anndict, s, save=save, headless=headless, results=data)
+        return results if headless else None
+
+    def anchors(
+        self,
+        n,
+        fmt="rect",
+        recompute=False,
+        init="random",
+        seed=None,
+        batch_size=None,
+        max_iter=None,
+        tol=0,
+        restarts=1,
+        scales=None,
+        levels=None,
+        workers=None,
+    ):
         """
         Generate top N anchors
 
@@ -250,35 +488,113 @@ class COCO_Assistant:
             Experimental feature
 
         Args:
-            n (int): Number of anchors
+            n (int): Number of anchors (per scale level)
             fmt (str): Anchor type i.e. square or rectangular. Defaults to "rect".
-            recompute (bool, optional): Recomputes the anchors if True. Defaults to False.
+            recompute (bool, optional): Recomputes the anchors if True, even if they are in
+                the result cache. Defaults to False.
+            init (str, optional): Initialisation of the clustering, "random" or "kmeans++".
+                Defaults to "random".
+            seed (int, optional): Seed for reproducible anchors. Defaults to None.
+            batch_size (int, optional): Cluster random batches of this many boxes per iteration
+                (mini-batch k-means), for datasets with very many boxes. Defaults to None.
+            max_iter (int, optional): Maximum number of clustering iterations. Defaults to None.
+            tol (float, optional): Stop clustering once no anchor moves by more than this IoU
+                distance in an iteration. Defaults to 0.
+            restarts (int, optional): Number of clustering runs per dataset (and level), the
+                one with the best average IoU is kept. Defaults to 1.
+            scales (list[float] or str, optional): Compute anchors per scale level, for feature
+                pyramids. Either the edges between the levels (in square root of box area) or
+                "fpn" for the P3-P7 levels. Defaults to None.
+            levels (list[str], optional): Names of the scale levels. Defaults to None.
+            workers (int, optional): If greater than 1, the runs of all datasets, levels and
+                restarts are spread over this many worker processes. Defaults to the `workers`
+                the assistant was created with.
         """
-
-        if recompute or not self.ann_anchors:
+        kmeans = {
+            "init": init,
+            "seed": seed,
+            "batch_size": batch_size,
+            "max_iter": max_iter,
+            "tol": tol,
+        }
+        if scales is not None and not isinstance(scales, str):
+            scales = [float(s) for s in scales]
+        params = dict(kmeans, n=n, fmt=fmt, restarts=restarts, scales=scales, levels=levels)
+        if recompute or not self.ann_anchors or self._anchor_params != params:
             print("Calculating anchors...")
-            names, anns = self.anndict.keys(), self.anndict.values()
-            a = [utils.generate_anchors(j, n, fmt) for j in anns]
-            self.ann_anchors = dict(zip(names, a))
+            workers = workers if workers is not None else self.workers
+
+            def cluster(names):
+                dims = {name: utils.anchors.box_dims(self.anndict[name]) for name in names}
+                runs = utils.cluster_anchors(dims, n, restarts, scales, levels, workers, **kmeans)
+                return {name: utils.anchors.report_anchors(runs[name], n, fmt) for name in names}
+
+            self.ann_anchors = self._cached_all("anchors", params, cluster, refresh=recompute)
+            self._anchor_params = params
         else:
             print("Loading pre-computed anchors")
             print(self.ann_anchors)
 
-    def get_segmasks(self, palette=True):
+    def evaluate_anchors(self, anchors=None, thresholds=None, report=None):
+        """
+        Evaluate how well anchors cover the boxes of every dataset.
+
+        Args:
+            anchors (np.ndarray or dict, optional): Anchor widths and heights to evaluate on
+                every dataset, or per level. Defaults to None, in which case the anchors last
+                generated by `anchors` are evaluated on their own dataset.
+            thresholds (list[float], optional): IoU thresholds of the recall. Defaults to
+                (0.5, 0.6, 0.7, 0.75, 0.8, 0.9).
+            report (str, optional): Also write the evaluation to a JSON or CSV report.
+                Defaults to None.
+
+        Raises:
+            AssertionError: if no anchors are given and none were generated yet
+
+        Returns:
+            dict: Evaluation of every dataset (see `utils.evaluate_anchors`)
+        """
+        if anchors is None and not self.ann_anchors:
+            raise AssertionError("No anchors to evaluate, generate them with anchors() first")
+        kwargs = {"thresholds": thresholds} if thresholds is not None else {}
+        results = {
+            name: utils.evaluate_anchors(
+                self.anndict[name],
+                self.ann_anchors[name] if anchors is None else anchors,
+                **kwargs,
+            )
+            for name in self.anndict
+        }
+        if report is not None:
+            from . import coco_stats as stats
+
+            stats.write_report(results, report)
+        return results
+
+    def get_segmasks(self, palette=True, workers=None, fmt="png"):
         """
         Generate segmentation masks
 
         Args:
             palette (bool, optional): Create masks with color palette if True. Defaults to True.
+            workers (int, optional): If greater than 1, masks are rendered in this many worker
+                processes (see `utils.det2seg`). Defaults to the `workers` the assistant was
+                created with.
+            fmt (str, optional): "png" for one PNG per image, or "shards" to store the masks
+                of every dataset uncompressed in a few large files with an index, to be read
+                back with `utils.MaskShards`. Defaults to "png".
         """
-        for name, ann in self.anndict.items():
+        workers = workers if workers is not None else self.workers
+        for name in self.anndict:
             output_dir = self.res_dir / "segmasks" / name
-            utils.det2seg(ann, output_dir, palette)
+            utils.det2seg(self._random_access(name), output_dir, palette, workers=workers, fmt=fmt)
 
     def visualise(self):
         """
         Visualise annotations.
         """
+        from . import coco_visualiser as cocovis
+
         print("Choose directory index (1:first, 2: second ..):")
         print(self.dh.names)
 
@@ -291,7 +607,7 @@ class COCO_Assistant:
         if dir_choice > len(self.dh.names):
             raise AssertionError("Index exceeds number of datasets")
         dir_choice = self.dh.names[dir_choice]
-        ann = self.anndict[dir_choice]
+        ann = self._random_access(dir_choice)
         img_dir = self.img_dir / dir_choice
         cocovis.visualise_all(ann, img_dir)
 
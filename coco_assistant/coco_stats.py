@@ -1,35 +1,79 @@
+import csv
+import json
 import logging
 import os
+from collections import Counter
 
-import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
+import numpy as np
 from pycocotools.coco import COCO
 
+from .utils import AnnStream, StatsSketch, get_table
+from .utils.sketch import ASPECT_EDGES, bin_index, bin_labels, check_bins
+from .utils.table import polygon_vertices
+
 logging.basicConfig(level=logging.DEBUG)
 
+# Side lengths bounding small, medium and large objects in COCO
+_COCO_SIZES = [0, 32, 96, 1e5]
+_SIZE_LABELS = ["small", "medium", "large"]
+# Statistics computed by dataset_stats
+STATS = ("cat", "area", "image", "per_image", "geometry")
+RELATIVE_SIZE_EDGES = (0, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, np.inf)
+# Polygons of 3 vertices up to 128 and more
+VERTEX_EDGES = (3, 4, 8, 16, 32, 64, 128, np.inf)
+_PIE_COLORS = ["#ff9999", "#ffcc99", "#66b3ff", "#99ff99", "#c2c2f0", "#ffb3e6"]
+
+
+def _subplots(headless, *args, **kwargs):
+    if headless:
+        # Plots are only written to files: draw them on an Agg canvas of their own,
+        # outside of pyplot, so the backend of the process is left alone
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=kwargs.pop("figsize", None))
+        FigureCanvasAgg(fig)
+        return fig, fig.subplots(*args, **kwargs)
+
+    import matplotlib.pyplot as plt
+
+    return plt.subplots(*args, **kwargs)
+
+
+def _show(headless):
+    # Headless figures are not tracked by pyplot, nothing needs closing
+    if not headless:
+        import matplotlib.pyplot as plt
+
+        plt.show()
+
+
+def _plot_dir():
+    out_dir = os.path.join(os.getcwd(), "results", "plots")
+    os.makedirs(out_dir, exist_ok=True)
+    return out_dir
+
+
+def cat_count(anndict, show_count=False, save=False, headless=False, counts=None):
+    import pandas as pd
+    import seaborn as sns
 
-def cat_count(anndict, show_count=False, save=False):
+    # Counts may have been computed (or cached) already
+    if counts is None:
+        counts = {name: category_counts(ann) for name, ann in anndict.items()}
 
-    fig, axes = plt.subplots(1, len(anndict), sharey=False)
+    fig, axes = _subplots(headless, 1, len(counts), sharey=False)
 
     # Making axes iterable if only single annotation is present
-    if len(anndict) == 1:
+    if len(counts) == 1:
         axes = [axes]
 
-    # Prepare annotations dataframe
-    # This should be done at the start
-    for ann, name, ax in zip(anndict.values(), anndict.keys(), axes):
-        ann_df = pd.DataFrame(ann.anns).transpose()
-        if "category_name" not in ann_df.columns:
-            # Add a new column -> category name
-            ann_df["category_name"] = ann_df.apply(
-                lambda row: ann.cats[row.category_id]["name"], axis=1
-            )
-        chart = sns.countplot(
-            data=ann_df,
-            x="category_name",
-            order=ann_df["category_name"].value_counts().index,
+    for (name, cat_counts), ax in zip(counts.items(), axes):
+        series = pd.Series(cat_counts)
+        chart = sns.barplot(
+            x=series.index,
+            y=series.values,
+            order=series.index,
             palette="Set1",
             ax=ax,
         )
@@ -38,34 +82,450 @@ def cat_count(anndict, show_count=False, save=False):
 
         if show_count is True:
             for p in chart.patches:
-                height = p.get_height()
+                height = int(p.get_height())
                 chart.text(p.get_x() + p.get_width() / 2.0, height + 0.9, height, ha="center")
 
-    plt.suptitle("Instances per category", fontsize=14, fontweight="bold")
-    plt.tight_layout()
-
-    fig = plt.gcf()
+    fig.suptitle("Instances per category", fontsize=14, fontweight="bold")
+    fig.tight_layout()
     fig.set_size_inches(11, 11)
 
-    out_dir = os.path.join(os.getcwd(), "results", "plots")
     if save is True:
-        if os.path.exists(out_dir) is False:
-            os.mkdir(out_dir)
-        plt.savefig(
-            os.path.join(out_dir, "cat_dist" + ".png"),
+        fig.savefig(
+            os.path.join(_plot_dir(), "cat_dist" + ".png"),
             bbox_inches="tight",
             pad_inches=0,
-            dpi=plt.gcf().dpi,
+            dpi=fig.dpi,
         )
 
-    plt.show()
+    _show(headless)
+
+
+def category_counts(ann):
+    """
+    Number of instances of every category.
+
+    Args:
+        ann (COCO or AnnStream): Annotations
+
+    Returns:
+        dict: Instance count per category name, most frequent first
+    """
+    table = get_table(ann)
+    if isinstance(ann, AnnStream):
+        cats = ann.categories
+        counts = Counter()
+        for chunk in ann.annotations():
+            counts.update(a["category_id"] for a in chunk)
+    elif table is not None:
+        cats = table.categories
+        ids, n = np.unique(table.category_ids, return_counts=True)
+        counts = Counter(dict(zip(ids.tolist(), n.tolist())))
+    else:
+        cats = ann.dataset.get("categories", [])
+        counts = Counter(a["category_id"] for a in ann.anns.values())
+
+    names = {c["id"]: c["name"] for c in cats}
+    return {names.get(k, str(k)): v for k, v in counts.most_common()}
 
 
 def get_areas(ann):
+    table = get_table(ann)
+    if table is not None:
+        return table.areas.tolist()
+    if isinstance(ann, AnnStream):
+        return [a["area"] for chunk in ann.annotations() for a in chunk]
     return [ann.anns[key]["area"] for key in ann.anns]
 
 
+def _column_chunks(ann):
+    # Areas and category ids in chunks, so streamed annotations are never held at once
+    table = get_table(ann)
+    if table is not None:
+        yield table.areas, table.category_ids
+    elif isinstance(ann, AnnStream):
+        for chunk in ann.annotations():
+            yield _record_columns(chunk)
+    else:
+        yield _record_columns(ann.anns.values())
+
+
+def _record_columns(anns):
+    areas, cat_ids = [], []
+    for a in anns:
+        areas.append(a.get("area", np.nan))
+        cat_ids.append(a.get("category_id", -1))
+    return np.array(areas, dtype=float), np.array(cat_ids)
+
+
+def area_histogram(ann, edges, labels=None, by_category=False):
+    """
+    Number of objects in every area bin, counted in a single pass over the areas.
+
+    Bin i holds the areas in `[edges[i], edges[i + 1])`. Areas outside of
+    all bins, or missing, are counted as "ignored".
+
+    Args:
+        ann (COCO or AnnStream): Annotations
+        edges (list[float]): Increasing bin edges
+        labels (list[str], optional): Name of every bin. Defaults to "<min>-<max>".
+        by_category (bool, optional): Count the objects of every category separately.
+            Defaults to False.
+
+    Raises:
+        AssertionError: if the edges are not increasing or the labels do not match the bins
+
+    Returns:
+        dict: Count per bin label followed by "ignored", or such a dict per category name
+            if `by_category` is set
+    """
+    edges, labels = check_bins(edges, labels)
+
+    # Bin len(labels) collects the ignored objects
+    n_bins = len(labels) + 1
+    counts = {}
+    for areas, cat_ids in _column_chunks(ann):
+        idx = bin_index(areas, edges)
+        if not by_category:
+            cat_ids = np.zeros(len(idx), dtype=np.int64)
+        keys, inverse = np.unique(cat_ids, return_inverse=True)
+        hist = np.bincount(inverse.ravel() * n_bins + idx, minlength=len(keys) * n_bins)
+        for key, row in zip(keys.tolist(), hist.reshape(len(keys), n_bins)):
+            counts[key] = counts.get(key, 0) + row
+
+    keys = labels + ["ignored"]
+    if not by_category:
+        row = counts.get(0, np.zeros(n_bins, dtype=np.int64))
+        return dict(zip(keys, row.tolist()))
+    cats = ann.categories if isinstance(ann, AnnStream) else ann.loadCats(ann.getCatIds())
+    names = {c["id"]: c["name"] for c in cats}
+    return {names.get(k, str(k)): dict(zip(keys, row.tolist())) for k, row in counts.items()}
+
+
+def area_histograms(anndict, edges, labels=None, by_category=False):
+    """
+    Area histograms (see `area_histogram`) of several datasets.
+
+    Args:
+        anndict (dict): Mapping of dataset names to annotations
+        edges (list[float]): Increasing bin edges
+        labels (list[str], optional): Name of every bin. Defaults to "<min>-<max>".
+        by_category (bool, optional): Count the objects of every category separately.
+            Defaults to False.
+
+    Returns:
+        dict: Histogram of every dataset
+    """
+    return {name: area_histogram(ann, edges, labels, by_category) for name, ann in anndict.items()}
+
+
+def image_stats(ann):
+    """
+    Size and number of annotations of every image.
+
+    Args:
+        ann (COCO or AnnStream): Annotations
+
+    Returns:
+        dict: Arrays of image "ids", "widths", "heights" and number of "annotations",
+            one entry per image in file order
+    """
+    table = get_table(ann)
+    if table is not None:
+        index = table.img_index
+        pos = index.positions(table.img_ids)
+        n_anns = np.where(pos >= 0, index.counts()[pos], 0)
+        return {
+            "ids": table.img_ids,
+            "widths": table.img_widths,
+            "heights": table.img_heights,
+            "annotations": n_anns,
+        }
+
+    if isinstance(ann, AnnStream):
+        ids, widths, heights = _image_columns(ann.images())
+        per_img = Counter()
+        for chunk in ann.annotations():
+            per_img.update(a["image_id"] for a in chunk)
+    else:
+        ids, widths, heights = _image_columns([ann.dataset.get("images", [])])
+        per_img = Counter(a["image_id"] for a in ann.anns.values())
+    return {
+        "ids": ids,
+        "widths": widths,
+        "heights": heights,
+        "annotations": np.array([per_img[i] for i in ids.tolist()], dtype=np.int64),
+    }
+
+
+def _image_columns(chunks):
+    # Ids, widths and heights of the images, gathered into arrays chunk by chunk
+    # so the image records themselves are never held at once
+    ids, widths, heights = [], [], []
+    for chunk in chunks:
+        if chunk:
+            ids.append(np.array([i["id"] for i in chunk]))
+            widths.append(np.array([i.get("width", -1) for i in chunk]))
+            heights.append(np.array([i.get("height", -1) for i in chunk]))
+    if not ids:
+        return np.array([]), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(ids), np.concatenate(widths), np.concatenate(heights)
+
+
+def _geometry_columns(ann):
+    """
+    Image sizes, and the annotation columns the geometry is computed from.
+
+    Returns:
+        tuple:
+        - widths (np.ndarray): Width of every image
+        - heights (np.ndarray): Height of every image
+        - chunks (iterable): Bounding boxes, polygon vertex counts and image rows of
+          the annotations, chunk by chunk for streamed datasets so they are never
+          held at once
+    """
+    table = get_table(ann)
+    if table is not None:
+        chunks = [(table.bboxes, table.nverts, table.ann_img_rows())]
+        return table.img_widths, table.img_heights, chunks
+
+    if isinstance(ann, AnnStream):
+        ids, widths, heights = _image_columns(ann.images())
+        chunks = ann.annotations()
+    else:
+        ids, widths, heights = _image_columns([ann.dataset.get("images", [])])
+        chunks = [ann.dataset.get("annotations", [])]
+    # The last image with a given id wins, like in a COCO index
+    img_row = {i: row for row, i in enumerate(ids.tolist())}
+    chunks = (_annotation_columns(chunk, img_row) for chunk in chunks)
+    return widths, heights, chunks
+
+
+def _annotation_columns(anns, img_row):
+    bboxes = [a.get("bbox", (np.nan,) * 4) for a in anns]
+    return (
+        np.array(bboxes, dtype=float).reshape(len(bboxes), 4),
+        np.array([polygon_vertices(a.get("segmentation")) for a in anns], dtype=np.int64),
+        np.array([img_row.get(a["image_id"], -1) for a in anns], dtype=np.int64),
+    )
+
+
+def _histogram(counts, edges):
+    _, labels = check_bins(edges)
+    return dict(zip(labels + ["ignored"], counts.tolist()))
+
+
+def _bin_counts(values, edges):
+    edges = np.asarray(edges, dtype=float)
+    return np.bincount(bin_index(values, edges), minlength=len(edges))
+
+
+def geometry_stats(ann):
+    """
+    Per image and geometry distributions, computed in one vectorised pass.
+
+    The annotation and image columns of the dataset are read straight from
+    the table of table backed datasets, and every distribution is computed
+    from them with array operations. Streamed datasets are binned one chunk
+    of annotations at a time, so only the image columns are held at once.
+
+    Histograms have half-open `[min, max)` bins and an "ignored" bin for
+    values outside all of them. For vertex counts, "ignored" holds the
+    annotations without a polygon segmentation (e.g. RLE masks).
+
+    Args:
+        ann (COCO or AnnStream): Annotations
+
+    Returns:
+        dict: "per_image" distributions: number of images per number of
+            "annotations", number of "empty" images and number of images per
+            "resolution" ("<width>x<height>", most frequent first). "geometry"
+            histograms of the bounding box "aspect" ratio (width / height),
+            "relative_size" (square root of the box area over the image area)
+            and polygon "vertices".
+    """
+    widths, heights, chunks = _geometry_columns(ann)
+    widths, heights = np.asarray(widths, dtype=float), np.asarray(heights, dtype=float)
+    img_area = widths * heights
+    img_area[img_area <= 0] = np.nan
+
+    n_anns = np.zeros(len(widths), dtype=np.int64)
+    aspect = np.zeros(len(ASPECT_EDGES), dtype=np.int64)
+    relative_size = np.zeros(len(RELATIVE_SIZE_EDGES), dtype=np.int64)
+    vertices = np.zeros(len(VERTEX_EDGES), dtype=np.int64)
+    for bboxes, nverts, img_rows in chunks:
+        has_img = img_rows >= 0
+        n_anns += np.bincount(img_rows[has_img], minlength=len(widths))
+
+        w, h = bboxes[:, 2], bboxes[:, 3]
+        area = np.full(len(w), np.nan)
+        area[has_img] = img_area[img_rows[has_img]]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            aspect += _bin_counts(w / h, ASPECT_EDGES)
+            relative_size += _bin_counts(np.sqrt(w * h / area), RELATIVE_SIZE_EDGES)
+        vertices += _bin_counts(nverts, VERTEX_EDGES)
+
+    n, n_imgs = np.unique(n_anns, return_counts=True)
+    sizes, n_sizes = np.unique(np.stack([widths, heights], axis=1), axis=0, return_counts=True)
+    order = np.argsort(-n_sizes, kind="stable")
+
+    return {
+        "per_image": {
+            "annotations": dict(zip(n.tolist(), n_imgs.tolist())),
+            "empty": int(np.count_nonzero(n_anns == 0)),
+            "resolution": {"{:g}x{:g}".format(*sizes[i].tolist()): int(n_sizes[i]) for i in order},
+        },
+        "geometry": {
+            "aspect": _histogram(aspect, ASPECT_EDGES),
+            "relative_size": _histogram(relative_size, RELATIVE_SIZE_EDGES),
+            "vertices": _histogram(vertices, VERTEX_EDGES),
+        },
+    }
+
+
+def dataset_sketch(ann, **kwargs):
+    """
+    Mergeable statistics sketch of a dataset.
+
+    The dataset is added chunk by chunk, so streamed datasets are never held
+    in memory. Sketches of shards of a dataset, built separately (or on other
+    machines, see `StatsSketch.to_dict`), combine with `StatsSketch.merge`
+    into the statistics of the whole dataset.
+
+    Args:
+        ann (COCO or AnnStream): Annotations
+        **kwargs: Bins and accuracy of the sketch, see `utils.StatsSketch`
+
+    Returns:
+        StatsSketch: Sketch of the dataset
+    """
+    sketch = StatsSketch(**kwargs)
+    table = get_table(ann)
+    if table is not None:
+        sketch.update_categories(table.categories)
+        sketch.update_images(table.img_ids)
+        sketch.update_columns(table.category_ids, table.areas, table.bboxes, table.image_ids)
+    elif isinstance(ann, AnnStream):
+        sketch.update_categories(ann.categories)
+        for chunk in ann.images():
+            sketch.update_images([i["id"] for i in chunk])
+        for chunk in ann.annotations():
+            sketch.update(chunk)
+    else:
+        sketch.update_categories(ann.dataset.get("categories", []))
+        sketch.update_images([i["id"] for i in ann.dataset.get("images", [])])
+        sketch.update(list(ann.anns.values()))
+    return sketch
+
+
+def _describe(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {"min": None, "max": None, "mean": None, "median": None}
+    return {
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "mean": float(values.mean()),
+        "median": float(np.median(values)),
+    }
+
+
+def dataset_stats(anndict, stats=("cat", "area", "image"), areaRng=None):
+    """
+    Statistics of several datasets, without plotting anything.
+
+    Args:
+        anndict (dict): Mapping of dataset names to annotations
+        stats (list[str], optional): Statistics to compute, any of "cat" (instances per
+            category), "area" (object size split), "image" (per image statistics),
+            "per_image" and "geometry" (distributions, see `geometry_stats`).
+            Defaults to "cat", "area" and "image".
+        areaRng (list[float], optional): Side lengths bounding the object sizes of the
+            "area" split. Defaults to the COCO sizes [0, 32, 96, 1e5].
+
+    Raises:
+        AssertionError: if a statistic is not supported
+
+    Returns:
+        dict: Statistics of every dataset. "image" statistics hold the arrays returned by
+            `image_stats`.
+    """
+    unknown = [s for s in stats if s not in STATS]
+    if unknown:
+        raise AssertionError("Unsupported statistics: {}".format(unknown))
+    edges, labels = _size_bins(areaRng)
+
+    results = {}
+    for name, ann in anndict.items():
+        res = results[name] = {}
+        if "cat" in stats:
+            res["cat"] = category_counts(ann)
+        if "area" in stats:
+            res["area"] = area_histogram(ann, edges, labels)
+        if "image" in stats:
+            res["image"] = image_stats(ann)
+        if "per_image" in stats or "geometry" in stats:
+            geometry = geometry_stats(ann)
+            res.update((k, geometry[k]) for k in ("per_image", "geometry") if k in stats)
+    return results
+
+
+def _flatten(values, prefix=""):
+    # Nested histograms become "<key>.<bin>" entries
+    for key, v in values.items():
+        if isinstance(v, dict):
+            yield from _flatten(v, "{}{}.".format(prefix, key))
+        else:
+            yield prefix + str(key), v
+
+
+def _report_rows(results):
+    # (dataset, statistic, key, value) rows. Per image arrays are summarised.
+    for name, res in results.items():
+        for stat, values in res.items():
+            if stat == "image":
+                yield name, stat, "count", len(values["ids"])
+                for key in ("widths", "heights", "annotations"):
+                    for k, v in _describe(values[key]).items():
+                        yield name, stat, key + "." + k, v
+            else:
+                for key, v in _flatten(values):
+                    yield name, stat, key, v
+
+
+def write_report(results, path):
+    """
+    Write statistics (see `dataset_stats`) to a JSON or CSV report.
+
+    Per image arrays are summarised by their minimum, maximum, mean and
+    median. A CSV report has one `dataset,stat,key,value` row per value.
+
+    Args:
+        results (dict): Statistics of every dataset
+        path (str): Path of the report, ending in `.json` or `.csv`
+
+    Raises:
+        AssertionError: if the report format is not supported
+    """
+    path = str(path)
+    rows = list(_report_rows(results))
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["dataset", "stat", "key", "value"])
+            writer.writerows(rows)
+    elif path.endswith(".json"):
+        report = {}
+        for name, stat, key, value in rows:
+            report.setdefault(name, {}).setdefault(stat, {})[key] = value
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        raise AssertionError("Reports are written as .json or .csv, got {}".format(path))
+
+
 def view_area_dist(ann):
+    import matplotlib.pyplot as plt
+
     obj_areas = get_areas(ann)
     plt.plot(range(len(obj_areas)), obj_areas)
     plt.xlabel("Objects")
@@ -74,49 +534,59 @@ def view_area_dist(ann):
     plt.show()
 
 
+def _size_bins(areaRng):
+    # Side length boundaries of the size classes, e.g. [0, 32, 96, 1e5]
+    if areaRng is None:
+        areaRng = _COCO_SIZES
+    if list(areaRng) != sorted(areaRng):
+        raise AssertionError("Area ranges incorrectly provided")
+    edges = [r**2 for r in areaRng]
+    labels = _SIZE_LABELS if len(edges) == 4 else bin_labels(edges)
+    return edges, labels
+
+
 def get_object_size_split(ann, areaRng):
+    """
+    Number of small, medium and large objects.
 
-    obj_areas = get_areas(ann)
+    Args:
+        ann (COCO or AnnStream): Annotations
+        areaRng (list[float]): Side lengths bounding the small, medium and large objects,
+            whose areas are their squares
 
-    if areaRng != sorted(areaRng):
-        raise AssertionError("Area ranges incorrectly provided")
+    Raises:
+        AssertionError: if the ranges are not increasing
 
-    small = len(ann.getAnnIds(areaRng=[(areaRng[0] ** 2), areaRng[1] ** 2 - 1]))
-    medium = len(ann.getAnnIds(areaRng=[(areaRng[1] ** 2), areaRng[2] ** 2 - 1]))
-    large = len(ann.getAnnIds(areaRng=[(areaRng[2] ** 2), areaRng[3] ** 2 - 1]))
-    left_out = len(ann.getAnnIds(areaRng=[0**2, (areaRng[0] ** 2)])) + len(
-        ann.getAnnIds(areaRng=[areaRng[3] ** 2, (1e5**2)])
-    )
+    Returns:
+        tuple: Number of small, medium, large and ignored objects
+    """
+    edges, _ = _size_bins(areaRng)
+    split = area_histogram(ann, edges, _SIZE_LABELS)
+    small, medium, large, left_out = split.values()
 
     logging.debug("Number of small objects in set = %s", small)
     logging.debug("Number of medium objects in set = %s", medium)
     logging.debug("Number of large objects in set = %s", large)
     if left_out != 0:
         logging.debug("Number of objects ignored in set = %s", left_out)
-
-    logging.debug("Number of objects = %s", len(obj_areas))
-
-    if len(obj_areas) != small + medium + large + left_out:
-        raise AssertionError("Sum of objects in different area ranges != Total number of objects")
+    logging.debug("Number of objects = %s", sum(split.values()))
     return small, medium, large, left_out
 
 
-def pi_area_split_single(ann, areaRng):
+def _pie(ax, split):
+    # Ignored objects are only shown if there are any
+    split = {k: v for k, v in split.items() if k != "ignored" or v != 0}
+    labels = [k.capitalize() for k in split]
+    colors = [_PIE_COLORS[i % len(_PIE_COLORS)] for i in range(len(split))]
+    ax.pie(list(split.values()), labels=labels, colors=colors, autopct="%1.2f%%", startangle=90)
 
-    # Pie chart
-    small, medium, large, left_out = get_object_size_split(ann, areaRng)
 
-    if left_out != 0:
-        sizes = [small, large, left_out, medium]
-        labels = "Small", "Large", "Ignored", "Medium"
-        colors = ["#ff9999", "#66b3ff", "#99ff99", "#ffcc99"]
-    else:
-        sizes = [small, large, medium]
-        labels = "Small", "Large", "Medium"
-        colors = ["#ff9999", "#66b3ff", "#ffcc99"]
+def pi_area_split_single(ann, areaRng):
+    import matplotlib.pyplot as plt
 
+    edges, labels = _size_bins(areaRng)
     _, ax1 = plt.subplots()
-    ax1.pie(sizes, colors=colors, labels=labels, autopct="%1.2f%%", startangle=90)
+    _pie(ax1, area_histogram(ann, edges, labels))
     # draw circle
     centre_circle = plt.Circle((0, 0), 0.70, fc="white")
     fig = plt.gcf()
@@ -128,56 +598,58 @@ def pi_area_split_single(ann, areaRng):
     plt.show()
 
 
-def pi_area_split(anndict, areaRng, save=False):
-
-    stuff = []
+def pi_area_split(anndict, areaRng, save=False, headless=False, splits=None):
+    if splits is None:
+        edges, labels = _size_bins(areaRng)
+        splits = area_histograms(anndict, edges, labels)
 
-    anns = anndict.values()
-    names = anndict.keys()
-
-    for ann in anns:
-        small, medium, large, left_out = get_object_size_split(ann, areaRng)
-
-        if left_out != 0:
-            sizes = [small, large, left_out, medium]
-            labels = "Small", "Large", "Ignored", "Medium"
-            colors = ["#ff9999", "#66b3ff", "#99ff99", "#ffcc99"]
-        else:
-            sizes = [small, large, medium]
-            labels = "Small", "Large", "Medium"
-            colors = ["#ff9999", "#66b3ff", "#ffcc99"]
-
-        stuff.append([sizes, labels, colors])
-
-    fig, axs = plt.subplots(1, len(anns), figsize=(11, 11))
-
-    for s, name, ax in zip(stuff, names, axs.flat):
-        ax.clear()
-        ax.pie(s[0], labels=s[1], colors=s[2], autopct="%1.2f%%", startangle=90)
-        # draw circle
-        # centre_circle = plt.Circle((0, 0), 0.70, fc='white')
-        # fig = plt.gcf()
-        # fig.gca().add_artist(centre_circle)
-        # Equal aspect ratio ensures that pie is drawn as a circle
-        # ax.axis('equal')
-        # from matplotlib import rcParams
-        # rcParams['axes.titlepad'] = 100
+    fig, axs = _subplots(headless, 1, len(splits), figsize=(11, 11), squeeze=False)
+    for (name, split), ax in zip(splits.items(), axs.flat):
+        _pie(ax, split)
         ax.set_title(name)
-
-    # plt.title('Object Size Distribution', pad=20)
     fig.suptitle("Object Size Distribution", fontsize=14, fontweight="bold")
-    # plt.tight_layout()
-
-    # fig = plt.gcf()
-    # fig.set_size_inches(11,11)
 
-    out_dir = os.path.join(os.getcwd(), "results", "plots")
+    if save is True:
+        fig.savefig(os.path.join(_plot_dir(), "area_dist" + ".png"), dpi=fig.dpi)
+
+    _show(headless)
+
+
+def geometry_plot(anndict, stat, save=False, headless=False, results=None):
+    """
+    Bar charts of the "per_image" or "geometry" distributions of every dataset.
+
+    Args:
+        anndict (dict): Mapping of dataset names to annotations
+        stat (str): "per_image" or "geometry"
+        save (bool, optional): Save the plot to disk if True. Defaults to False.
+        headless (bool, optional): Only draw the plot to save it, without showing it.
+            Defaults to False.
+        results (dict, optional): Distributions of every dataset, if already computed.
+            Defaults to None.
+    """
+    if results is None:
+        results = {name: geometry_stats(ann)[stat] for name, ann in anndict.items()}
+    # Only histograms are drawn, e.g. not the number of empty images
+    keys = [k for k, v in next(iter(results.values())).items() if isinstance(v, dict)]
+    fig, axs = _subplots(headless, len(results), len(keys), figsize=(11, 11), squeeze=False)
+    for row, (name, res) in zip(axs, results.items()):
+        for ax, key in zip(row, keys):
+            hist = res[key]
+            ax.bar([str(k) for k in hist], list(hist.values()), color=_PIE_COLORS[2])
+            ax.set_title("{} {}".format(name, key.replace("_", " ")))
+            ax.tick_params(axis="x", labelrotation=90)
+    fig.suptitle(
+        "Per image statistics" if stat == "per_image" else "Object geometry",
+        fontsize=14,
+        fontweight="bold",
+    )
+    fig.tight_layout()
 
     if save is True:
-        if os.path.exists(out_dir) is False:
-            os.mkdir(out_dir)
-        plt.savefig(os.path.join(out_dir, "area_dist" + ".png"), dpi=fig.dpi)
-    plt.show()
+        fig.savefig(os.path.join(_plot_dir(), stat + "_dist" + ".png"), dpi=fig.dpi)
+
+    _show(headless)
 
 
 if __name__ == "__main__":
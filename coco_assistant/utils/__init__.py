@@ -1,4 +1,22 @@
-from .anchors import generate_anchors
+from .anchors import cluster_anchors, evaluate_anchors, generate_anchors
+from .cache import DEFAULT_CACHE_DIR, cached_table, load_cached_table
 from .det2seg import det2seg
+from .loader import LazyAnnDict, load_coco, load_table, load_tables
+from .merger import (
+    COCOSource,
+    DatasetPlan,
+    MergePlan,
+    changed_sources,
+    load_manifest,
+    merge_files,
+    merge_sources,
+)
 from .misc import *
+from .query import AnnQuery, Selection
 from .remapper import CatRemapper
+from .remover import remove_categories
+from .results import DEFAULT_RESULT_CACHE_DIR, ResultCache
+from .shards import MaskShards, MaskShardWriter
+from .sketch import QuantileSketch, StatsSketch
+from .stream import AnnStream, JsonWriter
+from .table import AnnTable, GroupIndex, TableCOCO, get_table
@@ -6,35 +6,85 @@ Link: https://github.com/experiencor/keras-yolo2/blob/master/gen_anchors.py
 In progress
 """
 
-import random
+import logging
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 from pycocotools.coco import COCO
 
-
-def iou(ann, centroids):
-    w, h = ann
-    similarities = []
-
-    for centroid in centroids:
-        c_w, c_h = centroid
-
-        if c_w >= w and c_h >= h:
-            similarity = w * h / (c_w * c_h)
-        elif c_w >= w and c_h <= h:
-            similarity = w * c_h / (w * h + (c_w - w) * c_h)
-        elif c_w <= w and c_h >= h:
-            similarity = c_w * h / (w * h + c_w * (c_h - h))
-        else:  # means both w,h are bigger than c_w and c_h respectively
-            similarity = (c_w * c_h) / (w * h)
-        similarities.append(similarity)  # will become (k,) shape
-
-    return np.array(similarities)
-
-
-def avg_iou(anns, centroids):
-    n, _ = anns.shape
-    s = sum(max(iou(anns[i], centroids)) for i in range(anns.shape[0]))
+from .sketch import AREA_EDGES, AREA_LABELS, QuantileSketch, bin_index, bin_labels, check_bins
+from .stream import AnnStream
+from .table import get_table
+
+KMEANS_CHUNK = 1 << 16
+MINIBATCH_ITER = 100
+# Boxes go to the pyramid level whose anchor size (32 on P3 up to 512 on P7)
+# is closest on a log scale
+FPN_SCALE_EDGES = (0,) + tuple(32 * 2 ** (i + 0.5) for i in range(4)) + (np.inf,)
+FPN_LEVELS = ("P3", "P4", "P5", "P6", "P7")
+IOU_THRESHOLDS = (0.5, 0.6, 0.7, 0.75, 0.8, 0.9)
+IOU_EDGES = tuple(np.round(np.linspace(0, 1, 11), 1))
+
+
+def iou(anns, centroids):
+    """
+    IoU of boxes and centroids that share their top left corner.
+
+    Args:
+        anns (np.ndarray): (N, 2) widths and heights of the boxes, or a single (2,) box
+        centroids (np.ndarray): (k, 2) widths and heights of the centroids
+
+    Returns:
+        np.ndarray: (N, k) IoU of every box with every centroid, or (k,) for a single box
+    """
+    anns = np.asarray(anns, dtype=float)
+    centroids = np.asarray(centroids, dtype=float)
+    w, h = anns[..., 0, None], anns[..., 1, None]
+    c_w, c_h = centroids[:, 0], centroids[:, 1]
+
+    wider, taller = c_w >= w, c_h >= h
+    # The union is spelled out per case, as it was for a single box, so that
+    # results are identical down to the last bit.
+    union = np.select(
+        [wider & taller, wider & (c_h <= h), ~wider & taller],
+        [c_w * c_h, w * h + (c_w - w) * c_h, w * h + c_w * (c_h - h)],
+        w * h,
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.minimum(w, c_w) * np.minimum(h, c_h) / union
+
+
+def _chunks(n, chunk):
+    return (slice(i, min(i + chunk, n)) for i in range(0, n, chunk))
+
+
+def _assign(ann_dims, centroids, chunk=KMEANS_CHUNK):
+    # Nearest centroid (by IoU distance) of every box and that distance,
+    # computed chunk by chunk to bound the size of the distance matrix
+    n = ann_dims.shape[0]
+    assignments = np.empty(n, dtype=np.int64)
+    distances = np.empty(n)
+    for s in _chunks(n, chunk):
+        d = 1 - iou(ann_dims[s], centroids)
+        assignments[s] = np.argmin(d, axis=1)
+        distances[s] = d[np.arange(len(d)), assignments[s]]
+    return assignments, distances
+
+
+def avg_iou(anns, centroids, chunk=KMEANS_CHUNK):
+    """
+    Mean IoU of every box with its best matching centroid.
+
+    Args:
+        anns (np.ndarray): (N, 2) widths and heights of the boxes
+        centroids (np.ndarray): (k, 2) widths and heights of the centroids
+        chunk (int, optional): Number of boxes compared at once. Defaults to 65536.
+
+    Returns:
+        float: Mean IoU
+    """
+    n = anns.shape[0]
+    s = sum(iou(anns[c], centroids).max(axis=1).sum() for c in _chunks(n, chunk))
 
     return s / n
 
@@ -50,50 +100,174 @@ def print_anchors(centroids):
         r += "%0.2f,%0.2f, " % (anchors[i, 0], anchors[i, 1])
 
     # there should not be comma after last anchor, that's why
-    r += "%0.2f,%0.2f" % (anchors[sorted_indices[-1:], 0], anchors[sorted_indices[-1:], 1])
+    r += "%0.2f,%0.2f" % (anchors[sorted_indices[-1], 0], anchors[sorted_indices[-1], 1])
     r += "]"
     print(r)
     print("")
 
 
-def run_kmeans(ann_dims, anchor_num):
+def kmeans_pp(ann_dims, anchor_num, rng, chunk=KMEANS_CHUNK):
+    """
+    Pick initial centroids with k-means++, using 1 - IoU as the distance.
+
+    Every next centroid is a box drawn with a probability proportional to the
+    squared distance to its nearest centroid picked so far.
+
+    Args:
+        ann_dims (np.ndarray): (N, 2) widths and heights of the boxes
+        anchor_num (int): Number of centroids
+        rng (np.random.Generator): Random number generator
+        chunk (int, optional): Number of boxes compared at once. Defaults to 65536.
+
+    Returns:
+        np.ndarray: (anchor_num, 2) centroids
+    """
+    n = ann_dims.shape[0]
+    indices = [rng.integers(n)]
+    nearest = np.full(n, np.inf)
+    for _ in range(1, anchor_num):
+        centroid = ann_dims[indices[-1:]]
+        for s in _chunks(n, chunk):
+            d = 1 - iou(ann_dims[s], centroid)[:, 0]
+            nearest[s] = np.fmin(nearest[s], d)
+        weights = np.nan_to_num(nearest) ** 2
+        total = weights.sum()
+        # Every box coincides with a centroid already, any of them will do
+        p = weights / total if total > 0 else None
+        indices.append(rng.choice(n, p=p))
+    return ann_dims[indices].astype(float)
+
+
+def _shift(old, new):
+    # Largest IoU distance a centroid moved by
+    with np.errstate(invalid="ignore"):
+        d = 1 - np.diagonal(iou(old, new))
+    return np.nanmax(np.where((old == new).all(axis=1), 0, d))
+
+
+def _init_centroids(ann_dims, anchor_num, init, rng, chunk):
+    if init is None or (isinstance(init, str) and init == "random"):
+        return ann_dims[rng.integers(ann_dims.shape[0], size=anchor_num)].astype(float)
+    if isinstance(init, str) and init == "kmeans++":
+        return kmeans_pp(ann_dims, anchor_num, rng, chunk)
+    if isinstance(init, str):
+        raise AssertionError("Unknown initialisation {}".format(init))
+    return np.array(init, dtype=float)
+
+
+def run_kmeans(
+    ann_dims,
+    anchor_num,
+    init=None,
+    chunk=KMEANS_CHUNK,
+    seed=None,
+    max_iter=None,
+    tol=0,
+    batch_size=None,
+    verbose=True,
+):
+    """
+    Cluster box dimensions with k-means, using 1 - IoU as the distance.
+
+    By default every iteration assigns all boxes, until no assignment changes.
+    With a `batch_size`, every iteration only assigns a random batch of boxes
+    and moves the centroids towards the mean of their boxes in the batch, at a
+    rate decreasing with the number of boxes a centroid has seen (mini-batch
+    k-means). This converges in a fixed number of cheap iterations regardless
+    of the number of boxes.
+
+    Args:
+        ann_dims (np.ndarray): (N, 2) widths and heights of the boxes
+        anchor_num (int): Number of clusters
+        init (str or np.ndarray, optional): Initialisation, either "random" (random boxes),
+            "kmeans++" or (anchor_num, 2) initial centroids. Defaults to None ("random").
+        chunk (int, optional): Number of boxes compared at once. Defaults to 65536.
+        seed (int, optional): Seed of the random number generator, for reproducible
+            centroids. Defaults to None.
+        max_iter (int, optional): Maximum number of iterations. Defaults to None (no limit),
+            or 100 in mini-batch mode.
+        tol (float, optional): Stop once no centroid moves by more than this IoU distance
+            in an iteration. Defaults to 0.
+        batch_size (int, optional): Number of boxes per iteration in mini-batch mode.
+            Defaults to None (all boxes every iteration).
+        verbose (bool, optional): Print the progress of every iteration. Defaults to True.
+
+    Raises:
+        AssertionError: if the initialisation is unknown
+
+    Returns:
+        np.ndarray: (anchor_num, 2) centroids
+    """
+    rng = np.random.default_rng(seed)
     ann_num = ann_dims.shape[0]
-    prev_assignments = np.ones(ann_num) * (-1)
-    iteration = 0
-    old_distances = np.zeros((ann_num, anchor_num))
+    if batch_size is not None and batch_size < ann_num:
+        if max_iter is None:
+            max_iter = MINIBATCH_ITER
+        # Seed on a sample as well, a few batches worth of boxes represent the set well enough
+        sample = ann_dims[rng.integers(ann_num, size=min(ann_num, 3 * batch_size))]
+        centroids = _init_centroids(sample, anchor_num, init, rng, chunk)
+        return _minibatch_kmeans(
+            ann_dims, centroids, rng, batch_size, max_iter, tol, chunk, verbose
+        )
 
-    r = random.SystemRandom()
-    indices = [r.randrange(ann_dims.shape[0]) for i in range(anchor_num)]
-    centroids = ann_dims[indices]
-    anchor_dim = ann_dims.shape[1]
+    prev_assignments = np.full(ann_num, -1)
+    iteration = 0
+    centroids = _init_centroids(ann_dims, anchor_num, init, rng, chunk)
 
     while True:
-        distances = []
         iteration += 1
-        for i in range(ann_num):
-            d = 1 - iou(ann_dims[i], centroids)
-            distances.append(d)
-        distances = np.array(distances)  # distances.shape = (ann_num, anchor_num)
-
-        print(
-            "iteration {}: dists = {}".format(iteration, np.sum(np.abs(old_distances - distances)))
-        )
-
         # assign samples to centroids
-        assignments = np.argmin(distances, axis=1)
+        assignments, distances = _assign(ann_dims, centroids, chunk)
+
+        if verbose:
+            print(
+                "iteration {}: reassigned = {}, mean dist = {:.4f}".format(
+                    iteration, np.count_nonzero(assignments != prev_assignments), distances.mean()
+                )
+            )
 
         if (assignments == prev_assignments).all():
             return centroids
 
         # calculate new centroids
-        centroid_sums = np.zeros((anchor_num, anchor_dim), np.float)
-        for i in range(ann_num):
-            centroid_sums[assignments[i]] += ann_dims[i]
-        for j in range(anchor_num):
-            centroids[j] = centroid_sums[j] / (np.sum(assignments == j) + 1e-6)
+        old = centroids.copy()
+        counts = np.bincount(assignments, minlength=anchor_num) + 1e-6
+        for d in range(ann_dims.shape[1]):
+            sums = np.bincount(assignments, weights=ann_dims[:, d], minlength=anchor_num)
+            centroids[:, d] = sums / counts
 
-        prev_assignments = assignments.copy()
-        old_distances = distances.copy()
+        if (tol > 0 and _shift(old, centroids) <= tol) or iteration == max_iter:
+            return centroids
+        prev_assignments = assignments
+
+
+def _minibatch_kmeans(ann_dims, centroids, rng, batch_size, max_iter, tol, chunk, verbose):
+    anchor_num = len(centroids)
+    seen = np.zeros(anchor_num)
+    for iteration in range(1, max_iter + 1):
+        batch = ann_dims[rng.integers(ann_dims.shape[0], size=batch_size)]
+        assignments, distances = _assign(batch, centroids, chunk)
+
+        counts = np.bincount(assignments, minlength=anchor_num)
+        seen += counts
+        hit = counts > 0
+        # Learning rate of every centroid: its share of the boxes it has seen so far
+        rate = counts[hit] / seen[hit]
+        old = centroids.copy()
+        for d in range(ann_dims.shape[1]):
+            sums = np.bincount(assignments, weights=batch[:, d], minlength=anchor_num)
+            centroids[hit, d] += rate * (sums[hit] / counts[hit] - centroids[hit, d])
+
+        shift = _shift(old, centroids)
+        if verbose:
+            print(
+                "iteration {}: shift = {:.4f}, mean dist = {:.4f}".format(
+                    iteration, shift, distances.mean()
+                )
+            )
+        if shift <= tol:
+            break
+    return centroids
 
 
 def format_anchors(centroids):
@@ -101,21 +275,318 @@ def format_anchors(centroids):
     return sorted(new_anchors)
 
 
-def generate_anchors(cann, num_anchors, fmt="rect"):
+def box_dims(cann):
+    """
+    Widths and heights of all bounding boxes.
+
+    Args:
+        cann (COCO or AnnStream): Annotations
+
+    Returns:
+        np.ndarray: (N, 2) array of box widths and heights
+    """
+    table = get_table(cann)
+    if table is not None:
+        return np.array(table.bboxes[:, 2:], dtype=float)
+    if isinstance(cann, AnnStream):
+        chunks = [np.array([a["bbox"][-2:] for a in c], dtype=float) for c in cann.annotations()]
+        return np.concatenate(chunks).reshape(-1, 2) if chunks else np.zeros((0, 2))
     anns = cann.anns
     # dims is a list of tuples (w,h) for each bbox
     dims = [tuple(map(float, (anns[i]["bbox"][-2], anns[i]["bbox"][-1]))) for i in anns]
-    dims = np.array(dims)
-    centroids = run_kmeans(dims, num_anchors)
-
-    # write anchors to file
-    print("\naverage IOU for", num_anchors, "anchors:", "%0.2f" % avg_iou(dims, centroids))
-    if fmt == "square":
-        print("formatted anchors: {}\n".format(format_anchors(centroids)))
-        return format_anchors(centroids)
+    return np.array(dims)
+
+
+def split_scales(ann_dims, scales, levels=None):
+    """
+    Bucket boxes by scale, i.e. the square root of their area.
+
+    Args:
+        ann_dims (np.ndarray): (N, 2) widths and heights of the boxes
+        scales (list[float] or str): Increasing scale edges between the levels, or "fpn"
+            for the P3-P7 levels of a feature pyramid (`FPN_SCALE_EDGES`)
+        levels (list[str], optional): Name of every level. Defaults to the scale ranges,
+            or `FPN_LEVELS`.
+
+    Raises:
+        AssertionError: if the edges are not increasing or the names do not match them
+
+    Returns:
+        dict: (M, 2) widths and heights of the boxes of every level. Boxes outside of
+            all levels are left out.
+    """
+    if isinstance(scales, str) and scales == "fpn":
+        scales, levels = FPN_SCALE_EDGES, levels or FPN_LEVELS
+    edges, levels = check_bins(scales, levels)
+    idx = bin_index(np.sqrt(ann_dims[:, 0] * ann_dims[:, 1]), edges)
+    return {level: ann_dims[idx == i] for i, level in enumerate(levels)}
+
+
+def _kmeans_run(ann_dims, anchor_num, seed, kmeans, verbose):
+    centroids = run_kmeans(ann_dims, anchor_num, seed=seed, verbose=verbose, **kmeans)
+    return avg_iou(ann_dims, centroids), centroids
+
+
+def cluster_anchors(
+    datasets, num_anchors, restarts=1, scales=None, levels=None, workers=None, **kmeans
+):
+    """
+    Cluster the boxes of several datasets, keeping the best of several restarts.
+
+    Every dataset, and every scale level of it if `scales` are given, is
+    clustered `restarts` times with different seeds. The run with the highest
+    average IoU is kept. All runs are independent and go to a single pool of
+    worker processes, so more restarts, levels or datasets do not add up in
+    wall time as long as there are workers to spare.
+
+    Args:
+        datasets (dict): (N, 2) widths and heights of the boxes of every dataset
+        num_anchors (int): Number of anchors per dataset (and level)
+        restarts (int, optional): Number of runs per dataset (and level). Defaults to 1.
+        scales (list[float] or str, optional): Cluster boxes of every scale level
+            separately (see `split_scales`). Defaults to None.
+        levels (list[str], optional): Names of the scale levels. Defaults to None.
+        workers (int, optional): If greater than 1, runs are spread over this many
+            worker processes. Defaults to None.
+        **kmeans: Options of `run_kmeans` (init, seed, max_iter, tol, batch_size)
+
+    Returns:
+        dict: Best run of every dataset, as a dict from level (None without `scales`)
+            to an (average IoU, (num_anchors, 2) centroids) tuple
+    """
+    groups = {}
+    for name, dims in datasets.items():
+        split = {None: dims} if scales is None else split_scales(dims, scales, levels)
+        for level, level_dims in split.items():
+            if len(level_dims) == 0:
+                logging.warning("No boxes in level %s of %s, skipping it", level, name)
+                continue
+            groups[name, level] = level_dims
+
+    # Restarts draw independent streams from the seed, so the result is the
+    # same however the runs are scheduled
+    seed = kmeans.pop("seed", None)
+    seeds = [seed] if restarts == 1 else np.random.SeedSequence(seed).spawn(restarts)
+    jobs = [(key, s) for key in groups for s in seeds]
+    n = len(jobs)
+    args = (
+        [groups[key] for key, _ in jobs],
+        [num_anchors] * n,
+        [s for _, s in jobs],
+        [kmeans] * n,
+        [n == 1] * n,
+    )
+    if workers is not None and workers > 1 and n > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, n)) as ex:
+            runs = list(ex.map(_kmeans_run, *args))
+    else:
+        runs = list(map(_kmeans_run, *args))
+
+    best = {}
+    for (key, _), run in zip(jobs, runs):
+        if key not in best or run[0] > best[key][0]:
+            best[key] = run
+    results = {name: {} for name in datasets}
+    for (name, level), run in best.items():
+        results[name][level] = run
+    return results
+
+
+def report_anchors(runs, num_anchors, fmt="rect"):
+    """
+    Print and format the anchors of a dataset.
+
+    Args:
+        runs (dict): Best run of every level, as returned by `cluster_anchors` for a dataset
+        num_anchors (int): Number of anchors
+        fmt (str, optional): Anchor type i.e. "square" or "rect". Defaults to "rect".
+
+    Returns:
+        np.ndarray or list: Anchor widths and heights, or a dict of them by level
+            if the boxes were clustered by scale
+    """
+    anchors = {}
+    for level, (score, centroids) in runs.items():
+        if level is not None:
+            print("\nlevel", level)
+        print("\naverage IOU for", num_anchors, "anchors:", "%0.2f" % score)
+        if fmt == "square":
+            print("formatted anchors: {}\n".format(format_anchors(centroids)))
+            anchors[level] = format_anchors(centroids)
+        else:
+            print_anchors(centroids.round(0))
+            anchors[level] = centroids
+    if list(anchors) == [None]:
+        return anchors[None]
+    return anchors
+
+
+def generate_anchors(
+    cann, num_anchors, fmt="rect", restarts=1, scales=None, levels=None, workers=None, **kmeans
+):
+    """
+    Anchors of a dataset, clustered from the dimensions of its bounding boxes.
+
+    Args:
+        cann (COCO or AnnStream): Annotations
+        num_anchors (int): Number of anchors (per level)
+        fmt (str, optional): Anchor type i.e. "square" or "rect". Defaults to "rect".
+        restarts (int, optional): Number of clustering runs, the best one is kept. Defaults to 1.
+        scales (list[float] or str, optional): Cluster boxes of every scale level separately
+            (see `split_scales`). Defaults to None.
+        levels (list[str], optional): Names of the scale levels. Defaults to None.
+        workers (int, optional): Number of worker processes for the runs. Defaults to None.
+        **kmeans: Options of `run_kmeans` (init, seed, max_iter, tol, batch_size)
+
+    Returns:
+        np.ndarray or list: Anchor widths and heights, or a dict of them by level
+            if `scales` are given
+    """
+    runs = cluster_anchors(
+        {None: box_dims(cann)}, num_anchors, restarts, scales, levels, workers, **kmeans
+    )
+    return report_anchors(runs[None], num_anchors, fmt)
+
+
+def best_iou(ann_dims, anchors, chunk=KMEANS_CHUNK):
+    """
+    IoU of every box with its best matching anchor.
+
+    Args:
+        ann_dims (np.ndarray): (N, 2) widths and heights of the boxes
+        anchors (np.ndarray): (k, 2) widths and heights of the anchors
+        chunk (int, optional): Number of boxes compared at once. Defaults to 65536.
+
+    Returns:
+        np.ndarray: (N,) best IoU of every box, 0 for degenerate boxes
+    """
+    best = np.empty(ann_dims.shape[0])
+    for s in _chunks(ann_dims.shape[0], chunk):
+        best[s] = np.nan_to_num(iou(ann_dims[s], anchors)).max(axis=1)
+    return best
+
+
+def _eval_columns(cann):
+    # Box dimensions, category ids and areas in chunks, so streamed annotations are never
+    # held at once
+    table = get_table(cann)
+    if table is not None:
+        yield np.array(table.bboxes[:, 2:], dtype=float), table.category_ids, table.areas
+        return
+    chunks = cann.annotations() if isinstance(cann, AnnStream) else [cann.anns.values()]
+    for chunk in chunks:
+        anns = list(chunk)
+        dims = np.array([a["bbox"][-2:] for a in anns], dtype=float).reshape(-1, 2)
+        cat_ids = np.array([a.get("category_id", -1) for a in anns])
+        areas = np.array([a.get("area", np.nan) for a in anns], dtype=float)
+        yield dims, cat_ids, areas
+
+
+def _group_sums(groups, keys, best, thresholds):
+    # Adds the number of boxes, the sum of their best IoU and the number of boxes
+    # recalled at every threshold to the entry of every key
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+    n = len(uniq)
+    rows = [np.bincount(inverse, minlength=n), np.bincount(inverse, weights=best, minlength=n)]
+    rows += [np.bincount(inverse, weights=best >= t, minlength=n) for t in thresholds]
+    for key, row in zip(uniq.tolist(), np.stack(rows, axis=1)):
+        groups[key] = groups.get(key, 0) + row
+
+
+def _summary(row, thresholds):
+    n = int(row[0])
+    return {
+        "boxes": n,
+        "mean_iou": row[1] / n if n else 0.0,
+        "recall": {"{:g}".format(t): h / n if n else 0.0 for t, h in zip(thresholds, row[2:])},
+    }
+
+
+def evaluate_anchors(
+    cann,
+    anchors,
+    thresholds=IOU_THRESHOLDS,
+    area_edges=AREA_EDGES,
+    area_labels=AREA_LABELS,
+    quantiles=(0.05, 0.25, 0.5, 0.75, 0.95),
+    chunk=KMEANS_CHUNK,
+):
+    """
+    How well an anchor set covers the boxes of a dataset.
+
+    Every box is matched to the anchor it has the highest IoU with, both
+    aligned at the same corner (as in `avg_iou`). A box is recalled at a
+    threshold if that IoU reaches it. Boxes are compared in chunks of
+    `chunk` against all anchors at once.
+
+    Args:
+        cann (COCO or AnnStream): Annotations
+        anchors (np.ndarray, list or dict): (k, 2) anchor widths and heights, or such
+            anchors per level (as returned by `generate_anchors` with scales), which are
+            evaluated as one set
+        thresholds (list[float], optional): IoU thresholds of the recall.
+            Defaults to (0.5, 0.6, 0.7, 0.75, 0.8, 0.9).
+        area_edges (list[float], optional): Edges of the object size buckets.
+            Defaults to the COCO object sizes.
+        area_labels (list[str], optional): Names of the object size buckets.
+            Defaults to ("small", "medium", "large").
+        quantiles (list[float], optional): Quantiles of the best IoU.
+            Defaults to (0.05, 0.25, 0.5, 0.75, 0.95).
+        chunk (int, optional): Number of boxes compared at once. Defaults to 65536.
+
+    Raises:
+        AssertionError: if the size bucket edges are not increasing or the labels do
+            not match them
+
+    Returns:
+        dict: "iou" (number of boxes, mean, quantiles and histogram of the best IoU),
+            "recall" at every threshold, and the number of boxes, mean best IoU and recall
+            of every object size bucket ("by_size", with an "ignored" bucket for boxes
+            without a valid area) and category ("by_category")
+    """
+    if isinstance(anchors, dict):
+        anchors = np.concatenate([np.asarray(a, dtype=float) for a in anchors.values()])
+    anchors = np.asarray(anchors, dtype=float).reshape(-1, 2)
+    edges, labels = check_bins(area_edges, area_labels)
+    thresholds = list(thresholds)
+
+    total, sizes, cats = {}, {}, {}
+    sketch = QuantileSketch(alpha=0.001)
+    hist = np.zeros(len(IOU_EDGES) - 1, dtype=np.int64)
+    for dims, cat_ids, areas in _eval_columns(cann):
+        best = best_iou(dims, anchors, chunk)
+        _group_sums(total, np.zeros(len(best), dtype=np.int64), best, thresholds)
+        _group_sums(sizes, bin_index(areas, edges), best, thresholds)
+        _group_sums(cats, cat_ids, best, thresholds)
+        sketch.update(best)
+        # A perfect match goes to the last bin
+        hist += np.bincount(np.minimum(best * 10, 9).astype(np.int64), minlength=len(hist))
+
+    overall = _summary(total.get(0, np.zeros(len(thresholds) + 2)), thresholds)
+    keys = labels + ["ignored"]
+    if isinstance(cann, AnnStream):
+        cat_list = cann.categories
     else:
-        print_anchors(centroids.round(0))
-        return centroids
+        cat_list = cann.loadCats(cann.getCatIds())
+    names = {c["id"]: c["name"] for c in cat_list}
+    return {
+        "iou": {
+            "boxes": overall["boxes"],
+            "mean": overall["mean_iou"],
+            "quantiles": {q: sketch.quantile(q) if len(sketch) else 0.0 for q in quantiles},
+            "histogram": dict(zip(bin_labels(IOU_EDGES), hist.tolist())),
+        },
+        "recall": overall["recall"],
+        "by_size": {
+            key: _summary(sizes.get(i, np.zeros(len(thresholds) + 2)), thresholds)
+            for i, key in enumerate(keys)
+        },
+        "by_category": {
+            names.get(k, str(k)): _summary(row, thresholds)
+            for k, row in sorted(cats.items(), key=lambda kv: -kv[1][0])
+        },
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,182 @@
+"""
+Binary sidecar cache of parsed annotation files.
+
+Every annotation file gets its own cache directory holding the arrays of its
+AnnTable as `.npy` files, which are memory-mapped when loaded, and a
+`meta.json` holding the remaining sections along with the key of the cache.
+
+The key consists of the size, modification time and content hash of the
+annotation file. A cache is used as is if size and modification time match.
+If only the modification time differs, the file is hashed and the cache is
+reused (and its key refreshed) when the content turns out to be unchanged.
+Anything else invalidates the cache, which is then rebuilt from the json.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from .table import AnnTable
+
+CACHE_VERSION = 2
+DEFAULT_CACHE_DIR = ".coco_cache"
+
+
+def file_hash(path=None, data=None):
+    """
+    Content hash of an annotation file.
+
+    Args:
+        path (str, optional): File to hash, read in chunks.
+        data (bytes, optional): File content, if it has already been read.
+
+    Returns:
+        str: Hex digest of the content
+    """
+    h = hashlib.blake2b(digest_size=20)
+    if data is not None:
+        h.update(data)
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_path(path, cache_root=None):
+    """
+    Location of the cache of an annotation file.
+
+    The cache directory is named after the annotation file and a hash of its
+    resolved path, so annotation files of the same name in different
+    directories can share `cache_root`.
+
+    Args:
+        path (str): Annotation file
+        cache_root (str, optional): Directory holding the caches. Defaults to
+            a `.coco_cache` directory next to the annotation file.
+
+    Returns:
+        Path: Cache directory of the annotation file
+    """
+    path = Path(path)
+    root = Path(cache_root) if cache_root is not None else path.parent / DEFAULT_CACHE_DIR
+    digest = hashlib.blake2b(str(path.resolve()).encode(), digest_size=8).hexdigest()
+    return root / "{}-{}".format(path.name, digest)
+
+
+def save_table(table, cpath, key):
+    """
+    Write a table to a cache directory, replacing any previous cache.
+
+    Args:
+        table (AnnTable): Table to store
+        cpath (Path): Cache directory
+        key (dict): Size, mtime and hash of the annotation file the table was built from
+    """
+    tmp = cpath.with_name("{}.tmp{}".format(cpath.name, os.getpid()))
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir(parents=True)
+
+    for name in AnnTable.ARRAYS:
+        np.save(tmp / (name + ".npy"), getattr(table, name))
+    meta = dict(key, version=CACHE_VERSION, keys=table.keys, meta=table.meta)
+    with open(tmp / "meta.json", "w") as f:
+        json.dump(meta, f)
+
+    if cpath.exists():
+        shutil.rmtree(cpath)
+    tmp.rename(cpath)
+
+
+def load_cached_table(path, cache_root=None):
+    """
+    Memory-map the cached table of an annotation file, if it is still valid.
+
+    Args:
+        path (str): Annotation file
+        cache_root (str, optional): Directory holding the caches. See `cache_path`.
+
+    Returns:
+        AnnTable: Memory-mapped table, or None if there is no valid cache
+    """
+    path = Path(path)
+    cpath = cache_path(path, cache_root)
+    try:
+        with open(cpath / "meta.json") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    st = path.stat()
+    if meta.get("version") != CACHE_VERSION or meta["size"] != st.st_size:
+        logging.info("Cache of %s is stale", path)
+        return None
+    if meta["mtime_ns"] != st.st_mtime_ns:
+        if meta["hash"] != file_hash(path):
+            logging.info("Cache of %s is stale", path)
+            return None
+        # Touched but unchanged, refresh the key
+        meta["mtime_ns"] = st.st_mtime_ns
+        with open(cpath / "meta.json", "w") as f:
+            json.dump(meta, f)
+
+    arrays = {name: np.load(cpath / (name + ".npy"), mmap_mode="r") for name in AnnTable.ARRAYS}
+    logging.debug("Loaded cached table of %s", path)
+    return AnnTable(arrays, meta["meta"], meta["keys"])
+
+
+def build_cached_table(path, cache_root=None):
+    """
+    Parse an annotation file and write the resulting table to its cache.
+
+    Args:
+        path (str): Annotation file
+        cache_root (str, optional): Directory holding the caches. See `cache_path`.
+
+    Raises:
+        ValueError: if the annotation file cannot be represented as a table
+
+    Returns:
+        AnnTable: Parsed table
+    """
+    path = Path(path)
+    st = path.stat()
+    data = path.read_bytes()
+    if path.suffix == ".json":
+        table = AnnTable.from_text(data.decode())
+    else:
+        table = AnnTable.from_json(path)
+    key = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": file_hash(data=data)}
+
+    cpath = cache_path(path, cache_root)
+    cpath.parent.mkdir(parents=True, exist_ok=True)
+    save_table(table, cpath, key)
+    logging.info("Wrote cache of %s to %s", path, cpath)
+    return table
+
+
+def cached_table(path, cache_root=None):
+    """
+    Table of an annotation file, from its cache if valid, otherwise parsed and cached.
+
+    Args:
+        path (str): Annotation file
+        cache_root (str, optional): Directory holding the caches. See `cache_path`.
+
+    Raises:
+        ValueError: if the annotation file cannot be represented as a table
+
+    Returns:
+        AnnTable: Table of the annotation file
+    """
+    table = load_cached_table(path, cache_root)
+    if table is None:
+        table = build_cached_table(path, cache_root)
+    return table
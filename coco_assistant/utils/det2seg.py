@@ -1,12 +1,197 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 from PIL import Image
+from pycocotools import mask as maskUtils
 from pycocotools.coco import COCO
 from tqdm import tqdm
 
+from .shards import DEFAULT_SHARD_BYTES, MaskShardWriter
 
-def det2seg(cann, output_dir, palette=True):
+DET2SEG_CHUNK = 64
+
+
+def _colour_map(cats):
+    # Colour of every mask value, i.e. category id. A full 256 entry palette also
+    # keeps PIL from saving the PNG with fewer bits per pixel than the ids need.
+    colour_map = np.zeros((256, 3), dtype=int)
+
+    # Set seed for palette colour
+    rng = np.random.RandomState(121)
+
+    # Create category colourmap
+    for c in cats:
+        colour = (rng.randint(0, 256), rng.randint(0, 256), rng.randint(0, 256))
+        # Masks are uint8, larger ids have no colour of their own
+        if c["id"] < len(colour_map):
+            colour_map[c["id"]] = colour
+
+    return colour_map
+
+
+def _poly_boundary(poly, h, w):
+    # Pixels where a polygon's mask switches on or off when walking down the columns
+    # of the image, as (x, y) with y in [0, h]. A port of rleFrPoly from pycocotools,
+    # with the same floating point steps, so the mask is identical to `annToMask`.
+    scale = 5.0
+    xy = np.asarray(poly, dtype=float)
+    # upsample and get discrete points densely along entire boundary
+    x = np.trunc(scale * xy[0::2] + 0.5).astype(np.int64)
+    y = np.trunc(scale * xy[1::2] + 0.5).astype(np.int64)
+    xs, xe, ys, ye = x, np.roll(x, -1), y, np.roll(y, -1)
+    dx, dy = np.abs(xe - xs), np.abs(ye - ys)
+    horizontal = dx >= dy
+    flip = (horizontal & (xs > xe)) | (~horizontal & (ys > ye))
+    xs, xe = np.where(flip, xe, xs), np.where(flip, xs, xe)
+    ys, ye = np.where(flip, ye, ys), np.where(flip, ys, ye)
+    steps = np.where(horizontal, dx, dy)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s = np.where(horizontal, (ye - ys) / dx, (xe - xs) / dy)
+
+    # Every edge is walked from its first to its last vertex, flipped edges backwards
+    edge = np.repeat(np.arange(len(steps)), steps + 1)
+    d = np.arange(len(edge)) - np.repeat(np.cumsum(steps + 1) - (steps + 1), steps + 1)
+    t = np.where(flip[edge], steps[edge] - d, d)
+    # Points of zero length edges are never used, they are only kept to walk
+    # the same sequence
+    with np.errstate(invalid="ignore"):
+        interp = np.nan_to_num(s[edge] * t)
+    h_edge = horizontal[edge]
+    u = np.where(h_edge, t + xs[edge], np.trunc(xs[edge] + interp + 0.5)).astype(np.int64)
+    v = np.where(h_edge, np.trunc(ys[edge] + interp + 0.5), t + ys[edge]).astype(np.int64)
+
+    # get points along y-boundary and downsample
+    moved = np.flatnonzero(u[1:] != u[:-1]) + 1
+    uj, ui = u[moved], u[moved - 1]
+    xd = np.where(uj < ui, uj, uj - 1).astype(float)
+    xd = (xd + 0.5) / scale - 0.5
+    keep = (np.floor(xd) == xd) & (xd >= 0) & (xd <= w - 1)
+    yd = np.minimum(v[moved], v[moved - 1])[keep].astype(float)
+    yd = np.ceil(np.clip((yd + 0.5) / scale - 0.5, 0, h))
+    return xd[keep].astype(np.int64), yd.astype(np.int64)
+
+
+def _ann_window(ann, h, w):
+    # Mask of an annotation within the smallest window of the image holding it,
+    # as (mask, rows, cols). Polygons are rasterised in the window only.
+    segm = ann["segmentation"]
+    if isinstance(segm, list) and segm and all(len(p) > 4 for p in segm):
+        bounds = [_poly_boundary(p, h, w) for p in segm]
+        bounds = [(x, y) for x, y in bounds if len(x)]
+        if not bounds:
+            return None
+        x0 = min(x.min() for x, _ in bounds)
+        x1 = max(x.max() for x, _ in bounds) + 1
+        y0 = min(y.min() for _, y in bounds)
+        y1 = max(y.max() for _, y in bounds)
+        if y0 >= y1:
+            return None
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        for x, y in bounds:
+            # Parity of the switches above every pixel of its column
+            toggles = np.zeros((y1 - y0 + 1, x1 - x0), dtype=np.int64)
+            np.add.at(toggles, (y - y0, x - x0), 1)
+            mask |= (np.cumsum(toggles, axis=0)[:-1] % 2).astype(bool)
+        return mask, slice(y0, y1), slice(x0, x1)
+
+    # RLEs encode the whole image, they are decoded in full and cropped to their box.
+    # So are polygons pycocotools reads in other ways (e.g. 4 coordinates as boxes).
+    if isinstance(segm, list):
+        rle = maskUtils.merge(maskUtils.frPyObjects(segm, h, w))
+    elif isinstance(segm["counts"], list):
+        rle = maskUtils.frPyObjects(segm, h, w)
+    else:
+        rle = segm
+    x, y, bw, bh = maskUtils.toBbox(rle)
+    if bw == 0 or bh == 0:
+        return None
+    rows, cols = slice(int(y), int(y + bh)), slice(int(x), int(x + bw))
+    return maskUtils.decode(rle)[rows, cols], rows, cols
+
+
+def _paint(img, anns):
+    h, w = img["height"], img["width"]
+    res = np.zeros((h, w), dtype=np.uint8)
+
+    # Painter's rule: larger objects are painted first, so smaller ones stay visible
+    # on top of them. Objects of the same area are painted in annotation order.
+    order = np.argsort([-a["area"] for a in anns], kind="stable")
+    cats = np.array([a["category_id"] for a in anns]).astype(np.uint8)
+    for i in order:
+        window = _ann_window(anns[i], h, w)
+        if window is None:
+            continue
+        mask, rows, cols = window
+        res[rows, cols][mask > 0] = cats[i]
+    return res
+
+
+def _render_mask(img, anns, colour_map, palette):
+    res = Image.fromarray(_paint(img, anns))
+    # Images without annotations are saved without palette
+    if anns and palette:
+        res.putpalette(colour_map.astype(np.uint8))
+    return res
+
+
+def _write_masks(records, output_dir, colour_map, palette):
+    # Renders and saves the masks of a chunk of (image, annotations) records
+    for img, anns in records:
+        name = Path(img["file_name"])
+        if name.suffix.lower() != ".png":
+            name = name.stem + ".png"
+        _render_mask(img, anns, colour_map, palette).save(Path(output_dir) / f"{name}")
+    return len(records)
+
+
+def _paint_masks(records):
+    # Masks of a chunk of (image, annotations) records, by image file name
+    return [(img["file_name"], _paint(img, anns)) for img, anns in records]
+
+
+def _records(cann, imids, chunk):
+    # (image, annotations) records of the images, in chunks
+    for i in range(0, len(imids), chunk):
+        records = []
+        for imid in imids[i : i + chunk]:
+            img = cann.loadImgs(imid)
+            if len(img) > 1:
+                raise AssertionError("Multiple images with same id")
+            records.append((img[0], cann.loadAnns(cann.getAnnIds(imgIds=[imid]))))
+        yield records
+
+
+def _map_chunks(fn, chunks, workers):
+    # Results of `fn` over the chunks, in order. With several workers, only a few
+    # chunks per worker are in flight, so records are extracted from the index
+    # as fast as they are rendered.
+    if workers is None or workers <= 1:
+        for records in chunks:
+            yield fn(records)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        pending = deque()
+        for records in chunks:
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+            pending.append(ex.submit(fn, records))
+        while pending:
+            yield pending.popleft().result()
+
+
+def det2seg(
+    cann,
+    output_dir,
+    palette=True,
+    workers=None,
+    chunk=DET2SEG_CHUNK,
+    fmt="png",
+    shard_bytes=DEFAULT_SHARD_BYTES,
+):
     """
     Function for converting segmentation polygons in MS-COCO
     object detection dataset to segmentation masks. The seg-
@@ -14,82 +199,57 @@ def det2seg(cann, output_dir, palette=True):
     randomly assigned based on class if specified. Change
     the seed if you want to change colours.
 
+    With several workers, images are handed to a pool of worker processes
+    in chunks, each chunk together with the records of its images only, so
+    no worker needs the whole annotation index. Every mask only depends on
+    its own image, so the output is the same as without workers.
+
+    Masks are either saved as one PNG per image, or stored in shards (see
+    `MaskShards`) that loaders read without decoding. The palette of the
+    shards is kept in their index, indexed by mask value like the palette
+    of the PNGs, so `shards.palette[mask]` gives the colours of the PNG.
 
     Args:
         cann (dict): COCO annotation object
         output_dir (str): Directory to store segmentation masks
         palette (bool, optional): Use palette. Defaults to True.
+        workers (int, optional): If greater than 1, masks are rendered and encoded in this
+            many worker processes. Defaults to None.
+        chunk (int, optional): Number of images handed to a worker at once. Defaults to 64.
+        fmt (str, optional): Output format, "png" or "shards". Defaults to "png".
+        shard_bytes (int, optional): Size at which a new shard is started. Defaults to 1G.
 
     Raises:
-        AssertionError: Incorrect shape for colour map array
         AssertionError: Muliple images have same image id
+        AssertionError: Unknown output format
     """
+    if fmt not in ("png", "shards"):
+        raise AssertionError("Unknown mask format {}".format(fmt))
 
     output_dir = Path(output_dir)
     if not output_dir.is_dir():
         output_dir.mkdir(parents=True, exist_ok=True)
 
     imids = cann.getImgIds()
-    cats = cann.loadCats(cann.getCatIds())
-
-    cat_colours = {0: (0, 0, 0)}
+    colour_map = _colour_map(cann.loadCats(cann.getCatIds()))
+    chunks = _records(cann, imids, chunk)
 
-    # Set seed for palette colour
-    np.random.seed(121)
+    with tqdm(total=len(imids)) as pbar:
+        if fmt == "png":
+            write = partial(
+                _write_masks, output_dir=output_dir, colour_map=colour_map, palette=palette
+            )
+            for n in _map_chunks(write, chunks, workers):
+                pbar.update(n)
+            return
 
-    # Create category colourmap
-    for c in cats:
-        cat_colours[c["id"]] = (
-            np.random.randint(0, 256),
-            np.random.randint(0, 256),
-            np.random.randint(0, 256),
-        )
-
-    colour_map = np.array(list(cat_colours.values()))
-    if colour_map.shape != (len(cats) + 1, 3):
-        raise AssertionError("Incorrect shape of color map array")
-
-    for imid in tqdm(imids):
-        img = cann.loadImgs(imid)
-        if len(img) > 1:
-            raise AssertionError("Multiple images with same id")
-        h, w = img[0]["height"], img[0]["width"]
-        name = img[0]["file_name"]
-        name = Path(name)
-        if name.suffix.lower() != ".png":
-            name = name.stem + ".png"
-        im = np.zeros((h, w), dtype=np.uint8)
-        annids = cann.getAnnIds(imgIds=[imid])
-        if not annids:
-            # No annotations
-            res = Image.fromarray(im)
-        else:
-            anns = cann.loadAnns(annids)
-            areas = [i["area"] for i in anns]
-            area_ids = [i for i in range(1, len(areas) + 1)][::-1]
-            area_id_map = dict(zip(sorted(areas), area_ids))
-            area_cat_map = {}
-
-            # Assumption: area of objects are unique
-            for ann in anns:
-                aid = area_id_map[ann["area"]]
-                bMask = cann.annToMask(ann)
-                aMask = bMask * aid
-                im = np.maximum(im, aMask)
-                area_cat_map[aid] = ann["category_id"]
-
-            # Ref: https://stackoverflow.com/questions/55949809/efficiently-replace-elements-in-array-based-on-dictionary-numpy-python/55950051#55950051
-            k = np.array(list(area_cat_map.keys()))
-            v = np.array(list(area_cat_map.values()))
-            mapping_ar = np.zeros(k.max() + 1, dtype=np.uint8)
-            mapping_ar[k] = v
-            res = mapping_ar[im]
-
-            res = Image.fromarray(res)
-            if palette:
-                res.putpalette(colour_map.astype(np.uint8))
-
-        res.save(output_dir / f"{name}")
+        # Workers render, shards are written in image order by this process only
+        colours = colour_map if palette else None
+        with MaskShardWriter(output_dir, shard_bytes, palette=colours) as shards:
+            for masks in _map_chunks(_paint_masks, chunks, workers):
+                for name, mask in masks:
+                    shards.add(name, mask)
+                pbar.update(len(masks))
 
 
 if __name__ == "__main__":
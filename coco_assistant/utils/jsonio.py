@@ -0,0 +1,181 @@
+"""
+Json serialisation used by the writers of the package.
+
+Json is encoded and decoded with orjson when it is installed and with the
+standard library otherwise. Output is compact (no whitespace between tokens)
+and utf-8 encoded. Files ending in `.gz` or `.zst` are written compressed
+with gzip or zstandard and read back transparently. zstandard compression
+needs the zstandard package.
+"""
+
+import gzip
+import io
+import json
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Suffix appended to `.json` for every supported compression
+COMPRESSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+JSON_SUFFIXES = tuple(".json" + s for s in COMPRESSIONS.values())
+
+_ENCODER = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+
+def dumps(obj):
+    """
+    Encode an object as compact json.
+
+    Args:
+        obj: Json serialisable object
+
+    Returns:
+        bytes: utf-8 encoded json
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers that do not fit in 64 bits
+            pass
+    return _ENCODER.encode(obj).encode("utf-8")
+
+
+def loads(data):
+    """
+    Decode json.
+
+    Args:
+        data (bytes or str): Json text
+
+    Returns:
+        Decoded object
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # e.g. NaN or integers that do not fit in 64 bits, which the standard library accepts
+            pass
+    return json.loads(data)
+
+
+def json_name(path):
+    """
+    Name of a json file without its json and compression suffixes.
+
+    Args:
+        path (str): Path of the file
+
+    Returns:
+        str: Name of the file, None if it is not a (compressed) json file
+    """
+    name = Path(path).name
+    for suffix in JSON_SUFFIXES:
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return None
+
+
+def json_path(directory, name, compression=None):
+    """
+    Path of a json file with the suffix of a compression.
+
+    Args:
+        directory (Path): Directory of the file
+        name (str): Name of the file without suffixes
+        compression (str, optional): None, "gzip" or "zstd". Defaults to None.
+
+    Raises:
+        AssertionError: if the compression is not supported
+
+    Returns:
+        Path: Path of the file
+    """
+    if compression not in COMPRESSIONS:
+        raise AssertionError(
+            "Unsupported compression {!r}, use one of {}".format(compression, list(COMPRESSIONS))
+        )
+    return Path(directory) / (name + ".json" + COMPRESSIONS[compression])
+
+
+def open_json(path, mode="rb"):
+    """
+    Open a json file, compressed according to its suffix.
+
+    Args:
+        path (str): Path of the file
+        mode (str, optional): "rb", "wb" or "rt". Defaults to "rb".
+
+    Raises:
+        ImportError: if the file is zstandard compressed and zstandard is not installed
+
+    Returns:
+        file: File object. Binary files support forward seeks when reading.
+    """
+    path = Path(path)
+    binary = mode.replace("t", "b")
+    if path.suffix == ".gz":
+        # The default level 9 is several times slower for little gain
+        f = gzip.open(path, binary, compresslevel=6)
+    elif path.suffix == ".zst":
+        if zstandard is None:
+            raise ImportError("Reading and writing .zst files requires the zstandard package")
+        raw = open(path, binary)
+        if binary == "wb":
+            f = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        else:
+            f = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+    else:
+        f = open(path, binary)
+    if mode == "rt":
+        return io.TextIOWrapper(f, encoding="utf-8")
+    return f
+
+
+def read_text(path):
+    """
+    Read a (compressed) json file.
+
+    Args:
+        path (str): Path of the file
+
+    Returns:
+        str: Json text
+    """
+    with open_json(path, "rt") as f:
+        return f.read()
+
+
+def load(path):
+    """
+    Read and decode a (compressed) json file.
+
+    Args:
+        path (str): Path of the file
+
+    Returns:
+        Decoded object
+    """
+    with open_json(path, "rb") as f:
+        return loads(f.read())
+
+
+def dump(obj, path):
+    """
+    Encode an object as compact json and write it to a file, compressed according to its suffix.
+
+    Args:
+        obj: Json serialisable object
+        path (str): Path of the file
+    """
+    with open_json(path, "wb") as f:
+        f.write(dumps(obj))
@@ -0,0 +1,208 @@
+import logging
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from pycocotools.coco import COCO
+
+from . import jsonio
+from .cache import build_cached_table, cached_table, load_cached_table
+from .table import AnnTable
+
+
+def parse_table(path, cache_root=None):
+    """
+    Parse an annotation file into an AnnTable.
+
+    Used as the worker function of `load_tables`. Annotation files that
+    cannot be represented as a table (e.g. string ids) yield None.
+
+    Args:
+        path (str): Path to annotation file
+        cache_root (str, optional): If given, the table is also written to the
+            sidecar cache in this directory. Defaults to None.
+
+    Returns:
+        AnnTable: Parsed annotation file or None
+    """
+    try:
+        if cache_root is not None:
+            return build_cached_table(path, cache_root)
+        return AnnTable.from_json(path)
+    except ValueError as e:
+        logging.warning("Could not build table for %s: %s", path, e)
+        return None
+
+
+def _build_cache(path, cache_root):
+    # Only report success, the parent memory-maps the written cache
+    return parse_table(path, cache_root) is not None
+
+
+def load_table(path, cache_root=None):
+    """
+    Table of an annotation file, using the sidecar cache if a cache directory is given.
+
+    Args:
+        path (str): Path to annotation file
+        cache_root (str, optional): Directory holding the sidecar caches. Defaults to None.
+
+    Returns:
+        AnnTable: Table of the annotation file or None if it cannot be represented as one
+    """
+    if cache_root is None:
+        return parse_table(path)
+    try:
+        return cached_table(path, cache_root)
+    except ValueError as e:
+        logging.warning("Could not build table for %s: %s", path, e)
+        return None
+
+
+def load_coco(path):
+    """
+    Load an annotation file into a plain COCO object.
+
+    Args:
+        path (str): Path to annotation file, which may be compressed (see `jsonio`)
+
+    Returns:
+        COCO: Parsed annotation file
+    """
+    if Path(path).suffix == ".json":
+        return COCO(path)
+    ann = COCO()
+    ann.dataset = jsonio.load(path)
+    ann.createIndex()
+    return ann
+
+
+def load_tables(paths, workers, cache_root=None):
+    """
+    Parse annotation files in parallel, one file per worker process.
+
+    Each worker hands back an AnnTable, which is pickled as a handful of
+    flat buffers instead of millions of nested dicts. If a cache directory
+    is given, files with a valid sidecar cache are memory-mapped instead
+    and the workers write the caches of the remaining files.
+
+    Args:
+        paths (list[str]): Paths to annotation files
+        workers (int): Maximum number of worker processes
+        cache_root (str, optional): Directory holding the sidecar caches. Defaults to None.
+
+    Returns:
+        list[AnnTable]: Parsed annotation files in the order of `paths`.
+            Entries are None for files that could not be represented as a table.
+    """
+    if cache_root is None:
+        tables = [None] * len(paths)
+        todo = list(range(len(paths)))
+    else:
+        tables = [load_cached_table(p, cache_root) for p in paths]
+        todo = [i for i, t in enumerate(tables) if t is None]
+    if not todo:
+        return tables
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(todo))) as ex:
+        if cache_root is None:
+            for i, table in zip(todo, ex.map(parse_table, [paths[i] for i in todo])):
+                tables[i] = table
+        else:
+            done = ex.map(_build_cache, [paths[i] for i in todo], [cache_root] * len(todo))
+            for i, ok in zip(todo, done):
+                tables[i] = load_cached_table(paths[i], cache_root) if ok else None
+    return tables
+
+
+class LazyAnnDict(Mapping):
+    """
+    Mapping of dataset names to annotation objects that are only parsed
+    the first time they are accessed.
+
+    Parsed datasets are kept in least recently used order. If a memory
+    budget is given, the least recently used datasets are dropped once the
+    combined footprint of the loaded datasets exceeds it. A dropped dataset
+    is simply parsed again the next time it is accessed. The most recently
+    accessed dataset is never dropped, even if it exceeds the budget by itself.
+
+    Args:
+        names (list[str]): Dataset names in the order they should be iterated.
+        loader (callable): Called with a dataset name, returns the parsed dataset.
+        mem_budget (int, optional): Maximum combined footprint (in bytes) of the
+            loaded datasets. Defaults to None (no limit).
+        sizeof (callable, optional): Called with a dataset name and the parsed
+            dataset, returns its footprint in bytes. Defaults to None, in which
+            case every dataset counts as 0 bytes.
+    """
+
+    def __init__(self, names, loader, mem_budget=None, sizeof=None):
+        self.names = list(names)
+        self.loader = loader
+        self.mem_budget = mem_budget
+        self.sizeof = sizeof
+
+        self._loaded = OrderedDict()
+        self._sizes = {}
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            return self._loaded[name]
+
+        logging.info("Loading dataset %s", name)
+        ann = self.loader(name)
+        self._loaded[name] = ann
+        self._sizes[name] = self.sizeof(name, ann) if self.sizeof is not None else 0
+        self._enforce_budget()
+        return ann
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        # Mapping.__contains__ goes through __getitem__, which would load the dataset
+        return name in self.names
+
+    def __repr__(self):
+        return "{}(names={}, loaded={})".format(type(self).__name__, self.names, self.loaded)
+
+    @property
+    def loaded(self):
+        """list[str]: Names of the currently loaded datasets, least recently used first."""
+        return list(self._loaded.keys())
+
+    @property
+    def nbytes(self):
+        """int: Combined footprint of the currently loaded datasets."""
+        return sum(self._sizes.values())
+
+    def is_loaded(self, name):
+        return name in self._loaded
+
+    def evict(self, name=None):
+        """
+        Drop parsed datasets from memory.
+
+        Args:
+            name (str, optional): Dataset to drop. Defaults to None, which drops all of them.
+        """
+        names = self.loaded if name is None else [name]
+        for n in names:
+            if n in self._loaded:
+                logging.info("Evicting dataset %s", n)
+                del self._loaded[n]
+                del self._sizes[n]
+
+    def _enforce_budget(self):
+        if self.mem_budget is None:
+            return
+        while len(self._loaded) > 1 and self.nbytes > self.mem_budget:
+            self.evict(next(iter(self._loaded)))
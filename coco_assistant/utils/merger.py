@@ -0,0 +1,739 @@
+import copy
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from . import jsonio
+from .cache import file_hash
+from .loader import load_coco, load_table
+from .misc import make_clean
+from .remapper import CatRemapper
+from .stream import AnnStream, JsonWriter
+from .table import TableCOCO, get_table
+
+MANIFEST_VERSION = 2
+
+
+class DatasetPlan:
+    """
+    How the records of one dataset are rewritten when it is merged.
+
+    Args:
+        renumber (bool): Give images and annotations new, consecutive ids
+        remap_image_refs (bool): Point the image ids of annotations to the new image ids
+        img_start (int): New id of the first image
+        ann_start (int): New id of the first annotation
+        cat_map (dict): Mapping of old to new category ids, None to keep them
+    """
+
+    def __init__(self, renumber, remap_image_refs, img_start, ann_start, cat_map):
+        self.renumber = renumber
+        self.remap_image_refs = remap_image_refs
+        self.img_start = img_start
+        self.ann_start = ann_start
+        self.cat_map = cat_map
+
+        if cat_map is not None:
+            # Sorted lookup table of the category mapping, for bulk remapping
+            self._cat_keys = np.array(sorted(cat_map), dtype=np.int64)
+            self._cat_values = np.array([cat_map[k] for k in self._cat_keys.tolist()], np.int64)
+
+    def to_dict(self):
+        """dict: Json serialisable form of the plan."""
+        cat_map = None if self.cat_map is None else list(self.cat_map.items())
+        return {
+            "renumber": self.renumber,
+            "remap_image_refs": self.remap_image_refs,
+            "img_start": self.img_start,
+            "ann_start": self.ann_start,
+            "cat_map": cat_map,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Restore a plan stored with `to_dict`.
+
+        Args:
+            state (dict): Stored plan
+
+        Returns:
+            DatasetPlan: Restored plan
+        """
+        state = dict(state)
+        if state["cat_map"] is not None:
+            # Stored as pairs, json objects would turn the ids into strings
+            state["cat_map"] = {k: v for k, v in state["cat_map"]}
+        return cls(**state)
+
+    def image_id_map(self, image_ids):
+        """
+        Mapping of old to new image ids.
+
+        Args:
+            image_ids (list): Old image ids in dataset order
+
+        Returns:
+            dict: New image id of every old image id
+        """
+        return {old: self.img_start + i for i, old in enumerate(image_ids)}
+
+    def rewrite_images(self, images, pos):
+        """
+        Rewrite image records in place.
+
+        Args:
+            images (list[dict]): Consecutive image records of the dataset
+            pos (int): Position of the first record within the dataset
+
+        Returns:
+            list[dict]: Rewritten records
+        """
+        if self.renumber:
+            for i, img in enumerate(images, self.img_start + pos):
+                img["id"] = i
+        return images
+
+    def rewrite_annotations(self, anns, pos, id_map=None):
+        """
+        Rewrite annotation records in place.
+
+        Args:
+            anns (list[dict]): Consecutive annotation records of the dataset
+            pos (int): Position of the first record within the dataset
+            id_map (dict, optional): Mapping of old to new image ids. Required
+                if `remap_image_refs` is set.
+
+        Returns:
+            list[dict]: Rewritten records
+        """
+        for i, ann in enumerate(anns, self.ann_start + pos):
+            if self.renumber:
+                ann["id"] = i
+            if self.remap_image_refs:
+                ann["image_id"] = id_map[ann["image_id"]]
+            if self.cat_map is not None:
+                ann["category_id"] = self.cat_map[ann["category_id"]]
+        return anns
+
+    def map_categories(self, category_ids):
+        """
+        Map category ids to their merged ids in bulk.
+
+        Args:
+            category_ids (np.ndarray): Old category ids
+
+        Raises:
+            KeyError: if a category id is not part of the mapping
+
+        Returns:
+            np.ndarray: New category ids
+        """
+        keys = self._cat_keys
+        if not len(keys):
+            if len(category_ids):
+                raise KeyError(category_ids[0].item())
+            return np.zeros(0, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(keys, category_ids), len(keys) - 1)
+        missing = keys[pos] != category_ids
+        if missing.any():
+            raise KeyError(category_ids[missing][0].item())
+        return self._cat_values[pos]
+
+    def rewrite_annotation_columns(self, anns, pos, image_ids, category_ids, img_index=None):
+        """
+        Rewrite annotation records in place, computing the new values from id columns.
+
+        Gives the same result as `rewrite_annotations`, but all new ids are
+        computed with array operations and only assigned record by record.
+
+        Args:
+            anns (list[dict]): Consecutive annotation records of the dataset
+            pos (int): Position of the first record within the dataset
+            image_ids (np.ndarray): Image id of every record
+            category_ids (np.ndarray): Category id of every record
+            img_index (GroupIndex, optional): Image rows by image id. Required
+                if `remap_image_refs` is set.
+
+        Returns:
+            list[dict]: Rewritten records
+        """
+        columns = []
+        if self.renumber:
+            start = self.ann_start + pos
+            columns.append(("id", np.arange(start, start + len(anns))))
+        if self.remap_image_refs:
+            # The last image with a given id wins, like in `image_id_map`
+            columns.append(("image_id", self.img_start + img_index.last(image_ids)))
+        if self.cat_map is not None:
+            columns.append(("category_id", self.map_categories(category_ids)))
+
+        for key, values in columns:
+            for ann, v in zip(anns, values.tolist()):
+                ann[key] = v
+        return anns
+
+
+class MergePlan:
+    """
+    Running state of a merge: category table, last ids and latest info/licenses.
+
+    Datasets are added in merge order. Each one only needs to be summarised
+    (record counts, last and largest ids and its small sections), which is
+    enough to decide how its records have to be rewritten.
+
+    The first dataset keeps its ids, unless its last image or annotation id is
+    a string, in which case its records are numbered from 0. Every following
+    dataset is numbered on from the last ids of the merged dataset and has its
+    categories remapped onto the merged category table with CatRemapper.
+    """
+
+    def __init__(self):
+        self.datasets = []
+        self.categories = []
+        self.info = None
+        self.licenses = None
+        self.last_imid = None
+        self.last_annid = None
+        # Ids of the last image and annotation written, which the last ids
+        # fall back to when a dataset has no records
+        self.tail_imid = None
+        self.tail_annid = None
+
+    def add(self, images, annotations, meta):
+        """
+        Add the next dataset to the merge.
+
+        Args:
+            images (dict): Summary of the image records ("count", "last_id", "max_id")
+            annotations (dict): Summary of the annotation records ("count", "last_id", "max_id")
+            meta (dict): Top level sections other than images and annotations
+
+        Returns:
+            DatasetPlan: How the records of the dataset have to be rewritten
+        """
+        n_img, n_ann = images["count"], annotations["count"]
+        if not self.datasets:
+            renumber = isinstance(images["last_id"], str) or isinstance(annotations["last_id"], str)
+            plan = DatasetPlan(
+                renumber, renumber and isinstance(images["last_id"], str), 0, 0, None
+            )
+            self.categories = sorted(copy.deepcopy(meta["categories"]), key=lambda i: i["id"])
+            if renumber:
+                self.last_imid, self.last_annid = n_img - 1, n_ann - 1
+                self.tail_imid, self.tail_annid = n_img - 1, n_ann - 1
+            else:
+                # Ids of following datasets start at 1 if the first one has no records
+                self.last_imid = images["max_id"] if n_img else 0
+                self.last_annid = annotations["max_id"] if n_ann else 0
+                self.tail_imid = images["last_id"] if n_img else 0
+                self.tail_annid = annotations["last_id"] if n_ann else 0
+        else:
+            cmapper = CatRemapper(self.categories, copy.deepcopy(meta["categories"]))
+            self.categories, overlap, newcat = cmapper.remap_cats()
+            cat_map = dict(overlap)
+            cat_map.update(newcat)
+            plan = DatasetPlan(True, True, self.last_imid + 1, self.last_annid + 1, cat_map)
+            if n_img:
+                self.tail_imid = self.last_imid + n_img
+            if n_ann:
+                self.tail_annid = self.last_annid + n_ann
+            self.last_imid, self.last_annid = self.tail_imid, self.tail_annid
+
+        if "info" in meta:
+            self.info = meta["info"]
+        if "licenses" in meta:
+            self.licenses = meta["licenses"]
+        self.datasets.append(plan)
+        return plan
+
+    _STATE = (
+        "categories",
+        "info",
+        "licenses",
+        "last_imid",
+        "last_annid",
+        "tail_imid",
+        "tail_annid",
+    )
+
+    def to_dict(self):
+        """dict: Json serialisable form of the merge state."""
+        state = {k: getattr(self, k) for k in self._STATE}
+        state["datasets"] = [plan.to_dict() for plan in self.datasets]
+        return state
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Restore a merge state stored with `to_dict`, so more datasets can be added to it.
+
+        Args:
+            state (dict): Stored merge state
+
+        Returns:
+            MergePlan: Restored merge state
+        """
+        merge = cls()
+        for k in cls._STATE:
+            setattr(merge, k, state[k])
+        merge.datasets = [DatasetPlan.from_dict(plan) for plan in state["datasets"]]
+        return merge
+
+
+def _summary(ids):
+    if not ids:
+        return {"count": 0, "last_id": None, "max_id": None}
+    try:
+        max_id = max(ids)
+    except TypeError:
+        # Mixed id types cannot be ordered
+        max_id = None
+    return {"count": len(ids), "last_id": ids[-1], "max_id": max_id}
+
+
+class COCOSource:
+    """
+    Record source over a parsed dataset, with the interface of an AnnStream.
+
+    Records are handed out as copies in chunks, so merging never modifies the
+    dataset. The dataset is looked up in `anndict` every time it is read, which
+    lets a LazyAnnDict evict it (and load it again) in between.
+
+    Args:
+        anndict (Mapping): Mapping of dataset names to COCO objects
+        name (str): Name of the dataset
+        chunk (int, optional): Number of records per chunk. Defaults to 10000.
+    """
+
+    def __init__(self, anndict, name, chunk=10000):
+        self.anndict = anndict
+        self.name = name
+        self.chunk = chunk
+
+    @property
+    def table(self):
+        """AnnTable: Table behind the dataset, None if it is not viewed as a table."""
+        return get_table(self.anndict[self.name])
+
+    def row_chunks(self, section):
+        """
+        Split the rows of a section of the table into chunks.
+
+        Args:
+            section (str): "images" or "annotations"
+
+        Yields:
+            range: Consecutive rows
+        """
+        table = self.table
+        n = len(table.img_ids) if section == "images" else len(table)
+        for start in range(0, n, self.chunk):
+            yield range(start, min(start + self.chunk, n))
+
+    def _records(self, section):
+        ann = self.anndict[self.name]
+        table = get_table(ann)
+        if table is not None:
+            decode = table.imgs if section == "images" else table.anns
+            for rows in self.row_chunks(section):
+                yield decode(rows)
+        else:
+            records = ann.dataset.get(section, [])
+            for start in range(0, len(records), self.chunk):
+                # Only top level fields are rewritten, a shallow copy is enough
+                yield [dict(r) for r in records[start : start + self.chunk]]
+
+    def images(self):
+        return self._records("images")
+
+    def annotations(self):
+        return self._records("annotations")
+
+    def image_ids(self):
+        ann = self.anndict[self.name]
+        table = get_table(ann)
+        if table is not None:
+            return table.img_ids.tolist()
+        return [img["id"] for img in ann.dataset.get("images", [])]
+
+    def summary(self, section):
+        ann = self.anndict[self.name]
+        table = get_table(ann)
+        if table is not None:
+            ids = table.img_ids if section == "images" else table.ann_ids
+            return _summary(ids.tolist())
+        return _summary([r["id"] for r in ann.dataset.get(section, [])])
+
+    def keys(self):
+        ann = self.anndict[self.name]
+        table = get_table(ann)
+        if table is not None:
+            return table.keys
+        return list(ann.dataset.keys())
+
+    def meta(self):
+        ann = self.anndict[self.name]
+        table = get_table(ann)
+        if table is not None:
+            return table.meta
+        return {k: v for k, v in ann.dataset.items() if k not in ("images", "annotations")}
+
+
+def _write_images(w, src, plan):
+    pos = 0
+    for chunk in src.images():
+        w.extend(plan.rewrite_images(chunk, pos))
+        pos += len(chunk)
+
+
+def _write_annotations(w, src, plan):
+    table = getattr(src, "table", None)
+    if table is not None:
+        # Ids are rewritten from the columns of the table instead of record by record
+        img_index = table.img_row_index if plan.remap_image_refs else None
+        for rows in src.row_chunks("annotations"):
+            chunk = plan.rewrite_annotation_columns(
+                table.anns(rows),
+                rows.start,
+                table.image_ids[rows.start : rows.stop],
+                table.category_ids[rows.start : rows.stop],
+                img_index,
+            )
+            w.extend(chunk)
+        return
+
+    id_map = plan.image_id_map(src.image_ids()) if plan.remap_image_refs else None
+    pos = 0
+    for chunk in src.annotations():
+        w.extend(plan.rewrite_annotations(chunk, pos, id_map))
+        pos += len(chunk)
+
+
+def manifest_path(dst):
+    """
+    Location of the manifest of a merged annotation file.
+
+    Args:
+        dst (str): Merged annotation file
+
+    Returns:
+        Path: Manifest file next to the merged annotation file
+    """
+    dst = Path(dst)
+    return dst.with_name(dst.name + ".manifest")
+
+
+def load_manifest(dst):
+    """
+    Read the manifest of a merged annotation file.
+
+    Args:
+        dst (str): Merged annotation file
+
+    Raises:
+        AssertionError: if the merged file was changed after the manifest was written
+
+    Returns:
+        dict: Manifest, or None if the merged file has no manifest
+    """
+    try:
+        with open(manifest_path(dst)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+
+    st = os.stat(dst)
+    if (manifest["size"], manifest["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+        raise AssertionError("{} was modified after it was merged".format(dst))
+    return manifest
+
+
+def _fingerprint(path):
+    # Annotation file a dataset was merged from, None if it is not known
+    if path is None:
+        return None
+    path = Path(path).resolve()
+    st = path.stat()
+    return {
+        "path": str(path),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "hash": file_hash(path),
+    }
+
+
+def changed_sources(manifest):
+    """
+    Merged datasets whose annotation files changed after they were merged.
+
+    A file whose size and modification time are unchanged is taken as is,
+    one that was only touched is hashed again. Datasets merged without their
+    annotation file being known are not checked.
+
+    Args:
+        manifest (dict): Manifest of a merged annotation file (see `load_manifest`)
+
+    Returns:
+        list[str]: Names of the changed or missing datasets
+    """
+    changed = []
+    for name, fp in zip(manifest["names"], manifest["sources"]):
+        if fp is None:
+            continue
+        try:
+            st = os.stat(fp["path"])
+        except OSError:
+            changed.append(name)
+            continue
+        if st.st_size != fp["size"] or (
+            st.st_mtime_ns != fp["mtime_ns"] and file_hash(fp["path"]) != fp["hash"]
+        ):
+            changed.append(name)
+    return changed
+
+
+def merge_sources(sources, dst, names=None, append=False, paths=None):
+    """
+    Merge datasets into a single annotation file, writing records as they are read.
+
+    Only one chunk of records (and the image id mapping of one dataset) is held
+    in memory at a time. A source is anything that behaves like an AnnStream:
+
+    - `summary(section)` returns the record count, last id and largest id of a section
+    - `meta()` returns the small top level sections
+    - `images()` and `annotations()` yield chunks of records that may be modified
+    - `image_ids()` returns the image ids in order
+
+    Sources with a `table` (see COCOSource) have their annotation ids,
+    image references and category ids rewritten in bulk from the id
+    columns of the table.
+
+    Next to the merged file a manifest is stored, holding the merge state,
+    the byte ranges of the image and annotation records in the merged file and
+    the size, modification time and content hash of every annotation file
+    merged. With `append`, the sources are added to an existing merged file:
+    its records are copied over verbatim and only the new sources are read,
+    which gives the same result as merging all datasets again.
+
+    Args:
+        sources (list): Datasets to merge, in merge order
+        dst (str): Path of the merged annotation file
+        names (list[str], optional): Names of the datasets, recorded in the manifest
+        append (bool, optional): Append the sources to the merged file at `dst`.
+            Defaults to False.
+        paths (list[str], optional): Annotation files of the sources, fingerprinted in
+            the manifest so appending can tell whether they changed. Defaults to None.
+
+    Raises:
+        AssertionError: if `append` is set and `dst` has no valid manifest
+        AssertionError: if `append` is set and a merged annotation file changed since
+
+    Returns:
+        MergePlan: Final state of the merge
+    """
+    paths = list(paths) if paths is not None else [None] * len(sources)
+    base, merge, names, fps, out = _begin_merge(dst, names, paths, append)
+    plans = [merge.add(s.summary("images"), s.summary("annotations"), s.meta()) for s in sources]
+
+    def write_images(w):
+        for src, plan in zip(sources, plans):
+            _write_images(w, src, plan)
+
+    def write_annotations(w):
+        for src, plan in tqdm(list(zip(sources, plans))):
+            _write_annotations(w, src, plan)
+
+    ranges = _write_merged(out, dst, base, merge, write_images, write_annotations)
+    _finish_merge(dst, out, names, fps, ranges, merge)
+    return merge
+
+
+def _file_source(path, stream, cache_root):
+    # Merge source of an annotation file, opened inside a worker process
+    if stream:
+        return AnnStream(path)
+    table = load_table(path, cache_root)
+    ann = TableCOCO(table) if table is not None else load_coco(path)
+    return COCOSource({path: ann}, path)
+
+
+def _summarise_file(path, stream, cache_root):
+    src = _file_source(path, stream, cache_root)
+    return src.summary("images"), src.summary("annotations"), src.meta()
+
+
+def _write_fragment(path, plan, out, stream, cache_root):
+    # Rewrite a dataset into a merged file of its own, returning the byte
+    # ranges of its records
+    src = _file_source(path, stream, cache_root)
+    plan = DatasetPlan.from_dict(plan)
+    ranges = {}
+    with JsonWriter(out) as w:
+        for section, write in (("images", _write_images), ("annotations", _write_annotations)):
+            w.begin(section)
+            start = w.tell()
+            write(w, src, plan)
+            ranges[section] = [start, w.tell()]
+            w.end()
+    return ranges
+
+
+def merge_files(paths, dst, workers, names=None, append=False, stream=False, cache_root=None):
+    """
+    Merge annotation files in parallel worker processes.
+
+    The merge runs in three steps. Workers first summarise the files, from
+    which the global category table and the id offsets of every dataset are
+    planned in merge order, exactly as `merge_sources` does. Workers then
+    rewrite their datasets according to that plan into fragment files in
+    parallel, which are finally concatenated into the merged file as they are.
+    The result is identical to `merge_sources`.
+
+    Parsed tables are kept in a sidecar cache between the first two steps, so
+    every file is parsed once. Without `cache_root` a temporary cache is used.
+
+    Args:
+        paths (list[str]): Annotation files to merge, in merge order
+        dst (str): Path of the merged annotation file
+        workers (int): Maximum number of worker processes
+        names (list[str], optional): Names of the datasets, recorded in the manifest
+        append (bool, optional): Append the files to the merged file at `dst`.
+            Defaults to False.
+        stream (bool, optional): Read the files with AnnStream instead of
+            parsing them into tables. Defaults to False.
+        cache_root (str, optional): Directory holding the sidecar caches. Defaults to None.
+
+    Raises:
+        AssertionError: if `append` is set and `dst` has no valid manifest
+        AssertionError: if `append` is set and a merged annotation file changed since
+
+    Returns:
+        MergePlan: Final state of the merge
+    """
+    dst = Path(dst)
+    paths = [Path(p) for p in paths]
+    base, merge, names, fps, out = _begin_merge(dst, names, paths, append)
+
+    parts = dst.with_name(dst.name + ".parts")
+    make_clean(parts)
+    if not stream and cache_root is None:
+        cache_root = parts / "cache"
+    frags = [parts / "{}.json".format(i) for i in range(len(paths))]
+    n = len(paths)
+
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, n))) as ex:
+        summaries = list(ex.map(_summarise_file, paths, [stream] * n, [cache_root] * n))
+        plans = [merge.add(*summary) for summary in summaries]
+        done = ex.map(
+            _write_fragment,
+            paths,
+            [plan.to_dict() for plan in plans],
+            frags,
+            [stream] * n,
+            [cache_root] * n,
+        )
+        frag_ranges = list(tqdm(done, total=n))
+
+    def concat(section):
+        def write(w):
+            for frag, ranges in zip(frags, frag_ranges):
+                with jsonio.open_json(frag) as f:
+                    w.copy(f, *ranges[section])
+
+        return write
+
+    ranges = _write_merged(out, dst, base, merge, concat("images"), concat("annotations"))
+    shutil.rmtree(parts)
+    _finish_merge(dst, out, names, fps, ranges, merge)
+    return merge
+
+
+def _begin_merge(dst, names, paths, append):
+    """
+    Set up a merge into `dst`.
+
+    Returns:
+        tuple:
+        - base (dict): Manifest of the merged file appended to, None for a new merge
+        - merge (MergePlan): Merge state to add the new datasets to
+        - names (list): Names of all datasets of the merged file
+        - fps (list): Fingerprints of the annotation files of all datasets of the merged file
+        - out (Path): File to write the merged annotations to
+    """
+    dst = Path(dst)
+    names = list(names) if names is not None else [None] * len(paths)
+    fps = [_fingerprint(p) for p in paths]
+    if not append:
+        return None, MergePlan(), names, fps, dst
+
+    base = load_manifest(dst)
+    if base is None:
+        raise AssertionError("{} has no merge manifest to append to".format(dst))
+    changed = changed_sources(base)
+    if changed:
+        raise AssertionError(
+            "{} changed after being merged into {}".format(", ".join(map(str, changed)), dst)
+        )
+    # Keep the suffix, which decides the compression
+    out = dst.with_name(".tmp." + dst.name)
+    plan = MergePlan.from_dict(base["plan"])
+    return base, plan, base["names"] + names, base["sources"] + fps, out
+
+
+def _write_merged(out, dst, base, merge, write_images, write_annotations):
+    """
+    Write a merged annotation file.
+
+    Records of the merged file being appended to are copied first, followed by
+    what `write_images` and `write_annotations` write when called with the
+    JsonWriter.
+
+    Returns:
+        dict: Byte ranges of the image and annotation records in `out`
+    """
+    ranges = {}
+    with JsonWriter(out) as w, jsonio.open_json(dst) if base else nullcontext() as prev:
+        for section, write in (("images", write_images), ("annotations", write_annotations)):
+            w.begin(section)
+            start = w.tell()
+            if prev:
+                w.copy(prev, *base["ranges"][section])
+            write(w)
+            ranges[section] = [start, w.tell()]
+            w.end()
+
+        w.write("info", merge.info)
+        w.write("licenses", merge.licenses)
+        w.write("categories", merge.categories)
+    return ranges
+
+
+def _finish_merge(dst, out, names, fps, ranges, merge):
+    # Move an appended file into place and store the manifest of the result
+    dst = Path(dst)
+    if out != dst:
+        os.replace(out, dst)
+        logging.debug("Appended datasets to %s", dst)
+
+    st = os.stat(dst)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "names": names,
+        "sources": fps,
+        "ranges": ranges,
+        "plan": merge.to_dict(),
+    }
+    with open(manifest_path(dst), "w") as f:
+        json.dump(manifest, f)
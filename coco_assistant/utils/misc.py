@@ -2,6 +2,8 @@ import shutil
 from pathlib import Path
 from typing import Union
 
+from .jsonio import JSON_SUFFIXES, json_name
+
 
 def make_clean(dpath):
     if dpath.exists():
@@ -38,6 +40,14 @@ class DirectoryHandler:
             [i for i in self.img_dir.iterdir() if i.is_dir() and not i.name.startswith(".")]
         )
 
-        jsons = sorted([j for j in self.ann_dir.iterdir() if j.suffix == ".json"])
+        jsons = sorted([j for j in self.ann_dir.iterdir() if json_name(j) is not None])
+
+        return [img.stem for img, ann in zip(imgs, jsons) if img.stem == json_name(ann)]
 
-        return [img.stem for img, ann in zip(imgs, jsons) if img.stem == ann.stem]
+    def ann_path(self, name: str) -> Path:
+        # Annotation files may be compressed
+        for suffix in JSON_SUFFIXES:
+            path = self.ann_dir / (name + suffix)
+            if path.exists():
+                return path
+        return self.ann_dir / (name + ".json")
@@ -0,0 +1,234 @@
+from collections import namedtuple
+
+import numpy as np
+
+from .remover import _chunks
+from .stream import JsonWriter
+
+Selection = namedtuple("Selection", ["anns", "images"])
+Selection.__doc__ = """
+Result of an `AnnQuery`.
+
+Args:
+    anns (np.ndarray): Selected annotation rows, in file order
+    images (np.ndarray): Selected image rows, in file order
+"""
+
+
+def _in_range(values, rng):
+    """Mask of the values within an inclusive (min, max) range, either bound may be None."""
+    lo, hi = rng
+    mask = np.ones(len(values), dtype=bool)
+    if lo is not None:
+        mask &= values >= lo
+    if hi is not None:
+        mask &= values <= hi
+    return mask
+
+
+def _table_columns(table):
+    return {
+        "ann_ids": table.ann_ids,
+        "category_ids": table.category_ids,
+        "bboxes": table.bboxes,
+        "areas": table.areas,
+        "iscrowd": table.iscrowd,
+        "img_rows": table.ann_img_rows(),
+        "img_ids": table.img_ids,
+        "img_widths": table.img_widths,
+        "img_heights": table.img_heights,
+    }
+
+
+def _record_columns(src):
+    img_ids, widths, heights = [], [], []
+    for chunk in src.images():
+        for img in chunk:
+            img_ids.append(img["id"])
+            widths.append(img.get("width", -1))
+            heights.append(img.get("height", -1))
+    # The last image with a given id wins, like in a COCO index
+    img_row = {i: row for row, i in enumerate(img_ids)}
+
+    ann_ids, cat_ids, bboxes, areas, iscrowd, img_rows = [], [], [], [], [], []
+    for chunk in src.annotations():
+        for a in chunk:
+            ann_ids.append(a["id"])
+            cat_ids.append(a.get("category_id", -1))
+            bboxes.append(a.get("bbox", (np.nan,) * 4))
+            areas.append(a.get("area", np.nan))
+            iscrowd.append(a.get("iscrowd", 0))
+            img_rows.append(img_row.get(a["image_id"], -1))
+
+    n = len(ann_ids)
+    return {
+        "ann_ids": np.array(ann_ids, dtype=object),
+        "category_ids": np.array(cat_ids, dtype=object),
+        "bboxes": np.array(bboxes, dtype=np.float64).reshape(n, 4),
+        "areas": np.array(areas, dtype=np.float64),
+        "iscrowd": np.array(iscrowd, dtype=np.uint8),
+        "img_rows": np.array(img_rows, dtype=np.int64),
+        "img_ids": np.array(img_ids, dtype=object),
+        "img_widths": np.array(widths, dtype=np.float64),
+        "img_heights": np.array(heights, dtype=np.float64),
+    }
+
+
+class AnnQuery:
+    """
+    Vectorised filters over the annotations of a dataset.
+
+    The fields filters look at are gathered into NumPy columns once, after
+    which every query is a handful of array comparisons. Datasets held as
+    tables use the columns of the table directly. Other datasets (and
+    streamed ones) are read once to build the columns.
+
+    Args:
+        src (AnnStream or COCOSource): Dataset to query
+    """
+
+    def __init__(self, src):
+        self.src = src
+        self.categories = src.meta().get("categories", [])
+        table = getattr(src, "table", None)
+        columns = _table_columns(table) if table is not None else _record_columns(src)
+        for name, column in columns.items():
+            setattr(self, name, column)
+
+    def __len__(self):
+        return len(self.ann_ids)
+
+    def cat_ids(self, names):
+        """
+        Ids of the categories with the given names.
+
+        Args:
+            names (list[str]): Category names
+
+        Raises:
+            AssertionError: if a category does not exist
+
+        Returns:
+            list: Category ids
+        """
+        ids = {c["name"]: c["id"] for c in self.categories}
+        unknown = [n for n in names if n not in ids]
+        if unknown:
+            raise AssertionError("Unknown categories: {}".format(unknown))
+        return [ids[n] for n in names]
+
+    def select(
+        self,
+        cats=None,
+        area=None,
+        width=None,
+        height=None,
+        aspect=None,
+        iscrowd=None,
+        img_width=None,
+        img_height=None,
+        img_ids=None,
+        keep_empty=False,
+    ):
+        """
+        Select the annotations matching all given filters.
+
+        Ranges are (min, max) pairs, both inclusive. Either bound may be None
+        to leave that side open. Annotations missing a field (e.g. `area`)
+        never match a filter on it.
+
+        Args:
+            cats (list[str], optional): Category names
+            area (tuple, optional): Range of annotation areas
+            width (tuple, optional): Range of bounding box widths
+            height (tuple, optional): Range of bounding box heights
+            aspect (tuple, optional): Range of bounding box aspect ratios (width / height)
+            iscrowd (bool, optional): Crowd flag
+            img_width (tuple, optional): Range of image widths
+            img_height (tuple, optional): Range of image heights
+            img_ids (list, optional): Ids of the images to select from
+            keep_empty (bool, optional): Also select the images that pass the image filters
+                but have no selected annotations. Defaults to False.
+
+        Raises:
+            AssertionError: if a category does not exist
+
+        Returns:
+            Selection: Selected annotation and image rows
+        """
+        imgs = np.ones(len(self.img_ids), dtype=bool)
+        if img_width is not None:
+            imgs &= _in_range(self.img_widths, img_width)
+        if img_height is not None:
+            imgs &= _in_range(self.img_heights, img_height)
+        if img_ids is not None:
+            imgs &= np.isin(self.img_ids, list(img_ids))
+
+        anns = np.ones(len(self), dtype=bool)
+        if img_width is not None or img_height is not None or img_ids is not None:
+            # Annotations of missing images never match an image filter
+            has_img = self.img_rows >= 0
+            anns[has_img] = imgs[self.img_rows[has_img]]
+            anns[~has_img] = False
+        if cats is not None:
+            anns &= np.isin(self.category_ids, self.cat_ids(cats))
+        if area is not None:
+            anns &= _in_range(self.areas, area)
+        w, h = self.bboxes[:, 2], self.bboxes[:, 3]
+        if width is not None:
+            anns &= _in_range(w, width)
+        if height is not None:
+            anns &= _in_range(h, height)
+        if aspect is not None:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                anns &= _in_range(w / h, aspect)
+        if iscrowd is not None:
+            anns &= self.iscrowd == int(iscrowd)
+
+        ann_rows = np.flatnonzero(anns)
+        if not keep_empty:
+            used = np.zeros(len(imgs), dtype=bool)
+            img_rows = self.img_rows[ann_rows]
+            used[img_rows[img_rows >= 0]] = True
+            imgs &= used
+        return Selection(ann_rows, np.flatnonzero(imgs))
+
+    def write(self, selection, dst):
+        """
+        Write the selected records as a new annotation file.
+
+        All other sections (categories, info, licenses, ...) are copied as they are.
+
+        Args:
+            selection (Selection): Records to write
+            dst (str): Path of the annotation file
+        """
+        meta = self.src.meta()
+        with JsonWriter(dst) as w:
+            for key in self.src.keys():
+                if key in ("images", "annotations"):
+                    w.begin(key)
+                    for chunk in self._records(key, selection):
+                        w.extend(chunk)
+                    w.end()
+                else:
+                    w.write(key, meta[key])
+
+    def _records(self, section, selection):
+        rows = selection.images if section == "images" else selection.anns
+        table = getattr(self.src, "table", None)
+        if table is not None:
+            decode = table.imgs if section == "images" else table.anns
+            for r in _chunks(rows, self.src.chunk):
+                yield decode(r)
+            return
+
+        n = len(self.img_ids) if section == "images" else len(self)
+        keep = np.zeros(n, dtype=bool)
+        keep[rows] = True
+        records = self.src.images() if section == "images" else self.src.annotations()
+        pos = 0
+        for chunk in records:
+            mask = keep[pos : pos + len(chunk)]
+            pos += len(chunk)
+            yield [r for r, k in zip(chunk, mask.tolist()) if k]
@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+
+from .stream import JsonWriter
+
+
+def _chunks(rows, chunk):
+    for start in range(0, len(rows), chunk):
+        yield rows[start : start + chunk]
+
+
+def _emptied_images(src, catids_remove):
+    """Ids of the images whose annotations all belong to removed categories."""
+    table = getattr(src, "table", None)
+    if table is not None:
+        remove = np.isin(table.category_ids, list(catids_remove))
+        return set(np.setdiff1d(table.image_ids[remove], table.image_ids[~remove]).tolist())
+
+    removed, kept = set(), set()
+    for chunk in src.annotations():
+        for a in chunk:
+            (removed if a["category_id"] in catids_remove else kept).add(a["image_id"])
+    return removed - kept
+
+
+def _kept_images(src, emptied):
+    table = getattr(src, "table", None)
+    if table is not None:
+        rows = np.flatnonzero(~np.isin(table.img_ids, list(emptied)))
+        for r in _chunks(rows, src.chunk):
+            yield table.imgs(r)
+        return
+    for chunk in src.images():
+        yield [i for i in chunk if i["id"] not in emptied]
+
+
+def _kept_annotations(src, catids_remove, cat_map):
+    table = getattr(src, "table", None)
+    if table is not None:
+        # Only the annotations that are kept are decoded
+        rows = np.flatnonzero(~np.isin(table.category_ids, list(catids_remove)))
+        chunks = (table.anns(r) for r in _chunks(rows, src.chunk))
+    else:
+        chunks = (
+            [a for a in c if a["category_id"] not in catids_remove] for c in src.annotations()
+        )
+    for chunk in chunks:
+        if cat_map is not None:
+            for a in chunk:
+                if a["category_id"] not in cat_map:
+                    raise AssertionError(
+                        "Annotation {} has category id {}, which is not in the categories, "
+                        "so it cannot be compacted".format(a["id"], a["category_id"])
+                    )
+                a["category_id"] = cat_map[a["category_id"]]
+        yield chunk
+
+
+def remove_categories(src, rcats, dst, prune_images=False, compact=False):
+    """
+    Write a copy of an annotation file without the given categories.
+
+    The dataset is read once more at most (to find the images to prune),
+    records are filtered chunk by chunk and written as they are read. Datasets
+    held as tables are filtered on their category column, so only the kept
+    records are decoded.
+
+    Sections are written in the order `COCO_Assistant.remove_cat` has always
+    written them: the original sections, followed by the kept categories and
+    the annotations that do not belong to a removed category, all in file order.
+
+    Args:
+        src (AnnStream or COCOSource): Annotation file to filter
+        rcats (list[str]): Names of the categories to remove
+        dst (str): Path of the filtered annotation file
+        prune_images (bool, optional): Drop images whose annotations all belong to removed
+            categories. Images without any annotations are kept. Defaults to False.
+        compact (bool, optional): Renumber the kept categories 1..N, in the order of their
+            original ids. Defaults to False.
+
+    Raises:
+        AssertionError: if compacting and an annotation belongs to a category the dataset
+            does not list. No output file is left behind then.
+
+    Returns:
+        dict: Number of kept "categories", "annotations" and "images"
+    """
+    meta = src.meta()
+    cats = meta.get("categories", [])
+    catids_remove = {c["id"] for c in cats if c["name"] in rcats}
+    cats_keep = [dict(c) for c in cats if c["id"] not in catids_remove]
+
+    cat_map = None
+    if compact:
+        cat_map = {c["id"]: i for i, c in enumerate(sorted(cats_keep, key=lambda c: c["id"]), 1)}
+        for c in cats_keep:
+            c["id"] = cat_map[c["id"]]
+
+    emptied = _emptied_images(src, catids_remove) if prune_images else set()
+
+    n_imgs = n_anns = 0
+    try:
+        with JsonWriter(dst) as w:
+            for key in src.keys():
+                if key == "images":
+                    w.begin(key)
+                    for chunk in _kept_images(src, emptied):
+                        w.extend(chunk)
+                        n_imgs += len(chunk)
+                    w.end()
+                elif key not in ("categories", "annotations"):
+                    w.write(key, meta[key])
+            w.write("categories", cats_keep)
+            w.begin("annotations")
+            for chunk in _kept_annotations(src, catids_remove, cat_map):
+                w.extend(chunk)
+                n_anns += len(chunk)
+            w.end()
+    except AssertionError:
+        # Do not leave a truncated annotation file behind
+        os.remove(dst)
+        raise
+
+    return {"categories": len(cats_keep), "annotations": n_anns, "images": n_imgs}
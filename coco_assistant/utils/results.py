@@ -0,0 +1,177 @@
+"""
+On-disk cache of computed results (statistics, anchors, ...).
+
+Results are pickled into one file each, named after a key derived from the
+operation, its parameters and the content fingerprints of the annotation
+files it was computed from. Editing an annotation file changes its
+fingerprint, so stale results are never returned; they age out instead.
+
+Fingerprints are content hashes, remembered together with the size and
+modification time of the file so unchanged files are not hashed again.
+The cache is bounded in size: once it grows beyond `max_bytes`, the least
+recently used results are evicted.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+from pathlib import Path
+
+from .cache import file_hash
+
+DEFAULT_RESULT_CACHE_DIR = ".result_cache"
+DEFAULT_RESULT_CACHE_BYTES = 256 << 20
+RESULT_CACHE_VERSION = 1
+
+_FINGERPRINTS = "fingerprints.json"
+_SUFFIX = ".pkl"
+
+
+class ResultCache:
+    """
+    Size bounded, persistent cache of results keyed by dataset fingerprints.
+
+    Args:
+        root (str): Directory of the cache
+        max_bytes (int, optional): Size the cache is trimmed to after every write.
+            Defaults to 256M.
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_RESULT_CACHE_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._fingerprints = None
+
+    def _load_fingerprints(self):
+        if self._fingerprints is None:
+            try:
+                with open(self.root / _FINGERPRINTS) as f:
+                    self._fingerprints = json.load(f)
+            except (OSError, ValueError):
+                self._fingerprints = {}
+        return self._fingerprints
+
+    def fingerprint(self, path):
+        """
+        Content fingerprint of an annotation file.
+
+        The file is only hashed if its size or modification time changed
+        since it was last fingerprinted.
+
+        Args:
+            path (str): Annotation file
+
+        Returns:
+            str: Hex digest of the content
+        """
+        path = Path(path).resolve()
+        st = path.stat()
+        known = self._load_fingerprints()
+        entry = known.get(str(path))
+        if entry is not None and entry[:2] == [st.st_size, st.st_mtime_ns]:
+            return entry[2]
+
+        digest = file_hash(path)
+        known[str(path)] = [st.st_size, st.st_mtime_ns, digest]
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._atomic_write(self.root / _FINGERPRINTS, json.dumps(known).encode())
+        return digest
+
+    def key(self, op, paths, params=None):
+        """
+        Key of a result.
+
+        Args:
+            op (str): Name of the operation
+            paths (list[str]): Annotation files the result is computed from
+            params (dict, optional): Parameters of the operation, json serialisable
+
+        Raises:
+            AssertionError: if the parameters are not json serialisable
+
+        Returns:
+            str: Key of the result
+        """
+        ident = {
+            "version": RESULT_CACHE_VERSION,
+            "op": op,
+            "fingerprints": [self.fingerprint(p) for p in paths],
+            "params": params or {},
+        }
+        # Parameters are keyed on their exact json, never on a (possibly truncated) repr
+        try:
+            data = json.dumps(ident, sort_keys=True).encode()
+        except TypeError as e:
+            raise AssertionError("Parameters of {} are not json serialisable: {}".format(op, e))
+        return "{}-{}".format(op, hashlib.blake2b(data, digest_size=16).hexdigest())
+
+    def get(self, key):
+        """
+        Look up a result.
+
+        Args:
+            key (str): Key of the result
+
+        Returns:
+            Stored result, or None if it is not cached
+        """
+        path = self.root / (key + _SUFFIX)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        # Mark as recently used
+        os.utime(path)
+        logging.debug("Loaded cached result %s", key)
+        return value
+
+    def put(self, key, value):
+        """
+        Store a result and evict the least recently used ones beyond `max_bytes`.
+
+        Args:
+            key (str): Key of the result
+            value: Picklable result
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._atomic_write(self.root / (key + _SUFFIX), pickle.dumps(value, protocol=4))
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used results until the cache fits in `max_bytes`."""
+        entries = []
+        for p in self.root.glob("*" + _SUFFIX):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                p.unlink()
+            except OSError:
+                continue
+            total -= size
+            logging.debug("Evicted cached result %s", p.stem)
+
+    def clear(self):
+        """Remove all results and fingerprints."""
+        for p in self.root.glob("*" + _SUFFIX):
+            p.unlink()
+        fingerprints = self.root / _FINGERPRINTS
+        if fingerprints.exists():
+            fingerprints.unlink()
+        self._fingerprints = None
+
+    @staticmethod
+    def _atomic_write(path, data):
+        tmp = path.with_name("{}.tmp{}".format(path.name, os.getpid()))
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
@@ -0,0 +1,139 @@
+"""
+Sharded array storage of segmentation masks.
+
+Masks are stored uncompressed and back to back (uint8, row major) in shard
+files of at most `shard_bytes` bytes each; a mask larger than that gets a
+shard of its own. `index.json` maps the image file name of every mask to its
+shard, byte offset and shape, so any mask is read with a single seek and no
+decoding, or memory-mapped straight from the shard.
+"""
+
+import json
+import os
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+
+SHARD_VERSION = 1
+DEFAULT_SHARD_BYTES = 1 << 30
+
+_INDEX = "index.json"
+_SHARD = "masks-{:05d}.bin"
+
+
+class MaskShardWriter:
+    """
+    Writes masks into shards, and their index once closed.
+
+    Shards and index of a previous run in the same directory are replaced.
+
+    Args:
+        root (str): Directory of the shards
+        shard_bytes (int, optional): Size a shard is closed at. Defaults to 1G.
+        palette (np.ndarray, optional): (256, 3) colour of every mask value, stored in
+            the index. Defaults to None.
+    """
+
+    def __init__(self, root, shard_bytes=DEFAULT_SHARD_BYTES, palette=None):
+        self.root = Path(root)
+        self.shard_bytes = shard_bytes
+        self.palette = None if palette is None else np.asarray(palette).astype(int).tolist()
+        self.shards = []
+        self.masks = {}
+        self._f = None
+        self._size = 0
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        for p in self.root.glob(_SHARD.replace("{:05d}", "*")):
+            p.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add(self, name, mask):
+        """
+        Append a mask.
+
+        Args:
+            name (str): File name of the image of the mask
+            mask (np.ndarray): (H, W) mask, stored as uint8
+
+        Raises:
+            AssertionError: if a mask of the same name was added before
+        """
+        if name in self.masks:
+            raise AssertionError("Multiple masks for {}".format(name))
+        mask = np.ascontiguousarray(mask, dtype=np.uint8)
+        if self._f is None or (self._size and self._size + mask.nbytes > self.shard_bytes):
+            self._next_shard()
+        self._f.write(mask.tobytes())
+        self.masks[name] = [len(self.shards) - 1, self._size] + list(mask.shape)
+        self._size += mask.nbytes
+
+    def _next_shard(self):
+        if self._f is not None:
+            self._f.close()
+        self.shards.append(_SHARD.format(len(self.shards)))
+        self._f = open(self.root / self.shards[-1], "wb")
+        self._size = 0
+
+    def close(self):
+        """Close the last shard and write the index."""
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        index = {
+            "version": SHARD_VERSION,
+            "dtype": "uint8",
+            "palette": self.palette,
+            "shards": self.shards,
+            "masks": self.masks,
+        }
+        tmp = self.root / (_INDEX + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, self.root / _INDEX)
+
+
+class MaskShards(Mapping):
+    """
+    Read-only mapping of image file names to masks stored in shards.
+
+    Masks are memory-mapped views of their shard, nothing is read until
+    they are accessed.
+
+    Args:
+        root (str): Directory of the shards
+
+    Raises:
+        AssertionError: if the index was written by an incompatible version
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        with open(self.root / _INDEX) as f:
+            index = json.load(f)
+        if index.get("version") != SHARD_VERSION:
+            raise AssertionError("Unsupported mask shard version {}".format(index.get("version")))
+        self.shards = index["shards"]
+        self.masks = index["masks"]
+        self.palette = None if index["palette"] is None else np.array(index["palette"])
+        self._maps = {}
+
+    def __getitem__(self, name):
+        shard, offset, h, w = self.masks[name]
+        if h * w == 0:
+            return np.zeros((h, w), dtype=np.uint8)
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(self.root / self.shards[shard], dtype=np.uint8, mode="r")
+        return self._maps[shard][offset : offset + h * w].reshape(h, w)
+
+    def __iter__(self):
+        return iter(self.masks)
+
+    def __len__(self):
+        return len(self.masks)
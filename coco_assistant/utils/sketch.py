@@ -0,0 +1,407 @@
+from collections import Counter
+
+import numpy as np
+
+# Default bins: COCO object sizes and bounding box aspect ratios (width / height)
+AREA_EDGES = (0, 32**2, 96**2, 1e5**2)
+AREA_LABELS = ("small", "medium", "large")
+ASPECT_EDGES = (0, 1 / 4, 1 / 3, 1 / 2, 2 / 3, 1, 3 / 2, 2, 3, 4, np.inf)
+
+
+def bin_labels(edges):
+    """
+    Default names of the bins between consecutive edges.
+
+    Args:
+        edges (list[float]): Increasing bin edges
+
+    Returns:
+        list[str]: "<min>-<max>" for every bin
+    """
+    return ["{:g}-{:g}".format(lo, hi) for lo, hi in zip(edges[:-1], edges[1:])]
+
+
+def bin_index(values, edges):
+    """
+    Bin of every value.
+
+    Bin i holds the values in `[edges[i], edges[i + 1])`. Values outside of
+    all bins, or NaN, go to bin `len(edges) - 1`.
+
+    Args:
+        values (np.ndarray): Values to bin
+        edges (np.ndarray): Increasing bin edges
+
+    Returns:
+        np.ndarray: Bin of every value
+    """
+    n = len(edges) - 1
+    idx = np.searchsorted(edges, values, side="right") - 1
+    idx[(idx < 0) | (idx >= n) | np.isnan(values)] = n
+    return idx
+
+
+def check_bins(edges, labels=None):
+    """
+    Validate bin edges and labels.
+
+    Args:
+        edges (list[float]): Bin edges
+        labels (list[str], optional): Name of every bin. Defaults to `bin_labels(edges)`.
+
+    Raises:
+        AssertionError: if the edges are not increasing or the labels do not match the bins
+
+    Returns:
+        tuple: Edges as an array and the list of labels
+    """
+    edges = np.asarray(edges, dtype=float)
+    if len(edges) < 2 or (np.diff(edges) <= 0).any():
+        raise AssertionError("Bin edges must be increasing")
+    labels = list(labels) if labels is not None else bin_labels(edges.tolist())
+    if len(labels) != len(edges) - 1:
+        raise AssertionError("Expected {} bin labels, got {}".format(len(edges) - 1, len(labels)))
+    return edges, labels
+
+
+class QuantileSketch:
+    """
+    Mergeable sketch of a distribution of non-negative values.
+
+    Positive values are counted in logarithmic buckets, `(gamma^(k-1), gamma^k]`
+    with `gamma = (1 + alpha) / (1 - alpha)`, so every quantile is answered
+    with a relative error of at most `alpha`, whatever the number of values.
+    Values up to 0 are counted as 0. Sketches with the same `alpha` merge
+    exactly, as if all values had been added to one of them.
+
+    Args:
+        alpha (float, optional): Relative accuracy of the quantiles. Defaults to 0.01.
+    """
+
+    def __init__(self, alpha=0.01):
+        if not 0 < alpha < 1:
+            raise AssertionError("Sketch accuracy must be between 0 and 1")
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.buckets = Counter()
+        self.zeros = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def update(self, values):
+        """
+        Add values to the sketch. NaN values are skipped.
+
+        Args:
+            values (np.ndarray): Values to add
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        values = np.maximum(values, 0)
+        lo, hi = float(values.min()), float(values.max())
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+        self.count += len(values)
+
+        pos = values[values > 0]
+        self.zeros += len(values) - len(pos)
+        keys, counts = np.unique(
+            np.ceil(np.log(pos) / np.log(self.gamma)).astype(np.int64), return_counts=True
+        )
+        self.buckets.update(dict(zip(keys.tolist(), counts.tolist())))
+
+    def merge(self, other):
+        """
+        Add the values of another sketch to this one.
+
+        Args:
+            other (QuantileSketch): Sketch with the same accuracy
+
+        Raises:
+            AssertionError: if the sketches have different accuracies
+
+        Returns:
+            QuantileSketch: This sketch
+        """
+        if other.alpha != self.alpha:
+            raise AssertionError("Cannot merge sketches of different accuracies")
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        self.count += other.count
+        self.zeros += other.zeros
+        self.buckets.update(other.buckets)
+        return self
+
+    def quantile(self, q):
+        """
+        Approximate quantile of the values.
+
+        Args:
+            q (float): Quantile, between 0 and 1
+
+        Returns:
+            float: Value of rank `q * (count - 1)`, within a relative error of `alpha`.
+                None if the sketch is empty.
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0.0
+        seen = self.zeros
+        for k in sorted(self.buckets):
+            seen += self.buckets[k]
+            if seen > rank:
+                # Midpoint of the bucket, in relative terms
+                value = 2 * self.gamma**k / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        """dict: Json serialisable state of the sketch."""
+        return {
+            "alpha": self.alpha,
+            "count": self.count,
+            "zeros": self.zeros,
+            "min": self.min,
+            "max": self.max,
+            "buckets": sorted(self.buckets.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Rebuild a sketch from `to_dict`.
+
+        Args:
+            state (dict): State of the sketch
+
+        Returns:
+            QuantileSketch: The sketch
+        """
+        sketch = cls(state["alpha"])
+        sketch.count, sketch.zeros = state["count"], state["zeros"]
+        sketch.min, sketch.max = state["min"], state["max"]
+        sketch.buckets = Counter({k: c for k, c in state["buckets"]})
+        return sketch
+
+
+class StatsSketch:
+    """
+    Mergeable accumulator of dataset statistics.
+
+    Annotations (and images) are added chunk by chunk, and sketches of
+    different parts of a dataset, e.g. shards processed on different
+    machines, are combined with `merge`. It keeps
+
+    - the number of instances per category,
+    - histograms of object areas and bounding box aspect ratios,
+    - quantile sketches of bounding box widths and heights,
+    - the number of annotations of every image.
+
+    All of them are exact except for the width and height quantiles, which
+    are within a relative error of `alpha`. Memory grows with the number of
+    images, not with the number of annotations.
+
+    Args:
+        area_edges (list[float], optional): Increasing area bin edges. Defaults to the
+            COCO small, medium and large object sizes.
+        area_labels (list[str], optional): Name of every area bin. Defaults to "small",
+            "medium" and "large" for the default edges, "<min>-<max>" otherwise.
+        aspect_edges (list[float], optional): Increasing aspect ratio bin edges.
+            Defaults to `ASPECT_EDGES`.
+        alpha (float, optional): Relative accuracy of the quantiles. Defaults to 0.01.
+    """
+
+    def __init__(self, area_edges=None, area_labels=None, aspect_edges=None, alpha=0.01):
+        if area_edges is None:
+            area_edges = AREA_EDGES
+            area_labels = AREA_LABELS if area_labels is None else area_labels
+        self.area_edges, self.area_labels = check_bins(area_edges, area_labels)
+        self.aspect_edges, self.aspect_labels = check_bins(
+            aspect_edges if aspect_edges is not None else ASPECT_EDGES, None
+        )
+
+        self.categories = {}
+        self.category_counts = Counter()
+        # One extra bin for the values outside of all bins
+        self.areas = np.zeros(len(self.area_edges), dtype=np.int64)
+        self.aspects = np.zeros(len(self.aspect_edges), dtype=np.int64)
+        self.widths = QuantileSketch(alpha)
+        self.heights = QuantileSketch(alpha)
+        self.image_annotations = Counter()
+
+    def __len__(self):
+        return int(self.areas.sum())
+
+    def update_categories(self, categories):
+        """
+        Add category records, used to name the counted category ids.
+
+        Args:
+            categories (list[dict]): Category records
+        """
+        for c in categories:
+            self.categories.setdefault(c["id"], c["name"])
+
+    def update_images(self, image_ids):
+        """
+        Add images, so images without annotations are counted as well.
+
+        Args:
+            image_ids (list): Image ids
+        """
+        for i in np.unique(np.asarray(image_ids)).tolist():
+            self.image_annotations.setdefault(i, 0)
+
+    def update(self, anns):
+        """
+        Add a chunk of annotation records.
+
+        Args:
+            anns (list[dict]): Annotation records
+        """
+        n = len(anns)
+        self.update_columns(
+            np.array([a.get("category_id", -1) for a in anns]),
+            np.fromiter((a.get("area", np.nan) for a in anns), float, n),
+            np.array([a.get("bbox", (np.nan,) * 4) for a in anns], dtype=float).reshape(n, 4),
+            np.array([a["image_id"] for a in anns]),
+        )
+
+    def update_columns(self, category_ids, areas, bboxes, image_ids):
+        """
+        Add annotations given as columns.
+
+        Args:
+            category_ids (np.ndarray): Category id of every annotation
+            areas (np.ndarray): Area of every annotation
+            bboxes (np.ndarray): Nx4 bounding boxes (x, y, width, height)
+            image_ids (np.ndarray): Image id of every annotation
+        """
+        if len(areas) == 0:
+            return
+        for column, counter in (
+            (category_ids, self.category_counts),
+            (image_ids, self.image_annotations),
+        ):
+            keys, counts = np.unique(column, return_counts=True)
+            counter.update(dict(zip(keys.tolist(), counts.tolist())))
+
+        w, h = bboxes[:, 2], bboxes[:, 3]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            aspects = w / h
+        self.areas += np.bincount(bin_index(areas, self.area_edges), minlength=len(self.areas))
+        self.aspects += np.bincount(
+            bin_index(aspects, self.aspect_edges), minlength=len(self.aspects)
+        )
+        self.widths.update(w)
+        self.heights.update(h)
+
+    def merge(self, other):
+        """
+        Add the statistics of another sketch to this one.
+
+        Images present in both sketches have their annotations added up.
+
+        Args:
+            other (StatsSketch): Sketch with the same bins and accuracy
+
+        Raises:
+            AssertionError: if the sketches have different bins
+
+        Returns:
+            StatsSketch: This sketch
+        """
+        if not (
+            np.array_equal(self.area_edges, other.area_edges)
+            and np.array_equal(self.aspect_edges, other.aspect_edges)
+        ):
+            raise AssertionError("Cannot merge sketches with different bins")
+        for k, name in other.categories.items():
+            self.categories.setdefault(k, name)
+        self.category_counts.update(other.category_counts)
+        self.areas += other.areas
+        self.aspects += other.aspects
+        self.widths.merge(other.widths)
+        self.heights.merge(other.heights)
+        # Images without annotations are carried over as well
+        self.image_annotations.update(other.image_annotations)
+        return self
+
+    def result(self, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        """
+        Summary of the statistics.
+
+        Args:
+            quantiles (list[float], optional): Quantiles of the box widths and heights.
+                Defaults to (0.05, 0.25, 0.5, 0.75, 0.95).
+
+        Returns:
+            dict: Number of "annotations" and "images", instances per category ("cat", most
+                frequent first), "area" and "aspect" histograms (with an "ignored" bin),
+                "width" and "height" quantiles and "annotations_per_image", a histogram of
+                the number of annotations per image.
+        """
+        per_image = Counter(self.image_annotations.values())
+        return {
+            "annotations": len(self),
+            "images": len(self.image_annotations),
+            "cat": {
+                self.categories.get(k, str(k)): v for k, v in self.category_counts.most_common()
+            },
+            "area": dict(zip(self.area_labels + ["ignored"], self.areas.tolist())),
+            "aspect": dict(zip(self.aspect_labels + ["ignored"], self.aspects.tolist())),
+            "width": {q: self.widths.quantile(q) for q in quantiles},
+            "height": {q: self.heights.quantile(q) for q in quantiles},
+            "annotations_per_image": dict(sorted(per_image.items())),
+        }
+
+    def to_dict(self):
+        """dict: Json serialisable state of the sketch, to combine sketches across machines."""
+        return {
+            "area_edges": self.area_edges.tolist(),
+            "area_labels": self.area_labels,
+            # Json has no infinity, the last aspect edge may be one
+            "aspect_edges": [str(e) for e in self.aspect_edges.tolist()],
+            "categories": sorted(self.categories.items()),
+            "category_counts": sorted(self.category_counts.items()),
+            "areas": self.areas.tolist(),
+            "aspects": self.aspects.tolist(),
+            "widths": self.widths.to_dict(),
+            "heights": self.heights.to_dict(),
+            "image_annotations": list(self.image_annotations.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Rebuild a sketch from `to_dict`.
+
+        Args:
+            state (dict): State of the sketch
+
+        Returns:
+            StatsSketch: The sketch
+        """
+        sketch = cls(
+            state["area_edges"],
+            state["area_labels"],
+            [float(e) for e in state["aspect_edges"]],
+            state["widths"]["alpha"],
+        )
+        sketch.categories = {k: name for k, name in state["categories"]}
+        sketch.category_counts = Counter({k: c for k, c in state["category_counts"]})
+        sketch.areas = np.array(state["areas"], dtype=np.int64)
+        sketch.aspects = np.array(state["aspects"], dtype=np.int64)
+        sketch.widths = QuantileSketch.from_dict(state["widths"])
+        sketch.heights = QuantileSketch.from_dict(state["heights"])
+        sketch.image_annotations = Counter({i: n for i, n in state["image_annotations"]})
+        return sketch
@@ -0,0 +1,325 @@
+import json
+import re
+
+from . import jsonio
+
+_WS = re.compile(r"[ \t\n\r]*")
+_DECODER = json.JSONDecoder()
+_RECORD_SECTIONS = ("images", "annotations")
+
+
+class _TextBuffer:
+    """Sliding window over a text file for incremental json decoding."""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        # Read at least as much as is already buffered, so values larger than
+        # the chunk size are re-decoded a logarithmic number of times only
+        data = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos :] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non whitespace character, or an empty string at the end of the file."""
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            name = getattr(self.f, "name", "annotation file")
+            raise ValueError("Expected one of {!r} in {}, got {!r}".format(chars, name, c))
+        self.pos += 1
+        return c
+
+    def skip(self, char):
+        if self.peek() == char:
+            self.pos += 1
+
+    def decode(self):
+        """Decode the next json value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                # A number ending exactly at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            self._fill()
+
+
+class AnnStream:
+    """
+    Streaming reader of a COCO annotation file.
+
+    Images and annotations are decoded incrementally and handed out in chunks
+    of records, so memory use is bounded by the chunk size instead of the size
+    of the file. Every call to `images` or `annotations` reads the file again
+    from the start, skipping over the sections it is not interested in.
+
+    The small top level sections (categories, info, licenses, ...) along with
+    record counts and ids are collected by a single pass over the whole file
+    the first time they are requested.
+
+    Args:
+        path (str): Path to annotation file, which may be compressed (see `jsonio`)
+        chunk (int, optional): Number of records per chunk. Defaults to 10000.
+        chunk_size (int, optional): Number of characters read from the file at a time.
+            Defaults to 4M.
+    """
+
+    def __init__(self, path, chunk=10000, chunk_size=1 << 22):
+        self.path = path
+        self.chunk = chunk
+        self.chunk_size = chunk_size
+
+        self._meta = None
+        self._keys = None
+        self._summary = None
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, str(self.path))
+
+    def _walk(self, section=None, chunk=None):
+        """
+        Walk the top level object of the file.
+
+        Args:
+            section (str, optional): Record section whose records are yielded in chunks.
+                The walk stops once that section has been read. If None, the whole file
+                is walked and its small sections and record statistics are stored.
+            chunk (int, optional): Records per chunk. Defaults to `self.chunk`.
+
+        Yields:
+            list[dict]: Chunks of records of `section`
+        """
+        chunk = chunk or self.chunk
+        meta, keys, summary = {}, [], {}
+        with jsonio.open_json(self.path, "rt") as f:
+            buf = _TextBuffer(f, self.chunk_size)
+            buf.expect("{")
+            while buf.peek() != "}":
+                key = buf.decode()
+                buf.expect(":")
+                keys.append(key)
+                if key in _RECORD_SECTIONS and buf.peek() == "[":
+                    buf.expect("[")
+                    records, n, last_id, max_id = [], 0, None, None
+                    while buf.peek() != "]":
+                        record = buf.decode()
+                        n += 1
+                        if key == section:
+                            records.append(record)
+                            if len(records) == chunk:
+                                yield records
+                                records = []
+                        elif section is None:
+                            last_id = record.get("id")
+                            try:
+                                max_id = last_id if max_id is None else max(max_id, last_id)
+                            except TypeError:
+                                # Mixed id types cannot be ordered
+                                max_id = None
+                        buf.skip(",")
+                    buf.expect("]")
+                    if key == section:
+                        if records:
+                            yield records
+                        return
+                    summary[key] = {"count": n, "last_id": last_id, "max_id": max_id}
+                else:
+                    meta[key] = buf.decode()
+                buf.skip(",")
+            buf.expect("}")
+
+        if section is None:
+            self._meta, self._keys, self._summary = meta, keys, summary
+
+    def images(self, chunk=None):
+        """
+        Iterate over the image records of the file.
+
+        Args:
+            chunk (int, optional): Records per chunk. Defaults to `self.chunk`.
+
+        Yields:
+            list[dict]: Chunks of image records
+        """
+        return self._walk("images", chunk)
+
+    def annotations(self, chunk=None):
+        """
+        Iterate over the annotation records of the file.
+
+        Args:
+            chunk (int, optional): Records per chunk. Defaults to `self.chunk`.
+
+        Yields:
+            list[dict]: Chunks of annotation records
+        """
+        return self._walk("annotations", chunk)
+
+    def _scan(self):
+        if self._meta is None:
+            for _ in self._walk():
+                pass
+
+    def meta(self):
+        """
+        Top level sections other than images and annotations.
+
+        Returns:
+            dict: Sections in file order
+        """
+        self._scan()
+        return self._meta
+
+    def keys(self):
+        """
+        Top level keys of the file.
+
+        Returns:
+            list[str]: Keys in file order
+        """
+        self._scan()
+        return self._keys
+
+    def summary(self, section):
+        """
+        Statistics of a record section.
+
+        Args:
+            section (str): "images" or "annotations"
+
+        Returns:
+            dict: Number of records ("count") and id of the last record ("last_id")
+                and the largest id ("max_id"), None if the section is missing or empty.
+        """
+        self._scan()
+        return self._summary.get(section, {"count": 0, "last_id": None, "max_id": None})
+
+    @property
+    def categories(self):
+        """list[dict]: Category records."""
+        return self.meta().get("categories", [])
+
+    def image_ids(self):
+        """
+        Ids of all images.
+
+        Returns:
+            list: Image ids in file order
+        """
+        return [img["id"] for c in self.images() for img in c]
+
+
+class JsonWriter:
+    """
+    Write a json object to a file one top level section at a time.
+
+    Record sections are written chunk by chunk. The output is compact utf-8
+    json (see `jsonio`), compressed if the path ends in `.gz` or `.zst`.
+
+    Args:
+        path (str): Path of the output file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+        self._pos = 0
+        self._first_key = True
+        self._first_record = True
+
+    def __enter__(self):
+        self._f = jsonio.open_json(self.path, "wb")
+        self._write(b"{")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._write(b"}")
+        self._f.close()
+
+    def _write(self, data):
+        self._f.write(data)
+        self._pos += len(data)
+
+    def _key(self, key):
+        if not self._first_key:
+            self._write(b",")
+        self._first_key = False
+        self._write(jsonio.dumps(key) + b":")
+
+    def write(self, key, value):
+        """Write a complete section."""
+        self._key(key)
+        self._write(jsonio.dumps(value))
+
+    def begin(self, key):
+        """Start a record section."""
+        self._key(key)
+        self._write(b"[")
+        self._first_record = True
+
+    def extend(self, records):
+        """Append records to the current record section."""
+        if not records:
+            return
+        if not self._first_record:
+            self._write(b",")
+        # Encoding the chunk as a whole is much cheaper than record by record
+        self._write(jsonio.dumps(records)[1:-1])
+        self._first_record = False
+
+    def copy(self, src, start, stop):
+        """
+        Append records copied verbatim from another file written by a JsonWriter.
+
+        Args:
+            src (file): File opened with `jsonio.open_json`, in binary mode
+            start (int): Offset of the first record, as returned by `tell`
+            stop (int): Offset just past the last record
+        """
+        if start == stop:
+            return
+        if not self._first_record:
+            self._write(b",")
+        src.seek(start)
+        remaining = stop - start
+        while remaining:
+            data = src.read(min(remaining, 1 << 22))
+            if not data:
+                raise ValueError("Unexpected end of {}".format(getattr(src, "name", src)))
+            self._write(data)
+            remaining -= len(data)
+        self._first_record = False
+
+    def tell(self):
+        """int: Offset of the end of the (uncompressed) output written so far."""
+        return self._pos
+
+    def end(self):
+        """Finish the current record section."""
+        self._write(b"]")
@@ -0,0 +1,570 @@
+import copy
+import json
+
+import numpy as np
+from pycocotools import mask as maskUtils
+from pycocotools.coco import COCO
+
+from . import jsonio
+from .stream import _DECODER, _RECORD_SECTIONS, _WS
+
+_NOBOX = (np.nan, np.nan, np.nan, np.nan)
+
+
+def _int_column(values):
+    col = np.asarray(values) if values else np.zeros(0, dtype=np.int64)
+    if col.dtype.kind not in "iu":
+        raise ValueError("Only integer ids can be stored in an AnnTable")
+    return col.astype(np.int64, copy=False)
+
+
+def _scan(text):
+    """
+    Parse annotation json text, keeping the raw text of every image and annotation.
+
+    The records are decoded one at a time with `raw_decode`, which reports where
+    each of them ends, so their original text can be kept without encoding them again.
+
+    Args:
+        text (str): Annotation json
+
+    Returns:
+        tuple:
+        - dataset (dict): Parsed annotation json
+        - raw (dict): Mapping of "images" and "annotations" to the raw text of their records
+    """
+    ws = _WS.match
+    decode = _DECODER.raw_decode
+
+    dataset, raw = {}, {}
+    try:
+        idx = ws(text).end()
+        if text[idx : idx + 1] != "{":
+            raise ValueError("Annotation json must be an object")
+        idx = ws(text, idx + 1).end()
+        while text[idx] != "}":
+            key, idx = decode(text, idx)
+            idx = ws(text, ws(text, idx).end() + 1).end()  # skip ':'
+            if key in _RECORD_SECTIONS and text[idx] == "[":
+                records, parts = [], []
+                idx = ws(text, idx + 1).end()
+                while text[idx] != "]":
+                    record, end = decode(text, idx)
+                    records.append(record)
+                    parts.append(text[idx:end])
+                    idx = ws(text, end).end()
+                    if text[idx] == ",":
+                        idx = ws(text, idx + 1).end()
+                dataset[key], raw[key] = records, parts
+                idx += 1
+            else:
+                dataset[key], idx = decode(text, idx)
+            idx = ws(text, idx).end()
+            if text[idx] == ",":
+                idx = ws(text, idx + 1).end()
+    except IndexError:
+        raise ValueError("Unexpected end of annotation json")
+    return dataset, raw
+
+
+def polygon_vertices(segmentation):
+    """
+    Number of vertices of a polygon segmentation.
+
+    Args:
+        segmentation (list or dict): Segmentation of an annotation
+
+    Returns:
+        int: Vertices of all its polygons, -1 if it is not a polygon segmentation (e.g. RLE)
+    """
+    if isinstance(segmentation, list):
+        return sum(len(p) for p in segmentation) // 2
+    return -1
+
+
+def _pack(parts):
+    """
+    Join raw json records into a single json array held in a byte buffer.
+
+    Record i can be decoded on its own from `blob[offsets[i]:offsets[i + 1] - 1]`,
+    while the whole buffer decodes to the full list with a single `json.loads`.
+
+    Args:
+        parts (list[str]): Json text of every record
+
+    Returns:
+        tuple:
+        - blob (np.ndarray): uint8 buffer holding the json array
+        - offsets (np.ndarray): Start offset of every record plus a final end offset
+    """
+    data = ",".join(parts).encode()
+    if len(data) == sum(map(len, parts)) + max(len(parts) - 1, 0):
+        lengths = map(len, parts)
+    else:
+        # Non ascii characters, offsets have to be counted in bytes
+        lengths = (len(p.encode()) for p in parts)
+    offsets = np.ones(len(parts) + 1, dtype=np.int64)
+    offsets[1:] += np.cumsum(np.fromiter((n + 1 for n in lengths), np.int64, len(parts)))
+    blob = np.frombuffer(b"[" + data + b"]", dtype=np.uint8)
+    return blob, offsets
+
+
+def _unpack(blob, offsets=None, rows=None):
+    if rows is None:
+        return jsonio.loads(blob.tobytes())
+    if isinstance(rows, range) and rows.step == 1:
+        # Consecutive records are stored back to back, decode them in one go
+        if not rows:
+            return []
+        span = blob[offsets[rows.start] : offsets[rows.stop] - 1].tobytes()
+        return jsonio.loads(b"[" + span + b"]")
+    buf = memoryview(blob)
+    return jsonio.loads(b"[" + b",".join(buf[offsets[i] : offsets[i + 1] - 1] for i in rows) + b"]")
+
+
+def _as_list(x):
+    return x if hasattr(x, "__iter__") and hasattr(x, "__len__") else [x]
+
+
+def _ranges(starts, lengths):
+    """Concatenation of `range(s, s + n)` for every start s and length n."""
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return shifts + np.arange(total)
+
+
+class GroupIndex:
+    """
+    Compressed sparse row index grouping table rows by a key column.
+
+    Rows with key `keys[i]` are `order[indptr[i]:indptr[i + 1]]`, in their
+    original order.
+
+    Args:
+        column (np.ndarray): Key of every row
+    """
+
+    def __init__(self, column):
+        self.order = np.argsort(column, kind="stable")
+        skeys = column[self.order]
+        starts = np.flatnonzero(np.r_[True, skeys[1:] != skeys[:-1]]) if len(skeys) else []
+        self.keys = skeys[starts]
+        self.indptr = np.append(starts, len(skeys)).astype(np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def positions(self, keys):
+        """
+        Position of each key in `self.keys`.
+
+        Args:
+            keys (list): Keys to look up
+
+        Returns:
+            np.ndarray: Positions, -1 for keys that are not present
+        """
+        keys = np.asarray(keys, dtype=self.keys.dtype)
+        pos = np.searchsorted(self.keys, keys)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == keys[found]
+        return np.where(found, pos, -1)
+
+    def counts(self):
+        """np.ndarray: Number of rows of every key."""
+        return np.diff(self.indptr)
+
+    def rows(self, keys):
+        """
+        Rows belonging to the given keys, grouped in the order of `keys`.
+
+        Args:
+            keys (list): Keys to look up. Unknown keys are ignored.
+
+        Returns:
+            np.ndarray: Row numbers
+        """
+        pos = self.positions(keys)
+        pos = pos[pos >= 0]
+        starts = self.indptr[pos]
+        return self.order[_ranges(starts, self.indptr[pos + 1] - starts)]
+
+    def last(self, keys):
+        """
+        Last row of every key, as a dict keyed on the key would store it.
+
+        Args:
+            keys (list): Keys to look up
+
+        Raises:
+            KeyError: if a key is not present
+
+        Returns:
+            np.ndarray: Row numbers
+        """
+        pos = self.positions(keys)
+        if (pos < 0).any():
+            raise KeyError(np.asarray(keys)[pos < 0][0].item())
+        return self.order[self.indptr[pos + 1] - 1]
+
+
+class AnnTable:
+    """
+    Column oriented copy of a COCO annotation file.
+
+    The fields that operations scan over (ids, image ids, category ids,
+    boxes, areas, crowd flags and polygon vertex counts) are held as NumPy
+    arrays, one entry per annotation. The complete image and annotation
+    records are kept as serialised json in a single byte buffer each, so an
+    AnnTable is cheap to pickle or write to disk and still reproduces the
+    original dataset exactly.
+    Small sections (categories, info, licenses, ...) are kept as they are.
+
+    Args:
+        arrays (dict): Mapping of array name (see `ARRAYS`) to array
+        meta (dict): Top level sections other than images and annotations
+        keys (list[str]): Top level keys in their original order
+    """
+
+    ARRAYS = (
+        "ann_ids",
+        "image_ids",
+        "category_ids",
+        "bboxes",
+        "areas",
+        "iscrowd",
+        "nverts",
+        "ann_offsets",
+        "ann_blob",
+        "img_ids",
+        "img_widths",
+        "img_heights",
+        "img_offsets",
+        "img_blob",
+    )
+
+    def __init__(self, arrays, meta, keys):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.meta = meta
+        self.keys = list(keys)
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self.ann_ids)
+
+    def __repr__(self):
+        return "{}(images={}, annotations={}, categories={})".format(
+            type(self).__name__, len(self.img_ids), len(self), len(self.categories)
+        )
+
+    @classmethod
+    def from_dataset(cls, dataset, raw=None):
+        """
+        Build a table from a parsed annotation file.
+
+        Args:
+            dataset (dict): Parsed COCO annotation json
+            raw (dict, optional): Raw json text of the image and annotation records,
+                as returned by `_scan`. Records are serialised again if not given.
+
+        Raises:
+            ValueError: if image or annotation ids are not integers
+
+        Returns:
+            AnnTable: Column oriented copy of the dataset
+        """
+        anns = dataset.get("annotations", [])
+        imgs = dataset.get("images", [])
+        n = len(anns)
+
+        arrays = {
+            "ann_ids": _int_column([a["id"] for a in anns]),
+            "image_ids": _int_column([a["image_id"] for a in anns]),
+            "category_ids": _int_column([a.get("category_id", -1) for a in anns]),
+            "bboxes": np.array([a.get("bbox", _NOBOX) for a in anns], np.float64).reshape(n, 4),
+            "areas": np.fromiter((a.get("area", np.nan) for a in anns), np.float64, n),
+            "iscrowd": np.fromiter((a.get("iscrowd", 0) for a in anns), np.uint8, n),
+            "nverts": np.fromiter(
+                (polygon_vertices(a.get("segmentation")) for a in anns), np.int64, n
+            ),
+            "img_ids": _int_column([i["id"] for i in imgs]),
+            "img_widths": _int_column([i.get("width", -1) for i in imgs]),
+            "img_heights": _int_column([i.get("height", -1) for i in imgs]),
+        }
+        if raw is None:
+            encode = json.JSONEncoder(separators=(",", ":")).encode
+            raw = {k: [encode(r) for r in dataset.get(k, [])] for k in _RECORD_SECTIONS}
+        arrays["ann_blob"], arrays["ann_offsets"] = _pack(raw.get("annotations", []))
+        arrays["img_blob"], arrays["img_offsets"] = _pack(raw.get("images", []))
+
+        meta = {k: v for k, v in dataset.items() if k not in ("images", "annotations")}
+        return cls(arrays, meta, dataset.keys())
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Parse annotation json text into a table.
+
+        Args:
+            text (str): Annotation json
+
+        Returns:
+            AnnTable: Column oriented copy of the annotation json
+        """
+        return cls.from_dataset(*_scan(text))
+
+    @classmethod
+    def from_json(cls, path):
+        """
+        Parse an annotation file into a table.
+
+        Args:
+            path (str): Path to annotation file
+
+        Returns:
+            AnnTable: Column oriented copy of the annotation file
+        """
+        return cls.from_text(jsonio.read_text(path))
+
+    @property
+    def categories(self):
+        """list[dict]: Category records."""
+        return self.meta.get("categories", [])
+
+    @property
+    def nbytes(self):
+        """int: Memory held by the arrays of the table."""
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def _index(self, column):
+        if column not in self._indexes:
+            self._indexes[column] = GroupIndex(getattr(self, column))
+        return self._indexes[column]
+
+    @property
+    def ann_index(self):
+        """GroupIndex: Annotation rows by annotation id."""
+        return self._index("ann_ids")
+
+    @property
+    def img_index(self):
+        """GroupIndex: Annotation rows by image id (image -> annotations CSR index)."""
+        return self._index("image_ids")
+
+    @property
+    def cat_index(self):
+        """GroupIndex: Annotation rows by category id (category -> annotations CSR index)."""
+        return self._index("category_ids")
+
+    @property
+    def img_row_index(self):
+        """GroupIndex: Image rows by image id."""
+        return self._index("img_ids")
+
+    def ann_img_rows(self):
+        """
+        Image row of every annotation.
+
+        Returns:
+            np.ndarray: Row of the image of every annotation (the last one if its id is
+                duplicated), -1 if the image is missing
+        """
+        index = self.img_row_index
+        pos = index.positions(self.image_ids)
+        return np.where(pos >= 0, index.order[index.indptr[pos + 1] - 1], -1)
+
+    def anns(self, rows):
+        """
+        Decode annotation records.
+
+        Args:
+            rows (list[int] or range): Annotation rows
+
+        Returns:
+            list[dict]: Annotation records
+        """
+        return _unpack(self.ann_blob, self.ann_offsets, rows)
+
+    def imgs(self, rows):
+        """
+        Decode image records.
+
+        Args:
+            rows (list[int] or range): Image rows
+
+        Returns:
+            list[dict]: Image records
+        """
+        return _unpack(self.img_blob, self.img_offsets, rows)
+
+    def to_dataset(self):
+        """
+        Rebuild the annotation json this table was created from.
+
+        Returns:
+            dict: Annotation json with freshly decoded records
+        """
+        dataset = {}
+        for key in self.keys:
+            if key == "images":
+                dataset[key] = _unpack(self.img_blob)
+            elif key == "annotations":
+                dataset[key] = _unpack(self.ann_blob)
+            else:
+                dataset[key] = copy.deepcopy(self.meta[key])
+        return dataset
+
+
+class TableCOCO(COCO):
+    """
+    pycocotools COCO view of an AnnTable.
+
+    The lookups used by this package (getAnnIds, getCatIds, getImgIds,
+    loadAnns, loadCats, loadImgs and annToRLE) are answered from the columns
+    and indexes of the table. Records returned by the load methods are
+    decoded on demand, so they are fresh copies on every call.
+
+    The dict based members of COCO (`dataset`, `anns`, `imgs`, `cats`,
+    `imgToAnns` and `catToImgs`) are only built, by decoding the whole
+    dataset, when they are first accessed. From then on all lookups use
+    them, so changes made to those dicts stay visible.
+
+    Args:
+        table (AnnTable): Table to view
+    """
+
+    _DICT_MEMBERS = ("dataset", "anns", "imgs", "cats", "imgToAnns", "catToImgs")
+
+    def __init__(self, table):
+        self.table = table
+
+    def __getattr__(self, name):
+        # Only called for members that have not been set yet
+        if name not in self._DICT_MEMBERS:
+            raise AttributeError(name)
+        self.dataset = self.table.to_dataset()
+        self.createIndex()
+        return getattr(self, name)
+
+    @property
+    def materialized(self):
+        """bool: True once the dict based members have been built."""
+        return "dataset" in self.__dict__
+
+    def getAnnIds(self, imgIds=[], catIds=[], areaRng=[], iscrowd=None):
+        if self.materialized:
+            return super().getAnnIds(imgIds, catIds, areaRng, iscrowd)
+        t = self.table
+        imgIds, catIds = _as_list(imgIds), _as_list(catIds)
+
+        if len(imgIds) != 0:
+            rows = t.img_index.rows(imgIds)
+            if len(catIds) != 0:
+                rows = rows[np.isin(t.category_ids[rows], catIds)]
+        elif len(catIds) != 0:
+            rows = np.sort(t.cat_index.rows(np.unique(catIds)))
+        else:
+            rows = np.arange(len(t))
+        if len(areaRng) != 0:
+            areas = t.areas[rows]
+            rows = rows[(areas > areaRng[0]) & (areas < areaRng[1])]
+        if iscrowd is not None:
+            rows = rows[t.iscrowd[rows] == iscrowd]
+        return t.ann_ids[rows].tolist()
+
+    def getCatIds(self, catNms=[], supNms=[], catIds=[]):
+        if self.materialized:
+            return super().getCatIds(catNms, supNms, catIds)
+        catNms, supNms, catIds = _as_list(catNms), _as_list(supNms), _as_list(catIds)
+
+        cats = self.table.categories
+        cats = cats if len(catNms) == 0 else [c for c in cats if c["name"] in catNms]
+        cats = cats if len(supNms) == 0 else [c for c in cats if c["supercategory"] in supNms]
+        cats = cats if len(catIds) == 0 else [c for c in cats if c["id"] in catIds]
+        return [c["id"] for c in cats]
+
+    def getImgIds(self, imgIds=[], catIds=[]):
+        if self.materialized:
+            return super().getImgIds(imgIds, catIds)
+        t = self.table
+        imgIds, catIds = _as_list(imgIds), _as_list(catIds)
+
+        if len(imgIds) == len(catIds) == 0:
+            ids = t.img_ids
+            if len(t.img_row_index) != len(ids):
+                # Duplicated ids, keep the first occurrence like a dict would
+                ids = ids[np.sort(np.unique(ids, return_index=True)[1])]
+            return ids.tolist()
+
+        ids = set(imgIds)
+        for i, catId in enumerate(catIds):
+            cat_imgs = set(t.image_ids[t.cat_index.rows([catId])].tolist())
+            if i == 0 and len(ids) == 0:
+                ids = cat_imgs
+            else:
+                ids &= cat_imgs
+        return list(ids)
+
+    def loadAnns(self, ids=[]):
+        if self.materialized:
+            return super().loadAnns(ids)
+        if isinstance(ids, (int, np.integer)):
+            ids = [ids]
+        elif not hasattr(ids, "__iter__") or not hasattr(ids, "__len__"):
+            return None
+        return self.table.anns(self.table.ann_index.last(ids))
+
+    def loadCats(self, ids=[]):
+        if self.materialized:
+            return super().loadCats(ids)
+        if isinstance(ids, (int, np.integer)):
+            ids = [ids]
+        elif not hasattr(ids, "__iter__") or not hasattr(ids, "__len__"):
+            return None
+        cats = {c["id"]: c for c in self.table.categories}
+        return [copy.deepcopy(cats[i]) for i in ids]
+
+    def loadImgs(self, ids=[]):
+        if self.materialized:
+            return super().loadImgs(ids)
+        if isinstance(ids, (int, np.integer)):
+            ids = [ids]
+        elif not hasattr(ids, "__iter__") or not hasattr(ids, "__len__"):
+            return None
+        return self.table.imgs(self.table.img_row_index.last(ids))
+
+    def annToRLE(self, ann):
+        if self.materialized:
+            return super().annToRLE(ann)
+        t = self.table
+        row = t.img_row_index.last([ann["image_id"]])[0]
+        h, w = int(t.img_heights[row]), int(t.img_widths[row])
+        segm = ann["segmentation"]
+        if isinstance(segm, list):
+            # polygon -- a single object might consist of multiple parts
+            rle = maskUtils.merge(maskUtils.frPyObjects(segm, h, w))
+        elif isinstance(segm["counts"], list):
+            # uncompressed RLE
+            rle = maskUtils.frPyObjects(segm, h, w)
+        else:
+            rle = segm
+        return rle
+
+
+def get_table(ann):
+    """
+    AnnTable behind a COCO object.
+
+    Args:
+        ann (COCO): COCO object
+
+    Returns:
+        AnnTable: Table viewed by `ann`, or None if `ann` is a plain COCO object
+            or its dict members may have been changed
+    """
+    if isinstance(ann, TableCOCO) and not ann.materialized:
+        return ann.table
+    return None
@@ -1,13 +1,44 @@
+import copy
+import gzip
+import json
+import logging
 import os
+import pickle
 import shutil
 import subprocess
+import sys
+from collections import Counter
 from pathlib import Path
 
+import numpy as np
 import pytest
+from PIL import Image
+from pycocotools import mask as maskUtils
 from pycocotools.coco import COCO
 
 from coco_assistant import COCO_Assistant
-from coco_assistant.utils import CatRemapper
+from coco_assistant import coco_stats as stats
+from coco_assistant import utils
+from coco_assistant.utils import (
+    AnnStream,
+    AnnTable,
+    CatRemapper,
+    COCOSource,
+    DatasetPlan,
+    GroupIndex,
+    MaskShards,
+    ResultCache,
+    StatsSketch,
+    TableCOCO,
+    anchors,
+    jsonio,
+    load_cached_table,
+    load_table,
+    merge_sources,
+)
+from coco_assistant.utils.anchors import box_dims
+from coco_assistant.utils.cache import cache_path
+from coco_assistant.utils.table import polygon_vertices
 
 TESTS_DATA_DIR = "tests/tiny_coco"
 
@@ -46,6 +77,778 @@ def test_merge(get_data):
         raise AssertionError("Failure in merging datasets")
 
 
+def test_merge_sources(get_data):
+    cas = COCO_Assistant(get_data[0], get_data[1], mem_budget=1)
+    merged = cas.res_dir / "merged/annotations/merged.json"
+    cas.merge()
+    with open(merged) as f:
+        expected = f.read()
+
+    # Plain COCO objects, merged in chunks that do not line up with the datasets
+    paths = {name: Path(get_data[1]) / (name + ".json") for name in cas.dh.names}
+    anns = {name: COCO(path) for name, path in paths.items()}
+    plan = merge_sources([COCOSource(anns, name, chunk=3) for name in anns], merged)
+    with open(merged) as f:
+        chunked = f.read()
+
+    # Clean up
+    shutil.rmtree(cas.res_dir)
+    if chunked != expected:
+        raise AssertionError("Chunked merge differs from regular merge")
+    if len(plan.datasets) != len(anns):
+        raise AssertionError("Not all datasets were merged")
+    for name, path in paths.items():
+        with open(path) as f:
+            if anns[name].dataset != json.load(f):
+                raise AssertionError("Merging modified dataset {}".format(name))
+
+
+def test_parallel_merge(get_data):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    merged = cas.res_dir / "merged/annotations/merged.json"
+    cas.merge()
+    with open(merged) as f:
+        expected = f.read()
+    cas.merge(workers=2)
+    with open(merged) as f:
+        parallel = f.read()
+    leftovers = [p.name for p in merged.parent.iterdir() if p.name != "merged.json.manifest"]
+
+    # Clean up
+    shutil.rmtree(cas.res_dir)
+    if parallel != expected:
+        raise AssertionError("Parallel merge differs from sequential merge")
+    if leftovers != ["merged.json"]:
+        raise AssertionError("Parallel merge left files behind: {}".format(leftovers))
+
+
+def test_append_merge(get_data, tmp_path):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    cas.merge()
+    with open(cas.res_dir / "merged/annotations/merged.json") as f:
+        expected = f.read()
+    shutil.rmtree(cas.res_dir)
+
+    # Datasets arriving one at a time
+    img_dir, ann_dir = tmp_path / "images", tmp_path / "annotations"
+    img_dir.mkdir()
+    ann_dir.mkdir()
+    for name in cas.dh.names:
+        (img_dir / name).symlink_to(Path(get_data[0]).resolve() / name)
+        shutil.copy(Path(get_data[1]) / (name + ".json"), ann_dir)
+        inc = COCO_Assistant(img_dir, ann_dir)
+        inc.merge(append=True)
+
+    merged = inc.res_dir / "merged/annotations/merged.json"
+    with open(merged) as f:
+        appended = f.read()
+    if appended != expected:
+        raise AssertionError("Appending datasets differs from merging them at once")
+
+    merged.write_text(appended.replace("}", "} "))
+    with pytest.raises(AssertionError):
+        inc.merge(append=True)
+
+    # A new dataset sorting before the merged ones
+    img_dir, ann_dir = tmp_path / "sorted" / "images", tmp_path / "sorted" / "annotations"
+    ann_dir.mkdir(parents=True)
+    img_dir.mkdir()
+    for name, src in (("m_old", cas.dh.names[0]), ("a_new", cas.dh.names[1])):
+        (img_dir / name).symlink_to(Path(get_data[0]).resolve() / src)
+        shutil.copy(Path(get_data[1]) / (src + ".json"), ann_dir / (name + ".json"))
+        inc = COCO_Assistant(img_dir, ann_dir)
+        inc.merge(append=True)
+
+    merged = inc.res_dir / "merged/annotations/merged.json"
+    appended = merged.read_text()
+    inc.merge()
+    if appended != merged.read_text():
+        raise AssertionError("Appending a dataset sorting first differs from a full merge")
+
+    # A merged dataset edited before the next one is appended
+    dataset = jsonio.load(ann_dir / "m_old.json")
+    dataset["annotations"] = dataset["annotations"][:-1]
+    (ann_dir / "m_old.json").write_bytes(jsonio.dumps(dataset))
+    if utils.changed_sources(utils.load_manifest(merged)) != ["m_old"]:
+        raise AssertionError("Edited dataset not detected")
+    (img_dir / "z_new").symlink_to(Path(get_data[0]).resolve() / cas.dh.names[1])
+    shutil.copy(Path(get_data[1]) / (cas.dh.names[1] + ".json"), ann_dir / "z_new.json")
+    inc = COCO_Assistant(img_dir, ann_dir)
+    inc.merge(append=True)
+    appended = merged.read_text()
+    inc.merge()
+    if appended != merged.read_text():
+        raise AssertionError("Appending after editing a merged dataset differs from a full merge")
+
+
+def test_compressed_json(get_data, tmp_path):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    cas.merge()
+    expected = jsonio.load(cas.res_dir / "merged/annotations/merged.json")
+    shutil.rmtree(cas.res_dir)
+
+    # Compressed annotation files are read transparently
+    img_dir, ann_dir = tmp_path / "images", tmp_path / "annotations"
+    img_dir.mkdir()
+    ann_dir.mkdir()
+    for name in cas.dh.names:
+        (img_dir / name).symlink_to(Path(get_data[0]).resolve() / name)
+        with open(Path(get_data[1]) / (name + ".json"), "rb") as src:
+            with gzip.open(ann_dir / (name + ".json.gz"), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+    for stream in (False, True):
+        gz = COCO_Assistant(img_dir, ann_dir, stream=stream, compression="gzip")
+        if gz.dh.names != cas.dh.names:
+            raise AssertionError("Compressed annotation files were not found")
+        gz.merge()
+        merged = gz.res_dir / "merged/annotations/merged.json.gz"
+        if jsonio.load(merged) != expected:
+            raise AssertionError("Compressed merge differs from regular merge")
+    with gzip.open(merged) as f:
+        if b": " in f.read(1000):
+            raise AssertionError("Merged annotations are not compact")
+
+    big = {"id": 2**70, "bbox": [0.5, 1e-7]}
+    if jsonio.loads(jsonio.dumps(big)) != big:
+        raise AssertionError("Json round trip failed")
+
+
+def test_batch_cat_removal(get_data):
+    rcats = {"val2017": ["person"], "train2017": ["person", "bottle"]}
+    outputs = []
+    for stream in (False, True):
+        cas = COCO_Assistant(get_data[0], get_data[1], stream=stream)
+        counts = cas.remove_cats(rcats, prune_images=True, compact=True)
+        outputs.append(
+            {name: jsonio.load(cas.res_dir / "removal" / (name + ".json")) for name in rcats}
+        )
+
+    # Plain COCO objects take the record by record path
+    cas.anndict = {name: COCO(Path(get_data[1]) / (name + ".json")) for name in rcats}
+    cas.stream = False
+    cas.remove_cats(rcats, prune_images=True, compact=True)
+    outputs.append(
+        {name: jsonio.load(cas.res_dir / "removal" / (name + ".json")) for name in rcats}
+    )
+
+    # Clean up
+    shutil.rmtree(cas.res_dir)
+    if not outputs[0] == outputs[1] == outputs[2]:
+        raise AssertionError("Category removal differs between table, stream and COCO datasets")
+
+    for name, out in outputs[0].items():
+        orig = COCO(Path(get_data[1]) / (name + ".json"))
+        removed = orig.getCatIds(catNms=rcats[name])
+        kept_anns = [a for a in orig.dataset["annotations"] if a["category_id"] not in removed]
+        emptied = {a["image_id"] for a in orig.dataset["annotations"]} - {
+            a["image_id"] for a in kept_anns
+        }
+        kept_imgs = [i for i in orig.dataset["images"] if i["id"] not in emptied]
+        if counts[name] != {
+            "categories": len(orig.cats) - len(removed),
+            "annotations": len(kept_anns),
+            "images": len(kept_imgs),
+        }:
+            raise AssertionError("Wrong counts for {}".format(name))
+        if sorted(c["id"] for c in out["categories"]) != list(range(1, len(out["categories"]) + 1)):
+            raise AssertionError("Category ids were not compacted")
+        names = {c["id"]: c["name"] for c in out["categories"]}
+        if [names[a["category_id"]] for a in out["annotations"]] != [
+            orig.cats[a["category_id"]]["name"] for a in kept_anns
+        ]:
+            raise AssertionError("Annotations point to the wrong categories")
+        if out["images"] != kept_imgs:
+            raise AssertionError("Wrong images kept")
+
+
+def test_compact_unknown_category(get_data, tmp_path):
+    dataset = jsonio.load(Path(get_data[1]) / "val2017.json")
+    dataset["annotations"][3]["category_id"] = 1000
+    src = tmp_path / "src.json"
+    src.write_bytes(jsonio.dumps(dataset))
+
+    # Kept as is without compaction, a descriptive error with it
+    utils.remove_categories(AnnStream(src), ["person"], tmp_path / "kept.json")
+    kept = {a["id"]: a for a in jsonio.load(tmp_path / "kept.json")["annotations"]}
+    if kept[dataset["annotations"][3]["id"]]["category_id"] != 1000:
+        raise AssertionError("Annotation of an unknown category not kept")
+    with pytest.raises(AssertionError, match="category id 1000"):
+        utils.remove_categories(AnnStream(src), ["person"], tmp_path / "dst.json", compact=True)
+    if (tmp_path / "dst.json").exists():
+        raise AssertionError("Truncated annotation file left behind")
+
+
+def test_query(get_data):
+    filters = {
+        "cats": ["person", "car"],
+        "area": (100, None),
+        "aspect": (0.2, 1.5),
+        "iscrowd": False,
+        "img_width": (None, 640),
+    }
+    orig = COCO(Path(get_data[1]) / "train2017.json")
+    cat_ids = orig.getCatIds(catNms=filters["cats"])
+    expected = [
+        a["id"]
+        for a in orig.dataset["annotations"]
+        if a["category_id"] in cat_ids
+        and a["area"] >= 100
+        and 0.2 <= a["bbox"][2] / a["bbox"][3] <= 1.5
+        and not a["iscrowd"]
+        and orig.imgs[a["image_id"]]["width"] <= 640
+    ]
+    if not expected:
+        raise AssertionError("Query test needs matching annotations")
+
+    outputs = []
+    for stream in (False, True):
+        cas = COCO_Assistant(get_data[0], get_data[1], stream=stream)
+        if cas.query("train2017", save="subset", **filters) != expected:
+            raise AssertionError("Wrong annotations selected")
+        outputs.append(jsonio.load(cas.res_dir / "query/subset.json"))
+
+    # Plain COCO objects are read record by record
+    cas.anndict = {"train2017": orig}
+    cas.stream = False
+    if cas.query("train2017", save="subset", **filters) != expected:
+        raise AssertionError("Wrong annotations selected")
+    outputs.append(jsonio.load(cas.res_dir / "query/subset.json"))
+
+    # Clean up
+    shutil.rmtree(cas.res_dir)
+    if not outputs[0] == outputs[1] == outputs[2]:
+        raise AssertionError("Query output differs between table, stream and COCO datasets")
+    out = outputs[0]
+    if [a["id"] for a in out["annotations"]] != expected:
+        raise AssertionError("Wrong annotations written")
+    img_ids = {a["image_id"] for a in out["annotations"]}
+    if [i for i in orig.dataset["images"] if i["id"] in img_ids] != out["images"]:
+        raise AssertionError("Wrong images written")
+    if out["categories"] != orig.dataset["categories"]:
+        raise AssertionError("Categories were not copied")
+
+
+def test_area_histogram(get_data):
+    edges, labels = [0, 32**2, 64**2, 96**2, 1e5**2], ["xs", "s", "m", "l"]
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    scas = COCO_Assistant(get_data[0], get_data[1], stream=True)
+    hists = stats.area_histograms(cas.anndict, edges, labels, by_category=True)
+    if stats.area_histograms(scas.anndict, edges, labels, by_category=True) != hists:
+        raise AssertionError("Streamed area histograms differ")
+
+    for name, hist in hists.items():
+        coco = COCO(Path(get_data[1]) / (name + ".json"))
+        if stats.area_histogram(coco, edges, labels, by_category=True) != hist:
+            raise AssertionError("Area histograms of COCO datasets differ")
+
+        expected = {}
+        for a in coco.dataset["annotations"]:
+            counts = expected.setdefault(coco.cats[a["category_id"]]["name"], [0] * 5)
+            i = sum(a["area"] >= e for e in edges) - 1
+            counts[i if 0 <= i < len(labels) else len(labels)] += 1
+        if {k: list(v.values()) for k, v in hist.items()} != expected:
+            raise AssertionError("Wrong area histogram")
+
+        total = stats.area_histogram(coco, edges, labels)
+        if list(total.values()) != np.sum(list(expected.values()), axis=0).tolist():
+            raise AssertionError("Wrong total area histogram")
+
+    split = stats.get_object_size_split(cas.anndict["val2017"], [0, 32, 96, 1e5])
+    if sum(split) != len(cas.anndict["val2017"].anns):
+        raise AssertionError("Size split does not add up to the number of objects")
+
+
+def test_headless_stats(get_data, tmp_path):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    scas = COCO_Assistant(get_data[0], get_data[1], stream=True)
+    stat = ["cat", "area", "image"]
+    for name in scas.dh.names:
+        # Several chunks, so streamed statistics are gathered chunk by chunk
+        scas.anndict[name].chunk = 4
+    results = cas.ann_stats(stat, headless=True, report=tmp_path / "stats.json")
+    streamed = scas.ann_stats(stat, report=tmp_path / "stats.csv")
+
+    for name, res in results.items():
+        coco = COCO(Path(get_data[1]) / (name + ".json"))
+        if res["cat"] != streamed[name]["cat"] or res["area"] != streamed[name]["area"]:
+            raise AssertionError("Streamed statistics differ")
+        if res["area"] != stats.area_histogram(coco, [0, 32**2, 96**2, 1e10], stats._SIZE_LABELS):
+            raise AssertionError("Wrong default area split")
+        imgs = res["image"]
+        if imgs["ids"].tolist() != [i["id"] for i in coco.dataset["images"]]:
+            raise AssertionError("Wrong image ids")
+        if imgs["annotations"].tolist() != [len(coco.imgToAnns[i]) for i in imgs["ids"].tolist()]:
+            raise AssertionError("Wrong number of annotations per image")
+        for key in imgs:
+            if imgs[key].tolist() != streamed[name]["image"][key].tolist():
+                raise AssertionError("Streamed image statistics differ")
+
+    with open(tmp_path / "stats.json") as f:
+        report = json.load(f)
+    with open(tmp_path / "stats.csv") as f:
+        rows = f.read().splitlines()
+    name = cas.dh.names[0]
+    if report[name]["cat"] != results[name]["cat"]:
+        raise AssertionError("Wrong category counts in report")
+    if report[name]["image"]["count"] != len(results[name]["image"]["ids"]):
+        raise AssertionError("Wrong image count in report")
+    if rows[0] != "dataset,stat,key,value" or len(rows) != 1 + sum(
+        len(s) for r in report.values() for s in r.values()
+    ):
+        raise AssertionError("CSV and JSON reports differ")
+
+
+def test_headless_plots(get_data, tmp_path, monkeypatch):
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    cas = COCO_Assistant(Path(get_data[0]).resolve(), Path(get_data[1]).resolve())
+    monkeypatch.chdir(tmp_path)
+    # Any backend but Agg, to see that it is left alone
+    backend = matplotlib.get_backend()
+    plt.switch_backend("svg")
+    try:
+        cas.ann_stats(["cat", "area", "geometry"], headless=True, save=True)
+        switched = matplotlib.get_backend() != "svg"
+    finally:
+        plt.switch_backend(backend)
+
+    for plot in ("cat_dist", "area_dist", "geometry_dist"):
+        if not (tmp_path / "results" / "plots" / (plot + ".png")).is_file():
+            raise AssertionError("{} plot not saved".format(plot))
+    if switched or plt.get_fignums():
+        raise AssertionError("Headless plots went through pyplot")
+
+
+def test_stats_sketch(get_data):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    ann = cas.anndict["train2017"]
+    exact = stats.dataset_stats({"train2017": ann})["train2017"]
+    sketch = stats.dataset_sketch(ann)
+
+    # Shards of a few annotations each, serialised as if sent from other machines
+    stream = AnnStream(Path(get_data[1]) / "train2017.json", chunk=7)
+    merged = StatsSketch()
+    merged.update_categories(stream.categories)
+    for chunk in stream.images():
+        merged.update_images([i["id"] for i in chunk])
+    for chunk in stream.annotations():
+        shard = StatsSketch()
+        shard.update(chunk)
+        merged.merge(StatsSketch.from_dict(json.loads(json.dumps(shard.to_dict()))))
+    result = sketch.result()
+    if merged.result() != result:
+        raise AssertionError("Merged shard sketches differ from the dataset sketch")
+
+    n_anns = exact["image"]["annotations"]
+    if result["cat"] != exact["cat"] or result["area"] != exact["area"]:
+        raise AssertionError("Sketched category counts or area split differ")
+    if result["annotations_per_image"] != dict(sorted(Counter(n_anns.tolist()).items())):
+        raise AssertionError("Sketched annotations per image differ")
+    if result["annotations"] != len(ann.anns) or result["images"] != len(n_anns):
+        raise AssertionError("Wrong totals")
+
+    boxes = np.array([a["bbox"] for a in ann.dataset["annotations"]])
+    for key, column in (("width", boxes[:, 2]), ("height", boxes[:, 3])):
+        column = np.sort(column)
+        for q, value in result[key].items():
+            true = column[int(q * (len(column) - 1))]
+            if abs(value - true) > 0.01 * true:
+                raise AssertionError("{} quantile {} is off: {} != {}".format(key, q, value, true))
+
+
+def test_geometry_stats(get_data):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    scas = COCO_Assistant(get_data[0], get_data[1], stream=True)
+    for name in scas.dh.names:
+        # Streamed annotations are binned chunk by chunk
+        scas.anndict[name].chunk = 5
+    results = cas.ann_stats(["per_image", "geometry"], headless=True)
+    if scas.ann_stats(["per_image", "geometry"], headless=True) != results:
+        raise AssertionError("Streamed geometry statistics differ")
+
+    for name, res in results.items():
+        coco = COCO(Path(get_data[1]) / (name + ".json"))
+        if stats.geometry_stats(coco) != res:
+            raise AssertionError("Geometry statistics of COCO datasets differ")
+
+        n_anns = Counter(len(coco.imgToAnns[i]) for i in coco.imgs)
+        if res["per_image"]["annotations"] != dict(sorted(n_anns.items())):
+            raise AssertionError("Wrong annotations per image")
+        if res["per_image"]["empty"] != n_anns[0]:
+            raise AssertionError("Wrong number of empty images")
+        sizes = Counter("{}x{}".format(i["width"], i["height"]) for i in coco.imgs.values())
+        if res["per_image"]["resolution"] != dict(sizes.most_common()):
+            raise AssertionError("Wrong image resolutions")
+
+        geometry = res["geometry"]
+        polygons = [a for a in coco.anns.values() if isinstance(a["segmentation"], list)]
+        if sum(geometry["vertices"].values()) - geometry["vertices"]["ignored"] != len(polygons):
+            raise AssertionError("Wrong number of polygons")
+        small = [
+            a
+            for a in coco.anns.values()
+            if a["bbox"][2] * a["bbox"][3]
+            < 0.1**2 * coco.imgs[a["image_id"]]["width"] * coco.imgs[a["image_id"]]["height"]
+        ]
+        if geometry["relative_size"]["0-0.05"] + geometry["relative_size"]["0.05-0.1"] != len(
+            small
+        ):
+            raise AssertionError("Wrong relative sizes")
+        verts = cas.anndict[name].table.nverts.tolist()
+        if verts != [polygon_vertices(a["segmentation"]) for a in coco.dataset["annotations"]]:
+            raise AssertionError("Wrong vertex counts in the table")
+
+
+def test_result_cache(get_data, tmp_path, monkeypatch):
+    ann_dir = tmp_path / "annotations"
+    shutil.copytree(get_data[1], ann_dir)
+    cache_dir = tmp_path / "results"
+    stat = ["cat", "area", "geometry"]
+
+    cas = COCO_Assistant(get_data[0], ann_dir, result_cache=cache_dir)
+    results = cas.ann_stats(stat, headless=True)
+    cas = COCO_Assistant(get_data[0], ann_dir, result_cache=cache_dir)
+    if cas.ann_stats(stat, headless=True) != results:
+        raise AssertionError("Cached statistics differ")
+    if cas.anndict.loaded:
+        raise AssertionError("Datasets parsed despite cached statistics")
+
+    # Editing a dataset invalidates its results only
+    name = cas.dh.names[0]
+    with open(ann_dir / (name + ".json")) as f:
+        dataset = json.load(f)
+    dataset["annotations"] = dataset["annotations"][1:]
+    with open(ann_dir / (name + ".json"), "w") as f:
+        json.dump(dataset, f)
+    cas = COCO_Assistant(get_data[0], ann_dir, result_cache=cache_dir)
+    fresh = cas.ann_stats(stat, headless=True)
+    if cas.anndict.loaded != [name]:
+        raise AssertionError("Wrong datasets parsed after editing one")
+    if fresh[name] == results[name] or fresh != COCO_Assistant(get_data[0], ann_dir).ann_stats(
+        stat, headless=True
+    ):
+        raise AssertionError("Stale statistics returned")
+
+    calls = []
+
+    def cluster_anchors(datasets, n, *args, **kmeans):
+        calls.extend(datasets)
+        return {name: {None: (1.0, np.ones((n, 2)))} for name in datasets}
+
+    monkeypatch.setattr(utils, "cluster_anchors", cluster_anchors)
+    COCO_Assistant(get_data[0], ann_dir, result_cache=cache_dir).anchors(3)
+    cas = COCO_Assistant(get_data[0], ann_dir, result_cache=cache_dir)
+    cas.anchors(3)
+    if len(calls) != len(cas.dh.names) or cas.anndict.loaded:
+        raise AssertionError("Anchors not cached")
+    cas.anchors(4)
+    cas.anchors(4, recompute=True)
+    if len(calls) != 3 * len(cas.dh.names):
+        raise AssertionError("Anchors not recomputed")
+
+    # Least recently used results are evicted first
+    size = len(pickle.dumps(list(range(100)), protocol=4))
+    cache = ResultCache(tmp_path / "small", max_bytes=2 * size)
+    cache.put("a", list(range(100)))
+    cache.put("b", list(range(100)))
+    os.utime(tmp_path / "small" / "b.pkl", ns=(0, 0))
+    cache.put("c", list(range(100)))
+    if cache.get("b") is not None or cache.get("a") is None or cache.get("c") is None:
+        raise AssertionError("Wrong result evicted")
+
+    # Parameters are keyed on their json only, array valued ranges are converted first
+    with pytest.raises(AssertionError, match="not json serialisable"):
+        cache.key("stats", [], {"arearng": np.arange(2000)})
+    cas = COCO_Assistant(get_data[0], ann_dir, result_cache=cache_dir)
+    rng = np.array([0, 32, 96, 1e5])
+    if cas.ann_stats("area", rng, headless=True) != cas.ann_stats(
+        "area", rng.tolist(), headless=True
+    ):
+        raise AssertionError("Array valued area ranges keyed differently")
+
+
+def _box_iou(box, centroids):
+    # Reference IoU of a single box, one centroid at a time
+    w, h = box
+    similarities = []
+    for c_w, c_h in centroids:
+        if c_w >= w and c_h >= h:
+            similarities.append(w * h / (c_w * c_h))
+        elif c_w >= w and c_h <= h:
+            similarities.append(w * c_h / (w * h + (c_w - w) * c_h))
+        elif c_w <= w and c_h >= h:
+            similarities.append(c_w * h / (w * h + c_w * (c_h - h)))
+        else:
+            similarities.append((c_w * c_h) / (w * h))
+    return np.array(similarities)
+
+
+def test_kmeans_anchors(get_data):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    dims = np.concatenate([box_dims(ann) for ann in cas.anndict.values()])
+    init = dims[[0, 10, 20, 30, 40]]
+
+    if not (anchors.iou(dims, init) == [_box_iou(d, init) for d in dims]).all():
+        raise AssertionError("IoU matrix differs from box by box IoU")
+
+    # Box by box k-means, as anchors were computed before
+    centroids = init.copy()
+    prev = None
+    while True:
+        assignments = np.array([np.argmin(1 - _box_iou(d, centroids)) for d in dims])
+        if prev is not None and (assignments == prev).all():
+            break
+        for j in range(len(centroids)):
+            centroids[j] = dims[assignments == j].sum(axis=0) / (np.sum(assignments == j) + 1e-6)
+        prev = assignments
+
+    if not (anchors.run_kmeans(dims, 5, init=init, chunk=7) == centroids).all():
+        raise AssertionError("Chunked k-means differs from box by box k-means")
+    expected = np.mean([_box_iou(d, centroids).max() for d in dims])
+    if not np.isclose(anchors.avg_iou(dims, centroids, chunk=7), expected):
+        raise AssertionError("Wrong average IoU")
+    if utils.generate_anchors(cas.anndict[cas.dh.names[0]], 3).shape != (3, 2):
+        raise AssertionError("Wrong number of anchors")
+
+
+def test_kmeans_options(get_data, capsys):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    dims = np.concatenate([box_dims(ann) for ann in cas.anndict.values()])
+
+    for kmeans in ({}, {"init": "kmeans++"}, {"init": "kmeans++", "batch_size": 64}):
+        first = anchors.run_kmeans(dims, 5, seed=0, **kmeans)
+        if not (anchors.run_kmeans(dims, 5, seed=0, **kmeans) == first).all():
+            raise AssertionError("Seeded anchors differ between runs: {}".format(kmeans))
+        if anchors.avg_iou(dims, first) < 0.45:
+            raise AssertionError("Poor anchors: {}".format(kmeans))
+
+    init = anchors.kmeans_pp(dims, 5, np.random.default_rng(0))
+    if len({tuple(c) for c in init}) != 5 or not all((dims == c).all(axis=1).any() for c in init):
+        raise AssertionError("k-means++ did not pick distinct boxes")
+
+    capsys.readouterr()
+    anchors.run_kmeans(dims, 5, init=init, max_iter=2)
+    anchors.run_kmeans(dims, 5, init=init, tol=1)
+    anchors.run_kmeans(dims, 5, seed=0, batch_size=64, max_iter=3)
+    if capsys.readouterr().out.count("iteration") != 6:
+        raise AssertionError("Iteration cap or tolerance ignored")
+
+    with pytest.raises(AssertionError):
+        anchors.run_kmeans(dims, 5, init="kmeans")
+
+
+def test_anchor_restarts(get_data):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    dims = {name: box_dims(ann) for name, ann in cas.anndict.items()}
+
+    runs = anchors.cluster_anchors(dims, 4, restarts=3, seed=0, init="kmeans++")
+    for name, d in dims.items():
+        scores = [
+            anchors.avg_iou(d, anchors.run_kmeans(d, 4, init="kmeans++", seed=s, verbose=False))
+            for s in np.random.SeedSequence(0).spawn(3)
+        ]
+        if runs[name][None][0] != max(scores):
+            raise AssertionError("Best restart not kept")
+
+    levels = anchors.split_scales(dims[cas.dh.names[0]], "fpn")
+    if list(levels) != list(anchors.FPN_LEVELS) or sum(map(len, levels.values())) != len(
+        dims[cas.dh.names[0]]
+    ):
+        raise AssertionError("Boxes not split into pyramid levels")
+    for i, level in enumerate(anchors.FPN_LEVELS):
+        scale = np.sqrt(levels[level].prod(axis=1))
+        lo, hi = anchors.FPN_SCALE_EDGES[i : i + 2]
+        if ((scale < lo) | (scale >= hi)).any():
+            raise AssertionError("Box in the wrong pyramid level")
+
+    scaled = anchors.cluster_anchors(dims, 2, restarts=2, scales="fpn", seed=0, workers=2)
+    if scaled.keys() != dims.keys():
+        raise AssertionError("Datasets missing from per level anchors")
+    for name, res in anchors.cluster_anchors(dims, 2, restarts=2, scales="fpn", seed=0).items():
+        expected = {
+            level: len(d) > 0 for level, d in anchors.split_scales(dims[name], "fpn").items()
+        }
+        if {level: level in res for level in expected} != expected:
+            raise AssertionError("Wrong pyramid levels clustered")
+        for level, (score, centroids) in res.items():
+            if score != scaled[name][level][0] or (centroids != scaled[name][level][1]).any():
+                raise AssertionError("Parallel runs differ from sequential runs")
+
+    cas.anchors(2, scales="fpn", restarts=2, seed=0, workers=2)
+    if not all(set(a) <= set(anchors.FPN_LEVELS) for a in cas.ann_anchors.values()):
+        raise AssertionError("Anchors not computed per level")
+
+
+def test_anchor_evaluation(get_data, tmp_path):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    scas = COCO_Assistant(get_data[0], get_data[1], stream=True)
+    with pytest.raises(AssertionError):
+        cas.evaluate_anchors()
+
+    cas.anchors(4, seed=0)
+    results = cas.evaluate_anchors(report=tmp_path / "anchors.csv")
+    for name, res in results.items():
+        coco = COCO(Path(get_data[1]) / (name + ".json"))
+        dims = box_dims(coco)
+        with np.errstate(invalid="ignore"):
+            best = np.nan_to_num([_box_iou(d, cas.ann_anchors[name]).max() for d in dims])
+        if res["iou"]["boxes"] != len(dims) or not np.isclose(res["iou"]["mean"], best.mean()):
+            raise AssertionError("Wrong mean IoU")
+        median = np.sort(best)[(len(best) - 1) // 2]
+        if not np.isclose(res["iou"]["quantiles"][0.5], median, rtol=0.01):
+            raise AssertionError("Wrong median IoU")
+        if res["recall"] != {"{:g}".format(t): np.mean(best >= t) for t in anchors.IOU_THRESHOLDS}:
+            raise AssertionError("Wrong recall")
+        if sum(res["iou"]["histogram"].values()) != len(dims):
+            raise AssertionError("Boxes missing from the IoU histogram")
+        if {k: v["boxes"] for k, v in res["by_category"].items()} != stats.category_counts(coco):
+            raise AssertionError("Wrong per category breakdown")
+        sizes = stats.area_histogram(coco, anchors.AREA_EDGES, anchors.AREA_LABELS)
+        if {k: v["boxes"] for k, v in res["by_size"].items()} != sizes:
+            raise AssertionError("Wrong per size breakdown")
+
+        # Streamed in tiny chunks, against the anchors of every pyramid level at once
+        scas.anndict[name].chunk = 3
+        levels = {"P3": cas.ann_anchors[name][:2], "P4": cas.ann_anchors[name][2:]}
+        streamed = anchors.evaluate_anchors(scas.anndict[name], levels, chunk=5)
+        expected, got = dict(stats._flatten(res)), dict(stats._flatten(streamed))
+        if got.keys() != expected.keys() or not np.allclose(
+            list(got.values()), list(expected.values())
+        ):
+            raise AssertionError("Streamed anchor evaluation differs")
+
+    with open(tmp_path / "anchors.csv") as f:
+        if "recall.0.75" not in f.read():
+            raise AssertionError("Anchor evaluation report not written")
+
+
+def test_parallel_segmasks(get_data):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    out = cas.res_dir / "segmasks"
+    cas.get_segmasks()
+    expected = {p.relative_to(out): p.read_bytes() for p in out.rglob("*.png")}
+    shutil.rmtree(out)
+    cas.get_segmasks(workers=2)
+    parallel = {p.relative_to(out): p.read_bytes() for p in out.rglob("*.png")}
+
+    for name in cas.dh.names:
+        coco = COCO(Path(get_data[1]) / (name + ".json"))
+        for img in coco.imgs.values():
+            mask = np.array(Image.open(out / name / (Path(img["file_name"]).stem + ".png")))
+            covered = np.zeros((img["height"], img["width"]), dtype=bool)
+            for ann in coco.imgToAnns[img["id"]]:
+                covered |= coco.annToMask(ann) > 0
+            if ((mask > 0) != covered).any():
+                raise AssertionError("Mask does not cover the annotations")
+
+    # Clean up
+    shutil.rmtree(cas.res_dir)
+    if len(expected) != sum(len(ann.imgs) for ann in cas.anndict.values()):
+        raise AssertionError("Masks missing")
+    if parallel != expected:
+        raise AssertionError("Parallel masks differ from sequential masks")
+
+
+def test_segmask_painter(tmp_path):
+    def square(x, y, size):
+        return [[x, y, x + size, y, x + size, y + size, x, y + size]]
+
+    anns = [
+        # Small object on top of a large one
+        {"segmentation": square(0.5, 0.5, 30), "area": 900.0, "category_id": 1},
+        {"segmentation": square(10.2, 10.7, 5), "area": 25.0, "category_id": 2},
+        # Objects of the same area, the later one ends up on top
+        {"segmentation": square(40, 5, 10), "area": 100.0, "category_id": 3},
+        {"segmentation": square(45, 10, 10), "area": 100.0, "category_id": 4},
+        # Crowd region stored as RLE, reaching the edge of the image
+        {"segmentation": None, "area": 50.0, "category_id": 5, "iscrowd": 1},
+    ]
+    crowd = np.zeros((40, 64), dtype=np.uint8, order="F")
+    crowd[30:, 54:] = 1
+    anns[4]["segmentation"] = maskUtils.encode(crowd)
+    anns[4]["segmentation"]["counts"] = anns[4]["segmentation"]["counts"].decode()
+    for i, ann in enumerate(anns):
+        ann.update(id=i + 1, image_id=1, bbox=[0, 0, 0, 0])
+
+    coco = COCO()
+    coco.dataset = {
+        "images": [{"id": 1, "file_name": "tile.jpg", "height": 40, "width": 64}],
+        "annotations": anns,
+        "categories": [{"id": i, "name": str(i)} for i in range(1, 6)],
+    }
+    coco.createIndex()
+    utils.det2seg(coco, tmp_path, palette=False)
+
+    expected = np.zeros((40, 64), dtype=np.uint8)
+    for ann in (anns[0], anns[2], anns[3], anns[1], anns[4]):
+        expected[coco.annToMask(ann) > 0] = ann["category_id"]
+    mask = np.array(Image.open(tmp_path / "tile.png"))
+    if (mask != expected).any():
+        raise AssertionError("Masks not painted from the largest to the smallest object")
+    if mask[12, 12] != 2 or mask[6, 41] != 3 or mask[12, 47] != 4 or mask[35, 60] != 5:
+        raise AssertionError("Wrong object on top")
+
+
+def test_mask_shards(get_data, tmp_path):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    cas.get_segmasks()
+    cas.get_segmasks(fmt="shards")
+    name = cas.dh.names[0]
+    shards = MaskShards(cas.res_dir / "segmasks" / name)
+    coco = cas.anndict[name]
+    if shards.palette is None or shards.palette.shape != (256, 3):
+        raise AssertionError("Palette not stored with the shards")
+    for img in coco.imgs.values():
+        mask = shards[img["file_name"]]
+        png = Image.open(cas.res_dir / "segmasks" / name / (Path(img["file_name"]).stem + ".png"))
+        if (np.array(png) != mask).any():
+            raise AssertionError("PNG palette changed the mask")
+        if (shards.palette[mask] != np.array(png.convert("RGB"))).any():
+            raise AssertionError("Shard palette differs from PNG palette")
+
+    utils.det2seg(coco, tmp_path / "png", palette=False)
+    utils.det2seg(coco, tmp_path / "shards", palette=False, workers=2, chunk=4, fmt="shards")
+    utils.det2seg(coco, tmp_path / "small", fmt="shards", shard_bytes=100000)
+    small = MaskShards(tmp_path / "small")
+
+    # Clean up
+    shutil.rmtree(cas.res_dir)
+    if len(small.shards) < 2 or len(list((tmp_path / "small").glob("*.bin"))) != len(small.shards):
+        raise AssertionError("Masks not split into shards")
+
+    parallel = MaskShards(tmp_path / "shards")
+    if sorted(parallel) != sorted(img["file_name"] for img in coco.imgs.values()):
+        raise AssertionError("Masks missing from the shards")
+    for img in coco.imgs.values():
+        png = np.array(Image.open(tmp_path / "png" / (Path(img["file_name"]).stem + ".png")))
+        mask = parallel[img["file_name"]]
+        if mask.shape != (img["height"], img["width"]) or (mask != png).any():
+            raise AssertionError("Sharded mask differs from PNG mask")
+        if (small[img["file_name"]] != png).any():
+            raise AssertionError("Mask split across shards")
+
+    utils.det2seg(coco, tmp_path / "small", fmt="shards")
+    if len(list((tmp_path / "small").glob("*.bin"))) != 1:
+        raise AssertionError("Stale shards left behind")
+
+
+def test_bulk_remap():
+    plan = DatasetPlan(True, True, 10, 100, {1: 3, 2: 1, 7: 2})
+    img_ids = np.array([5, 9, 4])
+    anns = [{"id": 0, "image_id": i, "category_id": c} for i, c in [(9, 7), (4, 1), (5, 2), (9, 1)]]
+    image_ids = np.array([a["image_id"] for a in anns])
+    category_ids = np.array([a["category_id"] for a in anns])
+
+    expected = plan.rewrite_annotations(copy.deepcopy(anns), 4, plan.image_id_map(img_ids.tolist()))
+    bulk = plan.rewrite_annotation_columns(anns, 4, image_ids, category_ids, GroupIndex(img_ids))
+    if bulk != expected:
+        raise AssertionError("Bulk remapping differs from record by record remapping")
+    with pytest.raises(KeyError):
+        plan.map_categories(np.array([1, 4]))
+
+
 # @pytest.mark.skip
 def test_cat_removal(get_data):
     cas = COCO_Assistant(get_data[0], get_data[1])
@@ -121,3 +924,144 @@ def test_cat_remapper(cat1, cat2, result):
     res = cmapper.remap_cats()
     if res != result:
         raise AssertionError("CatRemapper failed")
+
+
+def test_lazy_loading(get_data, caplog):
+    caplog.set_level(logging.INFO)
+    cas = COCO_Assistant(get_data[0], get_data[1], mem_budget=1)
+    if cas.anndict.loaded:
+        raise AssertionError("Datasets parsed before being accessed")
+
+    first, second = cas.dh.names[:2]
+    cas.anndict[first]
+    if cas.anndict.loaded != [first]:
+        raise AssertionError("Accessed dataset was not loaded")
+
+    # Budget only fits a single dataset, so the first one has to go
+    cas.anndict[second]
+    if cas.anndict.loaded != [second]:
+        raise AssertionError("Least recently used dataset was not evicted")
+    if "Evicting dataset {}".format(first) not in caplog.text:
+        raise AssertionError("Eviction was not reported")
+
+
+def test_parallel_loading(get_data):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    pcas = COCO_Assistant(get_data[0], get_data[1], workers=2)
+    for name in cas.dh.names:
+        if pcas.anndict[name].dataset != cas.anndict[name].dataset:
+            raise AssertionError("Parallel loading changed dataset {}".format(name))
+        if pcas.anndict[name].anns != cas.anndict[name].anns:
+            raise AssertionError("Parallel loading changed index of {}".format(name))
+
+
+def test_sidecar_cache(get_data, tmp_path):
+    cache_dir = tmp_path / "cache"
+    cas = COCO_Assistant(get_data[0], get_data[1], cache=cache_dir)
+    name = cas.dh.names[0]
+    dataset = cas.anndict[name].dataset
+    if not (cache_path(cas.dh.ann_path(name), cache_dir) / "meta.json").exists():
+        raise AssertionError("Cache not written on first access")
+
+    ann_file = tmp_path / (name + ".json")
+    shutil.copy(Path(get_data[1]) / (name + ".json"), ann_file)
+    cache_dir = tmp_path / "cache2"
+    load_table(ann_file, cache_dir)
+    cached = load_cached_table(ann_file, cache_dir)
+    if cached is None or cached.to_dataset() != dataset:
+        raise AssertionError("Cached table does not match annotation file")
+
+    # Same content, new mtime: cache stays valid
+    os.utime(ann_file, ns=(0, 0))
+    if load_cached_table(ann_file, cache_dir) is None:
+        raise AssertionError("Cache invalidated by unchanged annotation file")
+
+    with open(ann_file, "a") as f:
+        f.write("\n")
+    if load_cached_table(ann_file, cache_dir) is not None:
+        raise AssertionError("Cache not invalidated by modified annotation file")
+
+    # Annotation files of the same name in other directories get caches of their own
+    other = tmp_path / "other" / (name + ".json")
+    other.parent.mkdir()
+    shutil.copy(Path(get_data[1]) / (cas.dh.names[1] + ".json"), other)
+    load_table(ann_file, cache_dir)
+    load_table(other, cache_dir)
+    for path in (ann_file, other):
+        cached = load_cached_table(path, cache_dir)
+        if cached is None or cached.to_dataset() != jsonio.load(path):
+            raise AssertionError("Caches of annotation files with the same name collide")
+
+
+def test_table_view(get_data):
+    ann_file = Path(get_data[1]) / "val2017.json"
+    coco = COCO(ann_file)
+    view = TableCOCO(AnnTable.from_json(ann_file))
+
+    img_ids = coco.getImgIds()
+    cat_ids = coco.getCatIds()
+    queries = [
+        {},
+        {"imgIds": img_ids[:3]},
+        {"catIds": cat_ids[:2]},
+        {"imgIds": img_ids[:5], "catIds": cat_ids[1:], "iscrowd": 0},
+        {"areaRng": [32**2, 96**2]},
+    ]
+    for q in queries:
+        if view.getAnnIds(**q) != coco.getAnnIds(**q):
+            raise AssertionError("getAnnIds({}) differs from pycocotools".format(q))
+
+    ann_ids = coco.getAnnIds(imgIds=img_ids[:3])
+    if view.loadAnns(ann_ids) != coco.loadAnns(ann_ids):
+        raise AssertionError("loadAnns differs from pycocotools")
+    if view.getImgIds() != img_ids or view.loadImgs(img_ids) != coco.loadImgs(img_ids):
+        raise AssertionError("Image lookups differ from pycocotools")
+    if view.materialized:
+        raise AssertionError("Lookups built the dict based index")
+
+
+def test_streaming(get_data):
+    cas = COCO_Assistant(get_data[0], get_data[1])
+    scas = COCO_Assistant(get_data[0], get_data[1], stream=True)
+    for name in cas.dh.names:
+        # Tiny chunks, so records and values straddle chunk boundaries
+        scas.anndict[name].chunk = 3
+        scas.anndict[name].chunk_size = 16
+
+        if stats.category_counts(scas.anndict[name]) != stats.category_counts(cas.anndict[name]):
+            raise AssertionError("Streamed category counts differ")
+        if (box_dims(scas.anndict[name]) != box_dims(cas.anndict[name])).any():
+            raise AssertionError("Streamed box dimensions differ")
+
+    merged = cas.res_dir / "merged/annotations/merged.json"
+    cas.merge()
+    with open(merged) as f:
+        expected = f.read()
+    scas.merge()
+    with open(merged) as f:
+        streamed = f.read()
+
+    scas.remove_cat(interactive=False, jc=Path(get_data[1]) / "val2017.json", rcats=["person"])
+    rmj = COCO(scas.res_dir / "removal" / "val2017.json")
+
+    # Clean up
+    shutil.rmtree(cas.res_dir)
+    if streamed != expected:
+        raise AssertionError("Streaming merge differs from regular merge")
+    if rmj.getCatIds(catNms=["person"]) or rmj.getAnnIds(catIds=[1]):
+        raise AssertionError("Streaming category removal failed")
+
+
+def test_import_time():
+    # Plotting and dataframe libraries must only be imported when plotting
+    code = (
+        "import sys, time; t = time.perf_counter(); import coco_assistant; "
+        "print(time.perf_counter() - t); "
+        "print(' '.join(m for m in ('matplotlib', 'pandas', 'seaborn') if m in sys.modules))"
+    )
+    out = subprocess.check_output([sys.executable, "-c", code], universal_newlines=True)
+    seconds, heavy = (out.splitlines() + [""])[:2]
+    if heavy:
+        raise AssertionError("Importing coco_assistant imported {}".format(heavy))
+    if float(seconds) > 2:
+        raise AssertionError("Importing coco_assistant took {:.2f}s".format(float(seconds)))